@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models import Sum
 from django.utils import timezone
 from django.conf import settings
 from django.core.cache import cache
@@ -11,6 +12,7 @@ from oauth2_provider.models import AccessToken, Application
 from rest_framework.authtoken.models import Token
 
 from valhalla.proposals.models import Proposal
+from valhalla.userrequests.models import Request
 
 logger = logging.getLogger()
 
@@ -30,12 +32,14 @@ class Profile(models.Model):
     def time_used_in_proposal(self, proposal):
         if not proposal.current_semester:
             return 0
-        user_requests = self.user.userrequest_set.filter(
-            proposal=proposal, created__gte=proposal.current_semester.start, state__in=['PENDING', 'COMPLETED']
-        ).prefetch_related('requests')
-        return sum(
-            request.duration for user_request in user_requests for request in user_request.requests.filter(state__in=['PENDING', 'COMPLETED'])
+        requests = Request.objects.filter(
+            user_request__submitter=self.user, user_request__proposal=proposal,
+            user_request__created__gte=proposal.current_semester.start,
+            user_request__state__in=['PENDING', 'COMPLETED'], state__in=['PENDING', 'COMPLETED']
         )
+        for request in requests.filter(duration__isnull=True).prefetch_related('molecules'):
+            request.get_duration()
+        return requests.aggregate(time_used=Sum('duration'))['time_used'] or 0
 
     @property
     def archive_bearer_token(self):
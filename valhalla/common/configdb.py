@@ -1,20 +1,48 @@
 import requests
 from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
 from django.utils.translation import ugettext as _
 from django.conf import settings
-from collections import namedtuple
+from django.dispatch import Signal
+from django.utils import timezone
+from dateutil.parser import parse
+from collections import namedtuple, OrderedDict
+from datetime import timedelta
+import threading
+import time
+import hashlib
+import json
+import os
+import tempfile
 import logging
 
 logger = logging.getLogger(__name__)
 
 CONFIGDB_ERROR_MSG = _(("ConfigDB connection is currently down, please wait a few minutes and try again."
                        " If this problem persists then please contact support."))
+CONFIGDB_CACHE_TIMEOUT = 900           # seconds before a cached configdb snapshot is refreshed in the background
+CONFIGDB_REFRESH_LOCK_TIMEOUT = 60     # seconds a background refresh may hold the refresh lock
+CONFIGDB_LOCK_POLL_INTERVAL = 0.1      # seconds between checks for the snapshot of a fetch made by another worker
+CONFIGDB_RESOURCES = ('sites', 'filterwheels')
+
+
+# sent when a refresh finds that the content of a resource has changed
+configdb_changed = Signal(providing_args=['resource', 'version'])
 
 
 class ConfigDBException(Exception):
     pass
 
 
+def get_snapshot_cache():
+    ''' The cache holding the configdb snapshots: the shared default cache, or the process local cache when no shared
+        cache is configured
+    '''
+    if isinstance(caches['default'], DummyCache):
+        return caches['locmem']
+    return caches['default']
+
+
 class TelescopeKey(namedtuple('TelescopeKey', ['site', 'observatory', 'telescope'])):
     __slots__ = ()
 
@@ -22,29 +50,405 @@ class TelescopeKey(namedtuple('TelescopeKey', ['site', 'observatory', 'telescope
         return ".".join(s for s in [self.site, self.observatory, self.telescope] if s)
 
 
+class CameraType(namedtuple('CameraType', [
+    'code', 'name', 'binnings', 'default_binning', 'exposure_overheads', 'default_exposure_overhead',
+    'request_overheads'
+])):
+    ''' The properties of a configdb camera type used for scheduling. exposure_overheads maps each binning to the
+        readout plus fixed overhead of an exposure.
+    '''
+    __slots__ = ()
+
+    @classmethod
+    def from_configdb(cls, camera_type):
+        fixed_overhead = camera_type['fixed_overhead_per_exposure']
+        exposure_overheads = {}
+        for mode in camera_type['mode_set']:
+            exposure_overheads.setdefault(mode['binning'], mode['readout'] + fixed_overhead)
+        return cls(
+            code=camera_type['code'].upper(),
+            name=camera_type['name'],
+            binnings=frozenset(mode['binning'] for mode in camera_type['mode_set']),
+            default_binning=camera_type['default_mode']['binning'],
+            exposure_overheads=exposure_overheads,
+            default_exposure_overhead=camera_type['default_mode']['readout'] + fixed_overhead,
+            request_overheads={
+                'config_change_time': camera_type['config_change_time'],
+                'acquire_processing_time': camera_type['acquire_processing_time'],
+                'acquire_exposure_time': camera_type['acquire_exposure_time'],
+                'front_padding': camera_type['front_padding'],
+                'filter_change_time': camera_type['filter_change_time']
+            }
+        )
+
+
+class Instrument(namedtuple('Instrument', ['code', 'name', 'state', 'telescope_key', 'camera_type', 'filters'])):
+    ''' A configdb instrument. Instruments of the same type share a single CameraType, and filters are lower case.
+    '''
+    __slots__ = ()
+
+    @property
+    def instrument_type(self):
+        return self.camera_type.code
+
+    @property
+    def schedulable(self):
+        return self.state == 'SCHEDULABLE'
+
+
+class OverheadTables(namedtuple('OverheadTables', [
+    'exposure_overheads', 'default_exposure_overheads', 'request_overheads'
+])):
+    ''' Flat overhead lookups for duration calculations: (instrument_type, binning) -> exposure overhead,
+        instrument_type -> default binning exposure overhead and instrument_type -> request overheads dict.
+        Built once per snapshot and shared, so the tables must not be modified.
+    '''
+    __slots__ = ()
+
+    def get_exposure_overhead(self, instrument_type, binning):
+        instrument_type = instrument_type.upper()
+        try:
+            return self.exposure_overheads[(instrument_type, binning)]
+        except KeyError:
+            pass
+        # if the binning is not found, return the default binning (Added to support legacy 2x2 Sinistro obs)
+        try:
+            return self.default_exposure_overheads[instrument_type]
+        except KeyError:
+            raise ConfigDBException("Instrument type {} not found in configdb.".format(instrument_type))
+
+    def get_request_overheads(self, instrument_type):
+        try:
+            return self.request_overheads[instrument_type.upper()]
+        except KeyError:
+            raise ConfigDBException("Instrument type {} not found in configdb.".format(instrument_type))
+
+
+class ConfigDBIndex(object):
+    ''' Read-only view of the configdb site structure, indexed once per fetch of the site data so that lookups
+        by instrument type, TelescopeKey and (instrument_type, binning) do not walk the whole site tree.
+        Instrument types are keyed upper case.
+    '''
+    def __init__(self, site_data, version=None):
+        self.version = version
+        self.instruments = []
+        self.schedulable_instruments = []
+        self.telescope_details = OrderedDict()
+        self.instrument_types_by_telescope = OrderedDict()
+        self.schedulable_instrument_types_by_telescope = OrderedDict()
+        self.telescopes_by_instrument_type = {}
+        self.schedulable_telescopes_by_instrument_type = {}
+        self.filters_by_instrument_type = {}
+        self.camera_types = {}
+        self.exposure_overheads = {}
+        self._active_instrument_types = []
+        self._active_instrument_types_by_location = {}
+
+        for site in site_data:
+            for enclosure in site['enclosure_set']:
+                for telescope in enclosure['telescope_set']:
+                    telescope_key = TelescopeKey(
+                        site=site['code'],
+                        observatory=enclosure['code'],
+                        telescope=telescope['code']
+                    )
+                    self.telescope_details[telescope_key] = {
+                        'latitude': telescope['lat'],
+                        'longitude': telescope['long'],
+                        'horizon': telescope['horizon'],
+                        'altitude': site['elevation'],
+                        'ha_limit_pos': telescope['ha_limit_pos'],
+                        'ha_limit_neg': telescope['ha_limit_neg']
+                    }
+                    for instrument in telescope['instrument_set']:
+                        self._add_instrument(telescope_key, instrument)
+
+        self.overhead_tables = OverheadTables(
+            exposure_overheads=self.exposure_overheads,
+            default_exposure_overheads={instrument_type: camera_type.default_exposure_overhead
+                                        for instrument_type, camera_type in self.camera_types.items()},
+            request_overheads={instrument_type: camera_type.request_overheads
+                               for instrument_type, camera_type in self.camera_types.items()}
+        )
+
+    def _add_instrument(self, telescope_key, instrument_data):
+        camera_data = instrument_data['science_camera']
+        instrument_type = camera_data['camera_type']['code'].upper()
+        # The first instrument found of a type defines the camera type properties used for that instrument type
+        if instrument_type not in self.camera_types:
+            camera_type = CameraType.from_configdb(camera_data['camera_type'])
+            self.camera_types[instrument_type] = camera_type
+            for binning, overhead in camera_type.exposure_overheads.items():
+                self.exposure_overheads[(instrument_type, binning)] = overhead
+        instrument = Instrument(
+            code=instrument_data['code'],
+            name=instrument_data['__str__'],
+            state=instrument_data['state'],
+            telescope_key=telescope_key,
+            camera_type=self.camera_types[instrument_type],
+            filters=frozenset(camera_filter.lower() for camera_filter in camera_data['filters'].split(','))
+        )
+
+        self.instruments.append(instrument)
+        self._add_to_index(self.instrument_types_by_telescope, self.telescopes_by_instrument_type,
+                           telescope_key, instrument_type)
+        if instrument.schedulable:
+            self.schedulable_instruments.append(instrument)
+            self._add_to_index(self.schedulable_instrument_types_by_telescope,
+                               self.schedulable_telescopes_by_instrument_type, telescope_key, instrument_type)
+            self.filters_by_instrument_type.setdefault(instrument_type, set()).update(instrument.filters)
+            self._active_instrument_types.append((instrument.name.lower().split('.'), instrument_type))
+
+    @staticmethod
+    def _add_to_index(types_by_telescope, telescopes_by_type, telescope_key, instrument_type):
+        instrument_types = types_by_telescope.setdefault(telescope_key, [])
+        if instrument_type not in instrument_types:
+            instrument_types.append(instrument_type)
+        telescopes_by_type.setdefault(instrument_type, set()).add(telescope_key)
+
+    def get_active_instrument_types(self, location):
+        location_key = tuple(location.get(field, '').lower()
+                             for field in ('site', 'observatory', 'telescope_class', 'telescope'))
+        if location_key not in self._active_instrument_types_by_location:
+            site, observatory, telescope_class, telescope = location_key
+            self._active_instrument_types_by_location[location_key] = frozenset(
+                instrument_type for split_string, instrument_type in self._active_instrument_types
+                if (site in split_string[0] and observatory in split_string[1]
+                    and telescope_class in split_string[2] and telescope in split_string[2])
+            )
+        return self._active_instrument_types_by_location[location_key]
+
+
 class ConfigDB(object):
+    def __init__(self):
+        self._index = None
+        self._index_site_data = None
+        self._snapshots = {}
+        self._snapshot_files_loaded = set()
+
+    @staticmethod
+    def _fetch_configdb_data(resource, info=None):
+        ''' Gets all the data for a resource from configdb. If the info of the current snapshot is given the request
+            is made conditional on its ETag/Last-Modified, and None is returned when configdb says it is unchanged.
+        :return: tuple of the list of dictionaries of resource data and the response headers
+        '''
+        headers = {}
+        if info and info.get('etag'):
+            headers['If-None-Match'] = info['etag']
+        if info and info.get('last_modified'):
+            headers['If-Modified-Since'] = info['last_modified']
+        try:
+            r = requests.get(settings.CONFIGDB_URL + '/{}/'.format(resource), headers=headers,
+                             timeout=settings.CONFIGDB_TIMEOUT)
+            r.raise_for_status()
+        except (requests.exceptions.RequestException, requests.exceptions.HTTPError) as e:
+            msg = "{}: {}".format(e.__class__.__name__, CONFIGDB_ERROR_MSG)
+            raise ConfigDBException(msg)
+        if r.status_code == 304:
+            return None, r.headers
+        try:
+            return r.json()['results'], r.headers
+        except KeyError:
+            raise ConfigDBException(CONFIGDB_ERROR_MSG)
+
+    @staticmethod
+    def _get_version(data):
+        return hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+    @staticmethod
+    def _get_snapshot_path(resource):
+        if not settings.CONFIGDB_SNAPSHOT_DIR:
+            return None
+        return os.path.join(settings.CONFIGDB_SNAPSHOT_DIR, '{}.json'.format(resource))
+
+    def _write_snapshot_file(self, resource, info, data):
+        ''' Writes the snapshot to CONFIGDB_SNAPSHOT_DIR, replacing the previous file atomically so a reader never
+            sees a partial file.
+        '''
+        path = self._get_snapshot_path(resource)
+        if path is None:
+            return
+        snapshot = dict(info, fetched=info['fetched'].isoformat(), results=data)
+        try:
+            os.makedirs(settings.CONFIGDB_SNAPSHOT_DIR, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=settings.CONFIGDB_SNAPSHOT_DIR, suffix='.tmp')
+            with os.fdopen(fd, 'w') as snapshot_file:
+                json.dump(snapshot, snapshot_file)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning('Failed to write configdb {} snapshot to {}: {}'.format(resource, path, repr(e)))
+
+    def read_snapshot_file(self, resource):
+        ''' Reads and verifies the snapshot of a resource from CONFIGDB_SNAPSHOT_DIR
+        :return: tuple of the snapshot info and data, or (None, None) if there is no snapshot file
+        '''
+        path = self._get_snapshot_path(resource)
+        if path is None or not os.path.exists(path):
+            return None, None
+        try:
+            with open(path) as snapshot_file:
+                snapshot = json.load(snapshot_file)
+            data = snapshot.pop('results')
+            snapshot['fetched'] = parse(snapshot['fetched'])
+        except (OSError, ValueError, KeyError) as e:
+            raise ConfigDBException('Unreadable configdb snapshot {}: {}'.format(path, repr(e)))
+        if self._get_version(data) != snapshot.get('version'):
+            raise ConfigDBException('Configdb snapshot {} does not match its version'.format(path))
+        return snapshot, data
+
+    def _load_snapshot_file(self, resource):
+        ''' Seeds the shared cache and this process with the snapshot on disk, so a cold worker can answer
+            straight away and refresh from configdb in the background. Only tried once per process.
+        '''
+        if resource in self._snapshot_files_loaded:
+            return None, None
+        self._snapshot_files_loaded.add(resource)
+        try:
+            info, data = self.read_snapshot_file(resource)
+        except ConfigDBException as e:
+            logger.warning(repr(e))
+            return None, None
+        if info is not None:
+            get_snapshot_cache().set('configdb.{}.{}'.format(resource, info['version']), data, None)
+            get_snapshot_cache().set('configdb.{}.info'.format(resource), info, None)
+            self._snapshots[resource] = (info['version'], data)
+        return info, data
+
+    @staticmethod
+    def _get_snapshot_info(resource):
+        return get_snapshot_cache().get('configdb.{}.info'.format(resource))
+
+    def _refresh_configdb_data(self, resource, conditional=False):
+        ''' Fetches a resource from configdb and stores it in the shared cache as the last known good snapshot,
+            keyed by a hash of its content. A small info entry holds that version, the fetch time and the validators
+            for the next conditional fetch. Neither entry expires, so the snapshot is kept until a newer one
+            replaces it, and the payload is only rewritten when its content actually changes. New content is also
+            written to CONFIGDB_SNAPSHOT_DIR when that is set, and configdb_changed is sent when it replaces an
+            earlier snapshot.
+        '''
+        previous_info = self._get_snapshot_info(resource)
+        info = previous_info if conditional else None
+        if info is not None and get_snapshot_cache().get('configdb.{}.{}'.format(resource, info['version'])) is None:
+            # a 304 cannot restore a payload that was evicted from the cache
+            info = None
+        data, headers = self._fetch_configdb_data(resource, info)
+        new_info = {
+            'version': self._get_version(data) if data is not None else info['version'],
+            'fetched': timezone.now(),
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+        }
+        if data is None:
+            # a 304 need not repeat the validators
+            new_info['etag'] = new_info['etag'] or info['etag']
+            new_info['last_modified'] = new_info['last_modified'] or info['last_modified']
+        version = new_info['version']
+        if data is not None and (info is None or version != info['version']):
+            get_snapshot_cache().set('configdb.{}.{}'.format(resource, version), data, None)
+            if info is not None:
+                get_snapshot_cache().delete('configdb.{}.{}'.format(resource, info['version']))
+            self._snapshots[resource] = (version, data)
+            self._write_snapshot_file(resource, new_info, data)
+        get_snapshot_cache().set('configdb.{}.info'.format(resource), new_info, None)
+        if previous_info is not None and version != previous_info['version']:
+            configdb_changed.send(sender=self.__class__, resource=resource, version=version)
+        return data
+
+    def refresh_snapshot(self, resource):
+        ''' Synchronously fetches a resource from configdb, replacing the shared and on-disk snapshots
+        :return: the version of the fetched snapshot
+        '''
+        return self._get_version(self._refresh_configdb_data(resource))
+
+    def _background_refresh(self, resource):
+        try:
+            self._refresh_configdb_data(resource, conditional=True)
+        except ConfigDBException as e:
+            logger.warning('Failed to refresh configdb {}, using the last known value: {}'.format(resource, repr(e)))
+        finally:
+            get_snapshot_cache().delete('configdb.{}.refresh_lock'.format(resource))
+
+    def _revalidate(self, resource, info=None):
+        ''' Starts a background refresh of the resource if its snapshot is older than CONFIGDB_CACHE_TIMEOUT, or
+            whenever no snapshot info is given. Only the worker that acquires the shared refresh lock starts one,
+            everyone else keeps using the current snapshot.
+        '''
+        if info is not None and timezone.now() - info['fetched'] < timedelta(seconds=CONFIGDB_CACHE_TIMEOUT):
+            return
+        if get_snapshot_cache().add('configdb.{}.refresh_lock'.format(resource), True, CONFIGDB_REFRESH_LOCK_TIMEOUT):
+            threading.Thread(target=self._background_refresh, args=(resource,), daemon=True).start()
+
     def _get_configdb_data(self, resource):
-        ''' Gets all the data from configdb (the sites structure with everything in it)
+        ''' Gets all the data from configdb (the sites structure with everything in it). The last known good
+            snapshot is served while it is refreshed in the background, so configdb is only waited on when there
+            is no snapshot at all, neither cached nor on disk. Each process keeps its own parsed copy and only
+            reloads it from the shared cache when the snapshot version changes.
         :return: list of dictionaries of site data
         '''
+        info = self._get_snapshot_info(resource)
+        if info is None:
+            info, data = self._load_snapshot_file(resource)
+            if info is None:
+                return self._fetch_missing_snapshot(resource)
+            self._revalidate(resource)
+            return data
+
+        data = self._get_cached_snapshot(resource, info)
+        if data is None:
+            return self._fetch_missing_snapshot(resource)
+
+        self._revalidate(resource, info)
+        return data
 
-        data = caches['locmem'].get(resource)
-        if not data:
-            try:
-                r = requests.get(settings.CONFIGDB_URL + '/{}/'.format(resource))
-                r.raise_for_status()
-            except (requests.exceptions.RequestException, requests.exceptions.HTTPError) as e:
-                msg = "{}: {}".format(e.__class__.__name__, CONFIGDB_ERROR_MSG)
-                raise ConfigDBException(msg)
-            try:
-                data = r.json()['results']
-            except KeyError:
-                raise ConfigDBException(CONFIGDB_ERROR_MSG)
-            # cache the results for 15 minutes
-            caches['locmem'].set(resource, data, 900)
-
+    def _get_cached_snapshot(self, resource, info):
+        ''' Returns the data of the snapshot version in info, reloading it from the cache only when this process does
+            not already hold that version
+        '''
+        version, data = self._snapshots.get(resource, (None, None))
+        if version != info['version']:
+            data = get_snapshot_cache().get('configdb.{}.{}'.format(resource, info['version']))
+            if data is not None:
+                self._snapshots[resource] = (info['version'], data)
         return data
 
+    def _fetch_missing_snapshot(self, resource):
+        ''' Fetches a resource that has no snapshot yet. Only the worker holding the refresh lock fetches it, the
+            others wait up to CONFIGDB_TIMEOUT for its snapshot and only fetch it themselves if none appears.
+        '''
+        lock_key = 'configdb.{}.refresh_lock'.format(resource)
+        if get_snapshot_cache().add(lock_key, True, CONFIGDB_REFRESH_LOCK_TIMEOUT):
+            try:
+                return self._refresh_configdb_data(resource)
+            finally:
+                get_snapshot_cache().delete(lock_key)
+        deadline = time.monotonic() + settings.CONFIGDB_TIMEOUT
+        while time.monotonic() < deadline:
+            time.sleep(CONFIGDB_LOCK_POLL_INTERVAL)
+            info = self._get_snapshot_info(resource)
+            data = self._get_cached_snapshot(resource, info) if info is not None else None
+            if data is not None:
+                return data
+        return self._refresh_configdb_data(resource)
+
+    def get_snapshot_age(self, resource='sites'):
+        ''' Returns how old the cached snapshot of the resource is as a timedelta, or None if there is none
+        '''
+        info = self._get_snapshot_info(resource)
+        if not info:
+            return None
+        return timezone.now() - info['fetched']
+
+    def _get_index(self):
+        ''' Returns the ConfigDBIndex built from the current site data. The index is kept in process and rebuilt
+            only when the site data changes. A process holds a single parsed copy of each snapshot version, so
+            comparing the site data by identity is enough to notice a new version.
+        '''
+        site_data = self.get_site_data()
+        if self._index is None or site_data is not self._index_site_data:
+            self._index = ConfigDBIndex(site_data, version=self._snapshots.get('sites', (None, None))[0])
+            self._index_site_data = site_data
+        return self._index
+
     def get_site_data(self):
         return self._get_configdb_data('sites')
 
@@ -61,77 +465,54 @@ class ConfigDB(object):
         return site_details
 
     def get_telescopes_with_instrument_type_and_location(self, instrument_type='', site_code='',
-                                                    observatory_code='', telescope_code=''):
-        site_data = self.get_site_data()
+                                                         observatory_code='', telescope_code=''):
+        index = self._get_index()
         telescope_details = {}
-        for site in site_data:
-            if not site_code or site_code == site['code']:
-                for enclosure in site['enclosure_set']:
-                    if not observatory_code or observatory_code == enclosure['code']:
-                        for telescope in enclosure['telescope_set']:
-                            if not telescope_code or telescope_code == telescope['code']:
-                                code = '.'.join([telescope['code'], enclosure['code'], site['code']])
-                                for instrument in telescope['instrument_set']:
-                                    if instrument['state'] == 'SCHEDULABLE':
-                                        camera_type = instrument['science_camera']['camera_type']['code']
-                                        if not instrument_type or instrument_type.upper() == camera_type.upper():
-                                            if code not in telescope_details:
-                                                telescope_details[code] = {
-                                                    'latitude': telescope['lat'],
-                                                    'longitude': telescope['long'],
-                                                    'horizon': telescope['horizon'],
-                                                    'altitude': site['elevation'],
-                                                    'ha_limit_pos': telescope['ha_limit_pos'],
-                                                    'ha_limit_neg': telescope['ha_limit_neg']
-                                                }
+        for telescope_key, details in index.telescope_details.items():
+            if site_code and site_code != telescope_key.site:
+                continue
+            if observatory_code and observatory_code != telescope_key.observatory:
+                continue
+            if telescope_code and telescope_code != telescope_key.telescope:
+                continue
+            schedulable_types = index.schedulable_instrument_types_by_telescope.get(telescope_key, [])
+            if schedulable_types and (not instrument_type or instrument_type.upper() in schedulable_types):
+                code = '.'.join([telescope_key.telescope, telescope_key.observatory, telescope_key.site])
+                telescope_details[code] = details
 
         return telescope_details
 
     def get_instruments(self, only_schedulable=False):
-        site_data = self.get_site_data()
-        instruments = []
-        for site in site_data:
-            for enclosure in site['enclosure_set']:
-                for telescope in enclosure['telescope_set']:
-                    for instrument in telescope['instrument_set']:
-                        if only_schedulable and instrument['state'] != 'SCHEDULABLE':
-                            pass
-                        else:
-                            telescope_key = TelescopeKey(
-                                site=site['code'],
-                                observatory=enclosure['code'],
-                                telescope=telescope['code']
-                            )
-                            instrument['telescope_key'] = telescope_key
-                            instruments.append(instrument)
-
-        return instruments
+        '''
+            Function returns the instruments in configdb as Instrument records, which carry their TelescopeKey
+        :return: list of Instruments
+        '''
+        index = self._get_index()
+        if only_schedulable:
+            return list(index.schedulable_instruments)
+        return list(index.instruments)
 
     def get_instrument_types_per_telescope(self, only_schedulable=False):
         '''
             Function uses the configdb to get a set of available instrument types per telescope
         :return: set of available instrument types per TelescopeKey
         '''
-        telescope_instrument_types = {}
-        for instrument in self.get_instruments(only_schedulable=only_schedulable):
-            if instrument['telescope_key'] not in telescope_instrument_types:
-                telescope_instrument_types[instrument['telescope_key']] = []
-            instrument_type = instrument['science_camera']['camera_type']['code'].upper()
-            if instrument_type not in telescope_instrument_types[instrument['telescope_key']]:
-                telescope_instrument_types[instrument['telescope_key']].append(instrument_type)
-
-        return telescope_instrument_types
+        index = self._get_index()
+        if only_schedulable:
+            instrument_types_by_telescope = index.schedulable_instrument_types_by_telescope
+        else:
+            instrument_types_by_telescope = index.instrument_types_by_telescope
+        return {tk: list(instrument_types) for tk, instrument_types in instrument_types_by_telescope.items()}
 
     def get_telescopes_per_instrument_type(self, instrument_type, only_schedulable=False):
         '''
         Function returns a set of telescope keys that have an instrument of instrument_type
         associated with them
         '''
-        instrument_telescopes = set()
-        for instrument in self.get_instruments(only_schedulable=only_schedulable):
-            if instrument['science_camera']['camera_type']['code'].upper() == instrument_type:
-                instrument_telescopes.add(instrument['telescope_key'])
-        return instrument_telescopes
+        index = self._get_index()
+        if only_schedulable:
+            return set(index.schedulable_telescopes_by_instrument_type.get(instrument_type, set()))
+        return set(index.telescopes_by_instrument_type.get(instrument_type, set()))
 
     def get_filters(self, instrument_type):
         '''
@@ -139,13 +520,7 @@ class ConfigDB(object):
         :param instrument_type:
         :return: returns the available set of filters for an instrument_type
         '''
-        available_filters = set()
-        for instrument in self.get_instruments(only_schedulable=True):
-            if instrument_type.upper() == instrument['science_camera']['camera_type']['code'].upper():
-                for camera_filter in instrument['science_camera']['filters'].split(','):
-                    available_filters.add(camera_filter.lower())
-
-        return available_filters
+        return set(self._get_index().filters_by_instrument_type.get(instrument_type.upper(), set()))
 
     def get_filter_map(self):
         filter_map = {}
@@ -163,14 +538,10 @@ class ConfigDB(object):
         :param instrument_type:
         :return: returns the available set of binnings for an instrument_type
         '''
-        available_binnings = set()
-        for instrument in self.get_instruments():
-            if instrument_type.upper() == instrument['science_camera']['camera_type']['code'].upper():
-                for mode in instrument['science_camera']['camera_type']['mode_set']:
-                    available_binnings.add(mode['binning'])
-                # Once the instrument type is found, we  have the binnings and are done
-                break
-        return available_binnings
+        camera_type = self._get_index().camera_types.get(instrument_type.upper())
+        if camera_type is None:
+            return set()
+        return set(camera_type.binnings)
 
     def get_default_binning(self, instrument_type):
         '''
@@ -178,16 +549,16 @@ class ConfigDB(object):
         :param instrument_type:
         :return: binning default
         '''
-        for instrument in self.get_instruments():
-            if instrument_type.upper() == instrument['science_camera']['camera_type']['code'].upper():
-                return instrument['science_camera']['camera_type']['default_mode']['binning']
-        return None
+        camera_type = self._get_index().camera_types.get(instrument_type.upper())
+        if camera_type is None:
+            return None
+        return camera_type.default_binning
 
     def get_instrument_name(self, instrument_type):
-        for instrument in self.get_instruments():
-            if instrument_type.upper() == instrument['science_camera']['camera_type']['code'].upper():
-                return instrument['science_camera']['camera_type']['name']
-        return instrument_type
+        camera_type = self._get_index().camera_types.get(instrument_type.upper())
+        if camera_type is None:
+            return instrument_type
+        return camera_type.name
 
     def get_active_instrument_types(self, location):
         '''
@@ -195,41 +566,21 @@ class ConfigDB(object):
             Location should be a dictionary of the location, with class, site, observatory, and telescope fields
         :return: Set of available instrument_types (i.e. 1M0-SCICAM-SBIG, etc.)
         '''
-        instrument_types = set()
-        for instrument in self.get_instruments(only_schedulable=True):
-            split_string = instrument['__str__'].lower().split('.')
-            if (location.get('site', '').lower() in split_string[0]
-                    and location.get('observatory', '').lower() in split_string[1]
-                    and location.get('telescope_class', '').lower() in split_string[2]
-                    and location.get('telescope', '').lower() in split_string[2]):
-                instrument_types.add(instrument['science_camera']['camera_type']['code'].upper())
-        return instrument_types
+        return set(self._get_index().get_active_instrument_types(location))
+
+    def get_overhead_tables(self):
+        '''
+            Function returns the precomputed overhead tables of the current snapshot. Use these when computing many
+            durations, to avoid looking up the snapshot for every molecule.
+        :return: OverheadTables
+        '''
+        return self._get_index().overhead_tables
 
     def get_exposure_overhead(self, instrument_type, binning):
-        # using the instrument type, build an instrument with the correct configdb parameters
-        for instrument in self.get_instruments():
-            camera_type = instrument['science_camera']['camera_type']
-            if camera_type['code'].upper() == instrument_type.upper():
-                # get the binnings and put them into a dictionary
-                for mode in camera_type['mode_set']:
-                    if mode['binning'] == binning:
-                        return mode['readout'] + camera_type['fixed_overhead_per_exposure']
-                # if the binning is not found, return the default binning (Added to support legacy 2x2 Sinistro obs)
-                return camera_type['default_mode']['readout'] + camera_type['fixed_overhead_per_exposure']
-
-        raise ConfigDBException("Instrument type {} not found in configdb.".format(instrument_type))
+        return self.get_overhead_tables().get_exposure_overhead(instrument_type, binning)
 
     def get_request_overheads(self, instrument_type):
-        for instrument in self.get_instruments():
-            camera_type = instrument['science_camera']['camera_type']
-            if camera_type['code'].upper() == instrument_type.upper():
-                return {'config_change_time': camera_type['config_change_time'],
-                        'acquire_processing_time': camera_type['acquire_processing_time'],
-                        'acquire_exposure_time': camera_type['acquire_exposure_time'],
-                        'front_padding': camera_type['front_padding'],
-                        'filter_change_time': camera_type['filter_change_time']}
-
-        raise ConfigDBException("Instrument type {} not found in configdb.".format(instrument_type))
+        return dict(self.get_overhead_tables().get_request_overheads(instrument_type))
 
     @staticmethod
     def is_spectrograph(instrument_type):
@@ -4,9 +4,10 @@ from django.utils.translation import ugettext as _
 from django.conf import settings
 from django.utils import timezone
 import logging
-from time_intervals.intervals import Intervals
 from datetime import datetime
 
+from valhalla.common.intervals import IntervalSet
+
 logger = logging.getLogger(__name__)
 
 DOWNTIMEDB_ERROR_MSG = _(("DowntimeDB connection is currently down, cannot update downtime information. "
@@ -44,11 +45,10 @@ class DowntimeDB(object):
                 downtime_intervals[resource] = []
             start = datetime.strptime(interval['start'], DOWNTIME_DATE_FORMAT).replace(tzinfo=timezone.utc)
             end = datetime.strptime(interval['end'], DOWNTIME_DATE_FORMAT).replace(tzinfo=timezone.utc)
-            downtime_intervals[resource].append({'type': 'start', 'time': start})
-            downtime_intervals[resource].append({'type': 'end', 'time': end})
+            downtime_intervals[resource].append((start, end))
 
         for resource in downtime_intervals:
-            downtime_intervals[resource] = Intervals(downtime_intervals[resource])
+            downtime_intervals[resource] = IntervalSet.from_tuples(downtime_intervals[resource])
 
         return downtime_intervals
 
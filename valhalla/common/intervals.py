@@ -0,0 +1,102 @@
+from datetime import datetime, timedelta
+from django.utils import timezone
+import numpy as np
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+MIN_TIME = np.iinfo(np.int64).min
+MAX_TIME = np.iinfo(np.int64).max
+
+
+def to_microseconds(time):
+    return (time - EPOCH) // MICROSECOND
+
+
+def from_microseconds(microseconds):
+    return EPOCH + timedelta(microseconds=microseconds)
+
+
+class IntervalSet(object):
+    ''' A set of time intervals, held as sorted numpy arrays of the starts and ends of its disjoint intervals in
+        microseconds since the epoch. Set operations are a single sweep over the edges of the intervals involved.
+    '''
+    __slots__ = ('starts', 'ends')
+
+    def __init__(self, starts=(), ends=()):
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+
+    @classmethod
+    def from_tuples(cls, intervals):
+        ''' Builds an IntervalSet from (start, end) datetime tuples in any order, merging those that overlap or touch
+        '''
+        starts = np.array([to_microseconds(start) for start, _ in intervals], dtype=np.int64)
+        ends = np.array([to_microseconds(end) for _, end in intervals], dtype=np.int64)
+        non_empty = starts < ends
+        return cls._sweep([cls(starts[non_empty], ends[non_empty])], 1)
+
+    def to_tuples(self):
+        return [(from_microseconds(start), from_microseconds(end))
+                for start, end in zip(self.starts.tolist(), self.ends.tolist())]
+
+    @staticmethod
+    def _sweep(interval_sets, min_coverage):
+        ''' Returns the IntervalSet of the times covered by at least min_coverage of the interval_sets. Starts sort
+            before ends at the same time, so touching intervals join in a union and give nothing in an intersection.
+        '''
+        edges = np.concatenate([s.starts for s in interval_sets] + [s.ends for s in interval_sets])
+        if not len(edges):
+            return IntervalSet()
+        num_starts = sum(len(s.starts) for s in interval_sets)
+        steps = np.concatenate([np.ones(num_starts, dtype=np.int64), -np.ones(num_starts, dtype=np.int64)])
+        # the edges are a few sorted runs, which the stable sort merges in linear time
+        order = np.argsort(edges, kind='stable')
+        edges = edges[order]
+        covered = np.cumsum(steps[order]) >= min_coverage
+        was_covered = np.concatenate([[False], covered[:-1]])
+        starts = edges[covered & ~was_covered]
+        ends = edges[was_covered & ~covered]
+        non_empty = starts < ends
+        return IntervalSet(starts[non_empty], ends[non_empty])
+
+    def union(self, others):
+        return self._sweep([self] + list(others), 1)
+
+    def intersect(self, other):
+        return self._sweep([self, other], 2)
+
+    def subtract(self, other):
+        complement = IntervalSet(np.concatenate([[MIN_TIME], other.ends]), np.concatenate([other.starts, [MAX_TIME]]))
+        return self.intersect(complement)
+
+    def clip(self, start, end):
+        ''' Returns the intervals that overlap start to end, clipped to them. Found by bisection, so it does not
+            depend on the size of the set.
+        '''
+        start, end = to_microseconds(start), to_microseconds(end)
+        first = np.searchsorted(self.ends, start, side='right')
+        last = np.searchsorted(self.starts, end, side='left')
+        starts = np.maximum(self.starts[first:last], start)
+        ends = np.minimum(self.ends[first:last], end)
+        non_empty = starts < ends
+        return IntervalSet(starts[non_empty], ends[non_empty])
+
+    def contains(self, start, end):
+        ''' Returns True if start to end lies within a single interval of the set
+        '''
+        start, end = to_microseconds(start), to_microseconds(end)
+        index = np.searchsorted(self.ends, start, side='left')
+        return bool(index < len(self.ends) and self.starts[index] <= start and end <= self.ends[index])
+
+    def is_empty(self):
+        return len(self.starts) == 0
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __eq__(self, other):
+        return (isinstance(other, IntervalSet) and np.array_equal(self.starts, other.starts) and
+                np.array_equal(self.ends, other.ends))
+
+    def __repr__(self):
+        return 'IntervalSet({})'.format(self.to_tuples())
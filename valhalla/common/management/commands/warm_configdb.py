@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+
+from valhalla.common.configdb import configdb, ConfigDBIndex, ConfigDBException, CONFIGDB_RESOURCES
+
+
+class Command(BaseCommand):
+    help = 'Fetches the configdb snapshot into the shared cache and CONFIGDB_SNAPSHOT_DIR, then verifies it'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify-only', action='store_true',
+                            help='Only verify the snapshot already in CONFIGDB_SNAPSHOT_DIR, do not contact configdb')
+
+    def handle(self, *args, **options):
+        if options['verify_only'] and not settings.CONFIGDB_SNAPSHOT_DIR:
+            raise CommandError('CONFIGDB_SNAPSHOT_DIR is not set, there is no snapshot to verify')
+
+        for resource in CONFIGDB_RESOURCES:
+            try:
+                if not options['verify_only']:
+                    version = configdb.refresh_snapshot(resource)
+                    self.stdout.write('Fetched configdb {} version {}'.format(resource, version))
+                if settings.CONFIGDB_SNAPSHOT_DIR:
+                    info, data = configdb.read_snapshot_file(resource)
+                    if info is None:
+                        raise ConfigDBException('No snapshot file for {}'.format(resource))
+                    if resource == 'sites' and not ConfigDBIndex(data).schedulable_instruments:
+                        raise ConfigDBException('Snapshot of sites has no schedulable instruments')
+                    self.stdout.write('Verified configdb {} snapshot version {} fetched at {}'.format(
+                        resource, info['version'], info['fetched']
+                    ))
+            except ConfigDBException as e:
+                raise CommandError(str(e))
@@ -0,0 +1,18 @@
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+import requests
+
+POND_RETRIES = 3
+
+
+@lru_cache()
+def get_pond_session():
+    ''' A session shared by the calls to the pond, which keeps connections alive between them and retries failed
+        connections
+    '''
+    session = requests.Session()
+    adapter = HTTPAdapter(max_retries=Retry(total=POND_RETRIES, read=False, backoff_factor=0.2))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
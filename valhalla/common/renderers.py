@@ -0,0 +1,42 @@
+from rest_framework.renderers import BaseRenderer
+from rest_framework.settings import api_settings
+from datetime import datetime, date, timedelta
+from decimal import Decimal
+import msgpack
+
+
+def encode_msgpack_value(value):
+    ''' Encodes the values msgpack has no type for. Datetimes become seconds since the epoch, the rest is encoded the
+        way the rest framework json encoder does
+    '''
+    if isinstance(value, datetime):
+        return value.timestamp()
+    elif isinstance(value, date):
+        return value.isoformat()
+    elif isinstance(value, timedelta):
+        return value.total_seconds()
+    elif isinstance(value, Decimal):
+        return float(value)
+    raise TypeError('Cannot encode {} as msgpack'.format(type(value).__name__))
+
+
+def pack(data):
+    return msgpack.packb(data, default=encode_msgpack_value, use_bin_type=True)
+
+
+class MsgPackRenderer(BaseRenderer):
+    ''' Renders data as msgpack, a compact binary alternative to json for the scheduler
+    '''
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return pack(data)
+
+
+# The renderers of the endpoints the scheduler reads, which it can ask for as msgpack
+SCHEDULER_RENDERER_CLASSES = tuple(api_settings.DEFAULT_RENDERER_CLASSES) + (MsgPackRenderer,)
@@ -1,18 +1,43 @@
-from math import cos, radians
+from math import cos, radians, ceil, log, log2
 from datetime import timedelta
-from time_intervals.intervals import Intervals
 from rise_set.astrometry import make_ra_dec_target, make_satellite_target, make_minor_planet_target
 from rise_set.astrometry import make_comet_target, make_major_planet_target
+from rise_set.astrometry import (gregorian_to_ut_mjd, ut_mjd_to_tdb, mean_to_apparent, apparent_planet_pos,
+                                 apply_refraction_to_horizon)
+from rise_set.visibility import set_airmass_limit
+from pyslalib import slalib as sla
+import numpy as np
 from rise_set.angle import Angle
 from rise_set.rates import ProperMotion
 from rise_set.visibility import Visibility
 from rise_set.moving_objects import MovingViolation
 from django.core.cache import cache
+from django.conf import settings
+import multiprocessing
+import threading
+import time
+from functools import lru_cache
+import hashlib
+import logging
+import json
+import django
 
 from valhalla.common.configdb import configdb
 from valhalla.common.downtimedb import DowntimeDB
+from valhalla.common.intervals import IntervalSet
+
+logger = logging.getLogger(__name__)
 
 HOURS_PER_DEGREES = 15.0
+SIDEREAL_GRID_STEP = 300.0         # seconds between the times the vectorized engine evaluates the constraints at
+SIDEREAL_PRECISION = 1.0           # seconds to which the vectorized engine refines the interval boundaries
+EPHEMERIS_STEP = 3600.0            # seconds between the sun and moon positions that are interpolated in between
+MOON_DISTANCE_CHUNK = 1800.0       # seconds, the chunks rise_set checks the moon distance in
+TWILIGHT_ALTITUDE = -12.0          # degrees, nautical twilight
+NIGHT_TABLE_CACHE_TIMEOUT = 86400 * 30
+NIGHT_TABLE_LOCAL_CACHE_SIZE = 64   # night tables kept in each process, each is a semester of one site
+# target fields that do not change where or when a target is visible
+RISE_SET_IGNORED_TARGET_FIELDS = ('id', 'request', 'name', 'acquire_mode', 'rot_mode', 'rot_angle', 'vmag', 'radvel')
 
 
 def get_largest_interval(intervals):
@@ -23,42 +48,388 @@ def get_largest_interval(intervals):
     return largest_interval
 
 
-def get_rise_set_intervals_by_site(request_dict):
-    ''' Computes or Retrieves from cache a dictionary of rise_set intervals by site for the request
+class RiseSetTimeout(Exception):
+    pass
+
+
+def running_under_gevent():
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('threading')
+
+
+class RiseSetPool(object):
+    ''' Bounded pool that rise_set computations are handed to, so that they run in parallel without holding up the
+        rest of the worker. Outside of gevent it is a pool of processes. In gevent workers, whose hub the result
+        handler threads of a process pool would block, it is a pool of native threads that the greenlet waits on
+        cooperatively, so the other greenlets keep being served while visibility is computed. Callers block until the
+        results are in, or until RISE_SET_TIMEOUT passes and RiseSetTimeout is raised: the process pool is terminated
+        to cancel its work, while threads cannot be stopped and are left to finish on their own. The pool is opt in
+        with RISE_SET_POOL_SIZE, otherwise everything is run in process. Each run logs the number of computations
+        already queued when it started and how long it waited.
+    '''
+    def __init__(self):
+        self._pool = None
+        self._pool_size = 0
+        self._threadpool = None
+        self._lock = threading.Lock()
+        self.queue_depth = 0
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None or self._pool_size != settings.RISE_SET_POOL_SIZE:
+                if self._pool is not None:
+                    self._pool.terminate()
+                self._pool = multiprocessing.get_context('spawn').Pool(
+                    settings.RISE_SET_POOL_SIZE, initializer=django.setup
+                )
+                self._pool_size = settings.RISE_SET_POOL_SIZE
+            return self._pool
+
+    def _get_threadpool(self):
+        from gevent.threadpool import ThreadPool
+        with self._lock:
+            if self._threadpool is None:
+                self._threadpool = ThreadPool(settings.RISE_SET_POOL_SIZE)
+            elif self._threadpool.maxsize != settings.RISE_SET_POOL_SIZE:
+                self._threadpool.maxsize = settings.RISE_SET_POOL_SIZE
+            return self._threadpool
+
+    def _timed_out(self):
+        return RiseSetTimeout('Rise set computations did not finish within {} seconds'.format(
+            settings.RISE_SET_TIMEOUT
+        ))
+
+    def _run_in_processes(self, func, args_list):
+        pool = self._get_pool()
+        async_results = [pool.apply_async(func, args) for args in args_list]
+        results = []
+        deadline = time.monotonic() + settings.RISE_SET_TIMEOUT
+        for async_result in async_results:
+            async_result.wait(max(0, deadline - time.monotonic()))
+            if not async_result.ready():
+                logger.warning('Rise set computations timed out in the process pool, cancelling them')
+                self.terminate()
+                raise self._timed_out()
+            results.append(async_result.get())
+        return results
+
+    def _run_in_threads(self, func, args_list):
+        from gevent import Timeout
+        threadpool = self._get_threadpool()
+        async_results = [threadpool.spawn(func, *args) for args in args_list]
+        results = []
+        deadline = time.monotonic() + settings.RISE_SET_TIMEOUT
+        for async_result in async_results:
+            try:
+                results.append(async_result.get(timeout=max(0, deadline - time.monotonic())))
+            except Timeout:
+                logger.warning('Rise set computations timed out in the thread pool, abandoning them')
+                raise self._timed_out()
+        return results
+
+    def run(self, func, args_list):
+        ''' Runs func for each tuple of arguments in args_list
+        :return: list of the results in the order of args_list
+        '''
+        if not settings.RISE_SET_POOL_SIZE or not args_list:
+            return [func(*args) for args in args_list]
+
+        under_gevent = running_under_gevent()
+        with self._lock:
+            queue_depth = self.queue_depth
+            self.queue_depth += len(args_list)
+        started = time.monotonic()
+        try:
+            if under_gevent:
+                return self._run_in_threads(func, args_list)
+            return self._run_in_processes(func, args_list)
+        finally:
+            with self._lock:
+                self.queue_depth -= len(args_list)
+            logger.info('Ran rise set computations', extra={'tags': {
+                'executor': 'threads' if under_gevent else 'processes',
+                'computations': len(args_list),
+                'queue_depth': queue_depth,
+                'wait_seconds': round(time.monotonic() - started, 3),
+            }})
+
+    def terminate(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool = None
+
+
+rise_set_pool = RiseSetPool()
+
+
+def get_rise_set_cache_key(request_dict, site_detail):
+    ''' Returns a cache key that is a stable hash of everything the rise_set intervals of a request at a site depend
+        on: the target, the constraints, the windows and the site itself. Identical computations share the key no
+        matter which request, saved or not, they come from.
+    '''
+    target = {k: v for k, v in request_dict['target'].items() if k not in RISE_SET_IGNORED_TARGET_FIELDS}
+    rise_set_inputs = {
+        'target': target,
+        'max_airmass': request_dict['constraints']['max_airmass'],
+        'min_lunar_distance': request_dict['constraints']['min_lunar_distance'],
+        'windows': [(window['start'], window['end']) for window in request_dict['windows']],
+        'site': site_detail
+    }
+    rise_set_hash = hashlib.sha1(json.dumps(rise_set_inputs, sort_keys=True, default=str).encode()).hexdigest()
+    return 'rise_set.{}'.format(rise_set_hash)
+
+
+def get_rise_set_intervals_by_site(request_dict, sites=None):
+    ''' Computes or Retrieves from cache a dictionary of rise_set intervals by site for the request, for all sites or
+        only the given ones. The sites and windows that are not cached are computed together in the rise_set pool.
     '''
     site_details = configdb.get_sites_with_instrument_type_and_location()
+    if sites is not None:
+        site_details = {site: details for site, details in site_details.items() if site in sites}
+    cache_keys = {site: get_rise_set_cache_key(request_dict, site_details[site]) for site in site_details}
     intervals_by_site = {}
     for site in site_details:
-        intervals_by_site[site] = None
-        if request_dict.get('id'):
-            cache_key = '{}.{}.rsi'.format(request_dict['id'], site)
-            intervals_by_site[site] = cache.get(cache_key, None)
-
-        if intervals_by_site[site] is None:
-            # There is no cached rise_set intervals for this request and site, so recalculate it now
-            intervals_by_site[site] = []
-            rise_set_site = get_rise_set_site(site_details[site])
-            rise_set_target = get_rise_set_target(request_dict['target'])
-            for window in request_dict['windows']:
-                visibility = get_rise_set_visibility(rise_set_site, window['start'], window['end'], site_details[site])
-                try:
-                    intervals_by_site[site].extend(
-                        visibility.get_observable_intervals(
-                            rise_set_target,
-                            airmass=request_dict['constraints']['max_airmass'],
-                            moon_distance=Angle(degrees=request_dict['constraints']['min_lunar_distance'])
-                        )
-                    )
-                except MovingViolation:
-                    pass
-            if request_dict.get('id'):
-                cache.set(cache_key, intervals_by_site[site], 86400 * 30) # cache for 30 days
+        intervals_by_site[site] = cache.get(cache_keys[site], None)
+
+    uncached_sites = [site for site in site_details if intervals_by_site[site] is None]
+    tasks = []
+    for site in uncached_sites:
+        # There is no cached rise_set intervals for this request and site, so recalculate it now
+        for window in request_dict['windows']:
+            tasks.append((request_dict['target'], request_dict['constraints']['max_airmass'],
+                          request_dict['constraints']['min_lunar_distance'], window['start'], window['end'],
+                          site_details[site]))
+    window_intervals = iter(rise_set_pool.run(get_observable_intervals, tasks))
+    for site in uncached_sites:
+        intervals_by_site[site] = []
+        for _ in request_dict['windows']:
+            intervals_by_site[site].extend(next(window_intervals))
+        cache.set(cache_keys[site], intervals_by_site[site], 86400 * 30)  # cache for 30 days
 
     return intervals_by_site
 
 
+def get_observable_intervals(target_dict, max_airmass, min_lunar_distance, start, end, site_detail):
+    ''' Computes the rise_set intervals of a target at a site within a single window
+    '''
+    if settings.RISE_SET_VECTORIZED and target_dict['type'] == 'SIDEREAL':
+        return SiderealVisibility(site_detail, start, end).get_observable_intervals(
+            target_dict, max_airmass, min_lunar_distance
+        )
+    rise_set_site = get_rise_set_site(site_detail)
+    visibility = get_rise_set_visibility(rise_set_site, start, end, site_detail)
+    try:
+        return visibility.get_observable_intervals(
+            get_rise_set_target(target_dict),
+            airmass=max_airmass,
+            moon_distance=Angle(degrees=min_lunar_distance)
+        )
+    except MovingViolation:
+        return []
+
+
+class SiderealVisibility(object):
+    ''' Vectorized version of rise_set.Visibility.get_observable_intervals for a SIDEREAL target at one site within
+        one window. The time grid, sidereal time and the sun and moon positions are computed once, then the
+        constraints are evaluated over the whole grid at once with numpy: sun below nautical twilight, target above the
+        airmass limit or horizon, within the hour angle limits and, in the same 30 minute chunks as rise_set, far
+        enough from the moon. The turning points of each constraint between grid points are found by ternary search
+        and added to the grid, so intervals and gaps shorter than SIDEREAL_GRID_STEP are not missed, and boundaries
+        are then refined by bisection to SIDEREAL_PRECISION.
+    '''
+    def __init__(self, site_detail, start, end):
+        self.start = start
+        self.duration = (end - start).total_seconds()
+        self.latitude = radians(site_detail['latitude'])
+        self.longitude = radians(site_detail['longitude'])
+        self.horizon = site_detail['horizon']
+        self.ha_limit_neg = site_detail['ha_limit_neg']
+        self.ha_limit_pos = site_detail['ha_limit_pos']
+        self.mjd_start = gregorian_to_ut_mjd(start)
+        self.tdb_mid = ut_mjd_to_tdb(self.mjd_start + self.duration / 2 / 86400)
+        self.eqeqx = sla.sla_eqeqx(self.tdb_mid)
+        self.grid = np.linspace(0, self.duration, max(int(ceil(self.duration / SIDEREAL_GRID_STEP)), 1) + 1)
+        self.bisections = max(int(ceil(log2(SIDEREAL_GRID_STEP / SIDEREAL_PRECISION))), 0)
+        # each ternary search step keeps two thirds of the two grid steps around a turning point
+        self.ternary_steps = max(int(ceil(log(2 * SIDEREAL_GRID_STEP / SIDEREAL_PRECISION) / log(1.5))), 0)
+
+        rise_set_site = get_rise_set_site(site_detail)
+        self.ephemeris_times = np.linspace(0, self.duration, max(int(ceil(self.duration / EPHEMERIS_STEP)), 1) + 1)
+        self.sun_ra, self.sun_dec = self._get_ephemeris('sun', rise_set_site)
+        self.moon_ra, self.moon_dec = self._get_ephemeris('moon', rise_set_site)
+        self.dark_intervals = self._get_intervals(self._dark_margin)
+
+    def _get_ephemeris(self, planet, rise_set_site):
+        positions = [apparent_planet_pos(planet, ut_mjd_to_tdb(self.mjd_start + t / 86400), rise_set_site)
+                     for t in self.ephemeris_times]
+        ra = np.unwrap([position[0].in_radians() for position in positions])
+        dec = np.array([position[1].in_radians() for position in positions])
+        return ra, dec
+
+    def _gmst(self, seconds):
+        ''' Greenwich mean sidereal time in radians, the same IAU 1982 expression as sla_gmst
+        '''
+        mjd = self.mjd_start + seconds / 86400
+        tu = (mjd - 51544.5) / 36525
+        gmst = (np.mod(mjd, 1.0) * 2 * np.pi +
+                (24110.54841 + (8640184.812866 + (0.093104 - 6.2e-6 * tu) * tu) * tu) * 7.272205216643039903848712e-5)
+        return np.mod(gmst, 2 * np.pi)
+
+    def _sin_altitude(self, ra, dec, seconds):
+        hour_angle = self._gmst(seconds) + self.eqeqx + self.longitude - ra
+        return np.sin(self.latitude) * np.sin(dec) + np.cos(self.latitude) * np.cos(dec) * np.cos(hour_angle)
+
+    def _dark_margin(self, seconds):
+        sun_ra = np.interp(seconds, self.ephemeris_times, self.sun_ra)
+        sun_dec = np.interp(seconds, self.ephemeris_times, self.sun_dec)
+        return np.sin(np.radians(TWILIGHT_ALTITUDE)) - self._sin_altitude(sun_ra, sun_dec, seconds)
+
+    def _up_margin(self, seconds):
+        return self._sin_altitude(self.target_ra, self.target_dec, seconds) - self.sin_horizon
+
+    def _hour_angle_margin(self, seconds):
+        # rise_set uses the mean RA and sidereal time for the hour angle limits
+        hour_angle = np.degrees(self._gmst(seconds) + self.longitude - self.mean_ra) / HOURS_PER_DEGREES
+        hour_angle = np.mod(hour_angle + 12.0, 24.0) - 12.0
+        return np.minimum(hour_angle - self.ha_limit_neg, self.ha_limit_pos - hour_angle)
+
+    def _get_turning_points(self, margin_function, margins):
+        ''' Finds the times of the local maxima and minima of margin_function between the grid points, given its
+            margins on the grid
+        '''
+        slopes = np.sign(np.diff(margins))
+        turning = np.nonzero(slopes[1:] != slopes[:-1])[0] + 1
+        low = self.grid[turning - 1]
+        high = self.grid[turning + 1]
+        # searching for the maximum of the negated margin finds a minimum
+        sign = np.where(slopes[turning - 1] > 0, 1.0, -1.0)
+        for _ in range(self.ternary_steps):
+            left = low + (high - low) / 3
+            right = high - (high - low) / 3
+            left_is_higher = sign * margin_function(left) > sign * margin_function(right)
+            high = np.where(left_is_higher, right, high)
+            low = np.where(left_is_higher, low, left)
+        return (low + high) / 2
+
+    def _get_intervals(self, margin_function):
+        ''' Finds the intervals in which margin_function is not negative
+        :return: list of (start, end) tuples in seconds from the start of the window
+        '''
+        grid_margins = margin_function(self.grid)
+        turning_points = self._get_turning_points(margin_function, grid_margins)
+        times = np.concatenate([self.grid, turning_points])
+        order = np.argsort(times, kind='mergesort')
+        times = times[order]
+        satisfied = np.concatenate([grid_margins, margin_function(turning_points)])[order] >= 0
+        changes = np.nonzero(satisfied[1:] != satisfied[:-1])[0]
+        low = times[changes]
+        high = times[changes + 1]
+        satisfied_low = satisfied[changes]
+        for _ in range(self.bisections):
+            middle = (low + high) / 2
+            same = (margin_function(middle) >= 0) == satisfied_low
+            low = np.where(same, middle, low)
+            high = np.where(same, high, middle)
+        crossings = (low + high) / 2
+
+        intervals = []
+        start = 0.0 if satisfied[0] else None
+        for crossing, rising in zip(crossings, ~satisfied_low):
+            if rising:
+                start = crossing
+            else:
+                intervals.append((start, crossing))
+        if satisfied[-1]:
+            intervals.append((start, self.duration))
+        return intervals
+
+    def _to_datetimes(self, intervals):
+        return [(self.start + timedelta(seconds=float(start)), self.start + timedelta(seconds=float(end)))
+                for start, end in intervals]
+
+    @staticmethod
+    def _intersect(intervals1, intervals2):
+        ''' Intersects two sorted lists of disjoint (start, end) tuples
+        '''
+        intersection = []
+        i = j = 0
+        while i < len(intervals1) and j < len(intervals2):
+            start = max(intervals1[i][0], intervals2[j][0])
+            end = min(intervals1[i][1], intervals2[j][1])
+            if start < end:
+                intersection.append((start, end))
+            if intervals1[i][1] < intervals2[j][1]:
+                i += 1
+            else:
+                j += 1
+        return intersection
+
+    def _get_moon_distance_intervals(self, up_intervals, min_lunar_distance):
+        ''' Like rise_set, splits each up interval into chunks from its start and keeps the chunks that start far
+            enough from the moon
+        '''
+        chunks = [np.append(np.arange(start, end, MOON_DISTANCE_CHUNK), end) for start, end in up_intervals]
+        chunk_starts = np.concatenate([boundaries[:-1] for boundaries in chunks])
+        moon_ra = np.interp(chunk_starts, self.ephemeris_times, self.moon_ra)
+        moon_dec = np.interp(chunk_starts, self.ephemeris_times, self.moon_dec)
+        ra, dec = self.target_ra, self.target_dec
+        cos_distance = np.sin(dec) * np.sin(moon_dec) + np.cos(dec) * np.cos(moon_dec) * np.cos(ra - moon_ra)
+        far_enough = iter(np.degrees(np.arccos(np.clip(cos_distance, -1.0, 1.0))) >= min_lunar_distance)
+
+        intervals = []
+        for boundaries in chunks:
+            run_start = None
+            for chunk_start, chunk_end in zip(boundaries[:-1], boundaries[1:]):
+                if next(far_enough):
+                    run_start = chunk_start if run_start is None else run_start
+                elif run_start is not None:
+                    intervals.append((run_start, chunk_start))
+                    run_start = None
+            if run_start is not None:
+                intervals.append((run_start, boundaries[-1]))
+        return intervals
+
+    def get_observable_intervals(self, target_dict, max_airmass, min_lunar_distance):
+        ''' Computes the observable intervals of a SIDEREAL target
+        :return: list of (start, end) datetime tuples
+        '''
+        rise_set_target = get_rise_set_target(target_dict)
+        ra, dec = mean_to_apparent(rise_set_target, self.tdb_mid)
+        self.target_ra = ra.in_radians()
+        self.target_dec = dec.in_radians()
+        self.mean_ra = rise_set_target['ra'].in_radians()
+        self.sin_horizon = np.sin(np.radians(
+            apply_refraction_to_horizon(Angle(degrees=set_airmass_limit(max_airmass, self.horizon))).in_degrees()
+        ))
+
+        up_intervals = self._get_intervals(self._up_margin)
+        intervals = self._intersect(self._intersect(self.dark_intervals, up_intervals),
+                                    self._get_intervals(self._hour_angle_margin))
+        if min_lunar_distance > 0.5 and intervals:
+            intervals = self._intersect(intervals, self._get_moon_distance_intervals(up_intervals, min_lunar_distance))
+        return self._to_datetimes(intervals)
+
+
 def get_rise_set_intervals(request_dict, site=''):
-    intervals = []
+    filtered_intervalsets_by_site = get_filtered_intervalsets_by_site(request_dict, site)
+    filtered_intervalset = IntervalSet().union(filtered_intervalsets_by_site.values())
+
+    return filtered_intervalset.to_tuples()
+
+
+def get_filtered_rise_set_intervals_by_site(request_dict, site=''):
+    ''' Returns the rise_set intervals of the request with downtime removed, for each site that has a telescope with
+        the request's instrument type and location. Visibility is computed once for each of those sites and no others.
+    '''
+    filtered_intervalsets_by_site = get_filtered_intervalsets_by_site(request_dict, site)
+    return {site: intervalset.to_tuples() for site, intervalset in filtered_intervalsets_by_site.items()}
+
+
+def get_filtered_intervalsets_by_site(request_dict, site=''):
     site = site if site else request_dict['location'].get('site', '')
     telescope_details = configdb.get_telescopes_with_instrument_type_and_location(
             request_dict['molecules'][0]['instrument_name'],
@@ -67,30 +438,30 @@ def get_rise_set_intervals(request_dict, site=''):
             request_dict['location'].get('telescope', '')
     )
     if not telescope_details:
-        return intervals
+        return {}
 
-    intervals_by_site = get_rise_set_intervals_by_site(request_dict)
+    sites = {telescope.split('.')[2] for telescope in telescope_details}
+    intervals_by_site = get_rise_set_intervals_by_site(request_dict, sites)
     intervalsets_by_telescope = intervals_by_site_to_intervalsets_by_telescope(intervals_by_site, telescope_details.keys())
     filtered_intervalsets_by_telescope = filter_out_downtime_from_intervalsets(intervalsets_by_telescope)
-    filtered_intervalset = Intervals().union(filtered_intervalsets_by_telescope.values())
-    filtered_intervals = filtered_intervalset.toTupleList()
+    filtered_intervalsets_by_site = {}
+    for telescope, intervalset in filtered_intervalsets_by_telescope.items():
+        filtered_intervalsets_by_site.setdefault(telescope.split('.')[2], []).append(intervalset)
 
-    return filtered_intervals
+    return {site: IntervalSet().union(intervalsets) for site, intervalsets in filtered_intervalsets_by_site.items()}
 
 
 def intervals_by_site_to_intervalsets_by_telescope(intervals_by_site, telescopes):
     ''' Takes in a dictionary of rise_set intervals by sites and a dictionary of telescope details for the request.
         Returns a dictionary by telescopes of rise_set intervals for the request
     '''
+    intervalsets_by_site = {}
     intervalsets_by_telescope = {}
     for telescope in telescopes:
-        if telescope not in intervalsets_by_telescope:
-            site = telescope.split('.')[2]
-            datetime_intervals = []
-            for start, end in intervals_by_site[site]:
-                datetime_intervals.append({'type': 'start', 'time': start})
-                datetime_intervals.append({'type': 'end', 'time': end})
-            intervalsets_by_telescope[telescope] = Intervals(datetime_intervals)
+        site = telescope.split('.')[2]
+        if site not in intervalsets_by_site:
+            intervalsets_by_site[site] = IntervalSet.from_tuples(intervals_by_site[site])
+        intervalsets_by_telescope[telescope] = intervalsets_by_site[site]
 
     return intervalsets_by_telescope
 
@@ -187,13 +558,68 @@ def get_rise_set_visibility(rise_set_site, start, end, site_detail):
         )
 
 
-def get_site_rise_set_intervals(start, end, site_code):
+def get_dark_intervals(start, end, site_detail):
+    rise_set_site = get_rise_set_site(site_detail)
+    v = get_rise_set_visibility(rise_set_site, start, end, site_detail)
+
+    return v.get_dark_intervals()
+
+
+def get_night_table_cache_key(site_code, site_detail_json, start, end):
+    night_table_inputs = '{}.{}.{}'.format(site_detail_json, start.isoformat(), end.isoformat())
+    night_table_hash = hashlib.sha1(night_table_inputs.encode()).hexdigest()
+    return 'night_table.{}.{}'.format(site_code, night_table_hash)
+
+
+@lru_cache(maxsize=NIGHT_TABLE_LOCAL_CACHE_SIZE)
+def get_night_table(site_code, site_detail_json, start, end):
+    ''' Returns the night table of the site for a semester: an IntervalSet of its dark intervals from start to end.
+        The most recently used tables are kept in this process, and all of them in the shared cache.
+    :param site_detail_json: the site details as json with sorted keys, so the arguments can be hashed
+    '''
+    cache_key = get_night_table_cache_key(site_code, site_detail_json, start, end)
+    night_table = cache.get(cache_key)
+    if night_table is None:
+        site_detail = json.loads(site_detail_json)
+        night_table = IntervalSet.from_tuples(rise_set_pool.run(get_dark_intervals, [(start, end, site_detail)])[0])
+        cache.set(cache_key, night_table, NIGHT_TABLE_CACHE_TIMEOUT)
+    return night_table
+
+
+def get_site_rise_set_intervals(start, end, site_code, semester_bounds=()):
+    ''' Returns the dark intervals of a site between start and end. The parts covered by semesters are read from the
+        semesters' night tables, anything outside of a semester is computed directly.
+    :param semester_bounds: (start, end) of the semesters that overlap start to end, in time order
+    '''
     site_details = configdb.get_sites_with_instrument_type_and_location(site_code=site_code)
-    if site_code in site_details:
-        site_detail = site_details[site_code]
-        rise_set_site = get_rise_set_site(site_detail)
-        v = get_rise_set_visibility(rise_set_site, start, end, site_detail)
+    if site_code not in site_details:
+        return []
 
-        return v.get_dark_intervals()
+    site_detail_json = json.dumps(site_details[site_code], sort_keys=True)
+    pieces = []
+    uncovered = []
+    cursor = start
+    for semester_start, semester_end in semester_bounds:
+        if semester_start > cursor:
+            uncovered.append((cursor, semester_start, site_details[site_code]))
+            pieces.append(None)
+        piece_end = min(end, semester_end)
+        if piece_end > cursor:
+            night_table = get_night_table(site_code, site_detail_json, semester_start, semester_end)
+            pieces.append(night_table.clip(max(cursor, semester_start), piece_end).to_tuples())
+            cursor = piece_end
+    if cursor < end:
+        uncovered.append((cursor, end, site_details[site_code]))
+        pieces.append(None)
+
+    uncovered_intervals = iter(rise_set_pool.run(get_dark_intervals, uncovered))
+    intervals = []
+    for piece in pieces:
+        for interval in piece if piece is not None else next(uncovered_intervals):
+            # a night that crosses the edge of a piece is split in two, so join it back together
+            if intervals and intervals[-1][1] >= interval[0]:
+                intervals[-1] = (intervals[-1][0], max(intervals[-1][1], interval[1]))
+            else:
+                intervals.append(interval)
 
-    return []
+    return intervals
@@ -12,6 +12,7 @@ from dateutil.parser import parse
 
 from valhalla.common.configdb import configdb, TelescopeKey
 from valhalla.common.rise_set_utils import get_site_rise_set_intervals
+from valhalla.common.intervals import IntervalSet
 
 logger = logging.getLogger(__name__)
 
@@ -203,56 +204,47 @@ class TelescopeStates(object):
 
 def filter_telescope_states_by_intervals(telescope_states, sites_intervals, start, end):
     filtered_states = {}
+    intervalsets_by_site = {}
     for telescope_key, events in telescope_states.items():
         # now loop through the events for the telescope, and tally the time the telescope is available for each 'day'
         if telescope_key.site in sites_intervals:
-            site_intervals = sites_intervals[telescope_key.site]
+            if telescope_key.site not in intervalsets_by_site:
+                intervalsets_by_site[telescope_key.site] = IntervalSet.from_tuples(sites_intervals[telescope_key.site])
+            site_intervalset = intervalsets_by_site[telescope_key.site]
             filtered_events = []
 
             for event in events:
                 event_start = max(event['start'], start)
                 event_end = min(event['end'], end)
-                for interval in site_intervals:
-                    if event_start >= interval[0] and event_end <= interval[1]:
-                        # the event is fully contained to add it and break out
-                        extra_event = deepcopy(event)
-                        extra_event['start'] = event_start
-                        extra_event['end'] = event_end
-                        filtered_events.append(deepcopy(event))
-                    elif event_start < interval[0] and event_end > interval[1]:
-                        # start is before interval and end is after, so it spans the interval
-                        extra_event = deepcopy(event)
-                        extra_event['start'] = interval[0]
-                        extra_event['end'] = interval[1]
-                        filtered_events.append(deepcopy(extra_event))
-                    elif event_start < interval[0] and event_end > interval[0] and event_end <= interval[1]:
-                        # start is before interval and end is in interval, so truncate start
-                        extra_event = deepcopy(event)
-                        extra_event['start'] = interval[0]
-                        extra_event['end'] = event_end
-                        filtered_events.append(deepcopy(extra_event))
-                    elif event_start >= interval[0] and event_start < interval[1] and event_end > interval[1]:
-                        # start is within interval and end is after, so truncate end
+                if site_intervalset.contains(event_start, event_end):
+                    # the event is fully contained so add it as is
+                    filtered_events.append(deepcopy(event))
+                else:
+                    # otherwise add the parts of the event that overlap the intervals, truncated to them
+                    for interval_start, interval_end in site_intervalset.clip(event_start, event_end).to_tuples():
                         extra_event = deepcopy(event)
-                        extra_event['start'] = event_start
-                        extra_event['end'] = interval[1]
-                        filtered_events.append(deepcopy(extra_event))
+                        extra_event['start'] = interval_start
+                        extra_event['end'] = interval_end
+                        filtered_events.append(extra_event)
 
             filtered_states[telescope_key] = filtered_events
 
     return filtered_states
 
 
-def get_telescope_availability_per_day(start, end, telescopes=None, sites=None, instrument_types=None):
+def get_telescope_availability_per_day(start, end, telescopes=None, sites=None, instrument_types=None,
+                                       semester_bounds=()):
+    ''' semester_bounds are the (start, end) of the semesters around start to end, whose night tables to use
+    '''
     telescope_states = TelescopeStates(start, end, telescopes, sites, instrument_types).get()
     # go through each telescopes list of states, grouping it up by observing night at the site
     rise_set_intervals = {}
     for telescope_key, events in telescope_states.items():
         if telescope_key.site not in rise_set_intervals:
             # remove the first and last interval as they may only be partial intervals
-            rise_set_intervals[telescope_key.site] = get_site_rise_set_intervals(start - timedelta(days=1),
-                                                                                 end + timedelta(days=1),
-                                                                                 telescope_key.site)[1:]
+            rise_set_intervals[telescope_key.site] = get_site_rise_set_intervals(
+                start - timedelta(days=1), end + timedelta(days=1), telescope_key.site, semester_bounds
+            )[1:]
     telescope_states = filter_telescope_states_by_intervals(telescope_states, rise_set_intervals, start, end)
     # now just compute a % available each day from the rise_set filtered set of events
     telescope_availability = {}
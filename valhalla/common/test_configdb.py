@@ -0,0 +1,245 @@
+from django.test import TestCase, override_settings
+from django.core.cache import caches
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from unittest.mock import patch
+from datetime import timedelta
+from io import StringIO
+import responses
+import requests
+import tempfile
+import shutil
+import json
+import os
+
+from valhalla.common.configdb import configdb, ConfigDB, ConfigDBException, TelescopeKey, CONFIGDB_CACHE_TIMEOUT
+from valhalla.common.test_helpers import ConfigDBTestMixin
+
+
+class TestConfigDBIndex(ConfigDBTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.doma = TelescopeKey('tst', 'doma', '1m0a')
+        self.domb = TelescopeKey('tst', 'domb', '1m0a')
+
+    def test_instrument_types_per_telescope(self):
+        instrument_types = configdb.get_instrument_types_per_telescope(only_schedulable=True)
+        self.assertEqual(instrument_types[self.doma], ['1M0-SCICAM-SBIG', '2M0-FLOYDS-SCICAM'])
+        self.assertEqual(instrument_types[self.domb], ['1M0-SCICAM-SBIG', '1M0-NRES-SCICAM', '2M0-FLOYDS-SCICAM'])
+
+    def test_telescopes_per_instrument_type(self):
+        self.assertEqual(configdb.get_telescopes_per_instrument_type('1M0-NRES-SCICAM'), {self.domb})
+        self.assertEqual(configdb.get_telescopes_per_instrument_type('1M0-SCICAM-SBIG'), {self.doma, self.domb})
+
+    def test_lookups_are_case_insensitive(self):
+        self.assertEqual(configdb.get_filters('1m0-scicam-sbig'), {'air'})
+        self.assertEqual(configdb.get_binnings('1m0-scicam-sbig'), {1, 2, 3})
+        self.assertEqual(configdb.get_default_binning('1m0-scicam-sbig'), 2)
+
+    def test_exposure_overhead_by_binning(self):
+        self.assertEqual(configdb.get_exposure_overhead('1M0-SCICAM-SBIG', 1), 36.0)
+        self.assertEqual(configdb.get_exposure_overhead('1M0-SCICAM-SBIG', 3), 12.5)
+
+    def test_exposure_overhead_falls_back_to_default_binning(self):
+        self.assertEqual(configdb.get_exposure_overhead('1M0-SCICAM-SBIG', 4), 15.5)
+
+    def test_unknown_instrument_type(self):
+        self.assertEqual(configdb.get_filters('FAKE-INSTRUMENT'), set())
+        self.assertIsNone(configdb.get_default_binning('FAKE-INSTRUMENT'))
+        with self.assertRaises(ConfigDBException):
+            configdb.get_request_overheads('FAKE-INSTRUMENT')
+
+    def test_active_instrument_types_by_location(self):
+        self.assertEqual(configdb.get_active_instrument_types({'observatory': 'doma'}),
+                         {'1M0-SCICAM-SBIG', '2M0-FLOYDS-SCICAM'})
+        self.assertEqual(configdb.get_active_instrument_types({'site': 'bpl'}), set())
+
+    def test_instrument_records(self):
+        instruments = configdb.get_instruments(only_schedulable=True)
+        sbig = [i for i in instruments if i.instrument_type == '1M0-SCICAM-SBIG']
+        self.assertEqual({i.telescope_key for i in sbig}, {self.doma, self.domb})
+        self.assertTrue(all(i.schedulable for i in instruments))
+        self.assertEqual(sbig[0].filters, {'air'})
+        self.assertIs(sbig[0].camera_type, sbig[1].camera_type)
+        self.assertEqual(sbig[0].camera_type.exposure_overheads, {1: 36.0, 2: 15.5, 3: 12.5})
+
+    def test_site_data_is_not_modified(self):
+        configdb.get_instruments()
+        for site in configdb.get_site_data():
+            for enclosure in site['enclosure_set']:
+                for telescope in enclosure['telescope_set']:
+                    for instrument in telescope['instrument_set']:
+                        self.assertNotIn('telescope_key', instrument)
+
+    def test_telescopes_with_instrument_type_and_location(self):
+        telescopes = configdb.get_telescopes_with_instrument_type_and_location('1M0-NRES-SCICAM')
+        self.assertEqual(list(telescopes.keys()), ['1m0a.domb.tst'])
+
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'configdb-test'},
+    'locmem': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}
+})
+class TestConfigDBSnapshotCache(ConfigDBTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        caches['default'].clear()
+        self.thread_patcher = patch('valhalla.common.configdb.threading.Thread')
+        self.mock_thread = self.thread_patcher.start()
+
+    def tearDown(self):
+        self.thread_patcher.stop()
+        caches['default'].clear()
+        super().tearDown()
+
+    def _age_snapshot(self, seconds):
+        info = caches['default'].get('configdb.sites.info')
+        info['fetched'] -= timedelta(seconds=seconds)
+        caches['default'].set('configdb.sites.info', info, None)
+
+    def test_snapshot_age(self):
+        self.assertIsNone(configdb.get_snapshot_age())
+        configdb.get_site_data()
+        self.assertLess(configdb.get_snapshot_age(), timedelta(seconds=CONFIGDB_CACHE_TIMEOUT))
+
+    def test_fresh_snapshot_is_not_refreshed(self):
+        configdb.get_filters('1M0-SCICAM-SBIG')
+        configdb.get_filters('1M0-SCICAM-SBIG')
+        self.assertEqual(len(responses.calls), 1)
+        self.mock_thread.assert_not_called()
+
+    def test_snapshot_is_shared_between_processes(self):
+        site_data = configdb.get_site_data()
+        other_process = ConfigDB()
+        self.assertEqual(other_process.get_site_data(), site_data)
+        self.assertEqual(other_process.get_filters('1M0-SCICAM-SBIG'), {'air'})
+        self.assertEqual(len(responses.calls), 1)
+
+    def test_stale_snapshot_is_served_and_refreshed_once(self):
+        configdb.get_site_data()
+        self._age_snapshot(CONFIGDB_CACHE_TIMEOUT + 1)
+        self.assertEqual(configdb.get_filters('1M0-SCICAM-SBIG'), {'air'})
+        self.assertEqual(ConfigDB().get_binnings('1M0-SCICAM-SBIG'), {1, 2, 3})
+        self.assertEqual(self.mock_thread.call_count, 1)
+        self.assertEqual(len(responses.calls), 1)
+
+    def test_last_known_good_snapshot_is_kept_when_configdb_is_down(self):
+        configdb.get_site_data()
+        self._age_snapshot(CONFIGDB_CACHE_TIMEOUT + 1)
+        responses.replace(responses.GET, settings.CONFIGDB_URL + '/sites/', status=500)
+        configdb._background_refresh('sites')
+        self.assertIsNone(caches['default'].get('configdb.sites.refresh_lock'))
+        self.assertEqual(configdb.get_filters('1M0-SCICAM-SBIG'), {'air'})
+        self.assertGreater(configdb.get_snapshot_age(), timedelta(seconds=CONFIGDB_CACHE_TIMEOUT))
+
+    def test_refresh_gives_up_on_a_hung_configdb(self):
+        configdb.get_site_data()
+        caches['default'].add('configdb.sites.refresh_lock', True)
+        with patch('valhalla.common.configdb.requests.get', side_effect=requests.exceptions.ReadTimeout) as mock_get:
+            configdb._background_refresh('sites')
+        self.assertEqual(mock_get.call_args[1]['timeout'], settings.CONFIGDB_TIMEOUT)
+        self.assertIsNone(caches['default'].get('configdb.sites.refresh_lock'))
+        self.assertEqual(configdb.get_filters('1M0-SCICAM-SBIG'), {'air'})
+
+    def test_refresh_is_conditional_on_etag(self):
+        responses.replace(responses.GET, settings.CONFIGDB_URL + '/sites/', json={'results': []},
+                          headers={'ETag': '"abc"'})
+        configdb.get_site_data()
+        version = caches['default'].get('configdb.sites.info')['version']
+        self._age_snapshot(CONFIGDB_CACHE_TIMEOUT + 1)
+        responses.replace(responses.GET, settings.CONFIGDB_URL + '/sites/', status=304)
+        configdb._background_refresh('sites')
+        self.assertEqual(responses.calls[-1].request.headers['If-None-Match'], '"abc"')
+        self.assertEqual(caches['default'].get('configdb.sites.info')['version'], version)
+        self.assertLess(configdb.get_snapshot_age(), timedelta(seconds=CONFIGDB_CACHE_TIMEOUT))
+
+    def test_first_miss_waits_on_the_worker_fetching_it(self):
+        caches['default'].add('configdb.sites.refresh_lock', True)
+        fetching_worker = ConfigDB()
+        with patch('valhalla.common.configdb.time.sleep',
+                   side_effect=lambda seconds: fetching_worker._refresh_configdb_data('sites')):
+            site_data = configdb.get_site_data()
+        self.assertEqual(site_data, fetching_worker.get_site_data())
+        self.assertEqual(len(responses.calls), 1)
+
+    def test_changed_content_gets_a_new_version(self):
+        configdb.get_site_data()
+        version = caches['default'].get('configdb.sites.info')['version']
+        responses.replace(responses.GET, settings.CONFIGDB_URL + '/sites/', json={'results': []})
+        configdb._background_refresh('sites')
+        new_version = caches['default'].get('configdb.sites.info')['version']
+        self.assertNotEqual(new_version, version)
+        self.assertIsNone(caches['default'].get('configdb.sites.{}'.format(version)))
+        self.assertEqual(ConfigDB().get_site_data(), [])
+
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'configdb-test'},
+    'locmem': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}
+})
+class TestConfigDBSnapshotFile(ConfigDBTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        caches['default'].clear()
+        self.snapshot_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(CONFIGDB_SNAPSHOT_DIR=self.snapshot_dir)
+        self.settings_override.enable()
+        self.thread_patcher = patch('valhalla.common.configdb.threading.Thread')
+        self.mock_thread = self.thread_patcher.start()
+
+    def tearDown(self):
+        self.thread_patcher.stop()
+        self.settings_override.disable()
+        shutil.rmtree(self.snapshot_dir)
+        caches['default'].clear()
+        super().tearDown()
+
+    def test_cold_start_loads_snapshot_from_disk(self):
+        site_data = ConfigDB().get_site_data()
+        caches['default'].clear()
+        responses.replace(responses.GET, settings.CONFIGDB_URL + '/sites/', status=500)
+        cold_process = ConfigDB()
+        self.assertEqual(cold_process.get_site_data(), site_data)
+        self.assertEqual(cold_process.get_filters('1M0-SCICAM-SBIG'), {'air'})
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(self.mock_thread.call_count, 1)
+
+    def test_corrupt_snapshot_falls_back_to_configdb(self):
+        with open(os.path.join(self.snapshot_dir, 'sites.json'), 'w') as snapshot_file:
+            snapshot_file.write('{"version": "abc", "results": [')
+        self.assertEqual(ConfigDB().get_filters('1M0-SCICAM-SBIG'), {'air'})
+        self.assertEqual(len(responses.calls), 1)
+
+    def test_warm_configdb_command(self):
+        call_command('warm_configdb', stdout=StringIO())
+        self.assertTrue(os.path.exists(os.path.join(self.snapshot_dir, 'sites.json')))
+        self.assertTrue(os.path.exists(os.path.join(self.snapshot_dir, 'filterwheels.json')))
+        call_command('warm_configdb', verify_only=True, stdout=StringIO())
+        self.assertEqual(len(responses.calls), 2)
+
+    def test_warm_configdb_command_rejects_modified_snapshot(self):
+        call_command('warm_configdb', stdout=StringIO())
+        with open(os.path.join(self.snapshot_dir, 'sites.json')) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+        snapshot['results'] = snapshot['results'][1:]
+        with open(os.path.join(self.snapshot_dir, 'sites.json'), 'w') as snapshot_file:
+            json.dump(snapshot, snapshot_file)
+        with self.assertRaises(CommandError):
+            call_command('warm_configdb', verify_only=True, stdout=StringIO())
+
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'},
+    'locmem': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'configdb-test'}
+})
+class TestConfigDBLocalCacheFallback(ConfigDBTestMixin, TestCase):
+    def tearDown(self):
+        caches['locmem'].clear()
+        super().tearDown()
+
+    def test_snapshot_is_kept_in_the_local_cache_without_a_shared_cache(self):
+        site_data = configdb.get_site_data()
+        self.assertEqual(ConfigDB().get_site_data(), site_data)
+        self.assertIsNotNone(caches['locmem'].get('configdb.sites.info'))
+        self.assertEqual(len(responses.calls), 1)
@@ -9,6 +9,9 @@ import os
 
 from valhalla.userrequests.models import UserRequest, Request, Window, Molecule, Constraints, Target, Location
 
+# random exposures add up to durations that overflow the integer duration column, so default to a short one
+mixer.register(Molecule, exposure_time=30.0, exposure_count=1)
+
 CONFIGDB_TEST_FILE = os.path.join(settings.BASE_DIR, 'valhalla/common/test_data/configdb.json')
 FILTERWHEELS_FILE = os.path.join(settings.BASE_DIR, 'valhalla/common/test_data/filterwheels.json')
 
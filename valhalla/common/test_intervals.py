@@ -0,0 +1,59 @@
+from django.test import TestCase
+from django.utils import timezone
+from datetime import datetime
+import pickle
+
+from valhalla.common.intervals import IntervalSet
+
+
+def day(day, hour=0):
+    return datetime(2017, 5, day, hour, tzinfo=timezone.utc)
+
+
+class TestIntervalSet(TestCase):
+    def setUp(self):
+        self.nights = IntervalSet.from_tuples([
+            (day(3, 22), day(4, 6)), (day(1, 22), day(2, 6)), (day(2, 22), day(3, 6))
+        ])
+
+    def test_tuples_round_trip(self):
+        self.assertEqual(self.nights.to_tuples(), [(day(1, 22), day(2, 6)), (day(2, 22), day(3, 6)),
+                                                   (day(3, 22), day(4, 6))])
+        microsecond = datetime(2017, 5, 1, 1, 2, 3, 456789, tzinfo=timezone.utc)
+        self.assertEqual(IntervalSet.from_tuples([(day(1), microsecond)]).to_tuples(), [(day(1), microsecond)])
+
+    def test_overlapping_and_touching_intervals_are_merged(self):
+        intervals = IntervalSet.from_tuples([(day(1), day(3)), (day(2), day(4)), (day(4), day(5)), (day(6), day(6))])
+        self.assertEqual(intervals.to_tuples(), [(day(1), day(5))])
+
+    def test_union(self):
+        union = self.nights.union([IntervalSet.from_tuples([(day(2, 4), day(2, 23))]), IntervalSet()])
+        self.assertEqual(union.to_tuples(), [(day(1, 22), day(3, 6)), (day(3, 22), day(4, 6))])
+        self.assertEqual(IntervalSet().union([]), IntervalSet())
+
+    def test_intersect(self):
+        intersection = self.nights.intersect(IntervalSet.from_tuples([(day(2), day(3, 23))]))
+        self.assertEqual(intersection.to_tuples(), [(day(2), day(2, 6)), (day(2, 22), day(3, 6)),
+                                                    (day(3, 22), day(3, 23))])
+        touching = IntervalSet.from_tuples([(day(2, 6), day(2, 22))])
+        self.assertTrue(self.nights.intersect(touching).is_empty())
+
+    def test_subtract(self):
+        downtime = IntervalSet.from_tuples([(day(1, 23), day(2, 1)), (day(2, 20), day(3, 7))])
+        self.assertEqual(self.nights.subtract(downtime).to_tuples(), [(day(1, 22), day(1, 23)), (day(2, 1), day(2, 6)),
+                                                                      (day(3, 22), day(4, 6))])
+        self.assertEqual(self.nights.subtract(IntervalSet()), self.nights)
+        self.assertTrue(IntervalSet().subtract(downtime).is_empty())
+
+    def test_clip(self):
+        self.assertEqual(self.nights.clip(day(2), day(3, 1)).to_tuples(),
+                         [(day(2), day(2, 6)), (day(2, 22), day(3, 1))])
+        self.assertTrue(self.nights.clip(day(2, 7), day(2, 21)).is_empty())
+
+    def test_contains(self):
+        self.assertTrue(self.nights.contains(day(2, 23), day(3, 6)))
+        self.assertFalse(self.nights.contains(day(2, 5), day(2, 23)))
+        self.assertFalse(self.nights.contains(day(5), day(5, 1)))
+
+    def test_intervalsets_can_be_cached(self):
+        self.assertEqual(pickle.loads(pickle.dumps(self.nights)), self.nights)
@@ -1,14 +1,18 @@
 from valhalla.common.telescope_states import (TelescopeStates, get_telescope_availability_per_day,
                                               combine_telescope_availabilities_by_site_and_class)
-from valhalla.common.configdb import TelescopeKey
+from valhalla.common.configdb import TelescopeKey, configdb
 from valhalla.common.test_helpers import ConfigDBTestMixin
 from valhalla.common import rise_set_utils
+from valhalla.common.intervals import IntervalSet
 
-from django.test import TestCase
-from datetime import datetime
+from django.test import TestCase, override_settings
+from django.core.cache import caches
+from datetime import datetime, timedelta
 from django.utils import timezone
 from unittest.mock import patch
+from time import sleep
 import json
+import numpy as np
 
 
 class TelescopeStatesFakeInput(ConfigDBTestMixin, TestCase):
@@ -397,3 +401,169 @@ class TestRiseSetUtils(ConfigDBTestMixin, TestCase):
         start = timezone.datetime(year=2017, month=5, day=5, tzinfo=timezone.utc)
         end = timezone.datetime(year=2017, month=5, day=6, tzinfo=timezone.utc)
         self.assertFalse(rise_set_utils.get_site_rise_set_intervals(start=start, end=end, site_code='bpl'))
+
+    def _get_request_dict(self):
+        return {
+            'target': {
+                'name': 'fake target', 'type': 'SIDEREAL', 'ra': 34.4, 'dec': -2.1, 'proper_motion_ra': 0.0,
+                'proper_motion_dec': 0.0, 'parallax': 0.0, 'epoch': 2000.0
+            },
+            'constraints': {'max_airmass': 2.0, 'min_lunar_distance': 30.0},
+            'windows': [{
+                'start': datetime(2016, 9, 4, tzinfo=timezone.utc), 'end': datetime(2016, 9, 5, tzinfo=timezone.utc)
+            }]
+        }
+
+    def test_rise_set_cache_key_depends_only_on_rise_set_inputs(self):
+        site_detail = {'latitude': -30.0, 'longitude': -70.0, 'horizon': 15.0}
+        request_dict = self._get_request_dict()
+        cache_key = rise_set_utils.get_rise_set_cache_key(request_dict, site_detail)
+        request_dict['id'] = 5
+        request_dict['target']['name'] = 'renamed target'
+        self.assertEqual(rise_set_utils.get_rise_set_cache_key(request_dict, site_detail), cache_key)
+        request_dict['constraints']['max_airmass'] = 1.6
+        self.assertNotEqual(rise_set_utils.get_rise_set_cache_key(request_dict, site_detail), cache_key)
+        request_dict['constraints']['max_airmass'] = 2.0
+        self.assertNotEqual(rise_set_utils.get_rise_set_cache_key(request_dict, dict(site_detail, horizon=20.0)),
+                            cache_key)
+
+    def test_visibility_is_computed_once_per_site_with_the_instrument_type(self):
+        request_dict = self._get_request_dict()
+        request_dict['molecules'] = [{'instrument_name': '1M0-NRES-SCICAM'}]
+        request_dict['location'] = {'telescope_class': '1m0'}
+        with patch('valhalla.common.rise_set_utils.get_observable_intervals',
+                   wraps=rise_set_utils.get_observable_intervals) as mock_observable_intervals:
+            intervals_by_site = rise_set_utils.get_filtered_rise_set_intervals_by_site(request_dict)
+        self.assertEqual(list(intervals_by_site.keys()), ['tst'])
+        self.assertTrue(intervals_by_site['tst'])
+        self.assertEqual(mock_observable_intervals.call_count, 1)
+        self.assertEqual(rise_set_utils.get_rise_set_intervals(request_dict), intervals_by_site['tst'])
+
+    @override_settings(CACHES={
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'rise-set-test'},
+        'locmem': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}
+    })
+    def test_rise_set_intervals_of_unsaved_requests_are_cached(self):
+        caches['default'].clear()
+        intervals_by_site = rise_set_utils.get_rise_set_intervals_by_site(self._get_request_dict())
+        self.assertTrue(intervals_by_site['tst'])
+        with patch('valhalla.common.rise_set_utils.get_rise_set_visibility', side_effect=AssertionError):
+            self.assertEqual(rise_set_utils.get_rise_set_intervals_by_site(self._get_request_dict()), intervals_by_site)
+        caches['default'].clear()
+
+    def test_site_rise_set_intervals_are_read_from_semester_night_tables(self):
+        semester_bounds = [
+            (datetime(2017, 2, 1, tzinfo=timezone.utc), datetime(2017, 5, 5, 12, tzinfo=timezone.utc)),
+            (datetime(2017, 5, 5, 12, tzinfo=timezone.utc), datetime(2017, 5, 8, tzinfo=timezone.utc)),
+        ]
+        start = timezone.datetime(year=2017, month=5, day=4, tzinfo=timezone.utc)
+        end = timezone.datetime(year=2017, month=5, day=10, tzinfo=timezone.utc)
+        rise_set_utils.get_night_table.cache_clear()
+        intervals = rise_set_utils.get_site_rise_set_intervals(
+            start=start, end=end, site_code='tst', semester_bounds=semester_bounds
+        )
+        site_detail = configdb.get_sites_with_instrument_type_and_location(site_code='tst')['tst']
+        self.assertEqual(intervals, rise_set_utils.get_dark_intervals(start, end, site_detail))
+        with patch('valhalla.common.rise_set_utils.get_dark_intervals', side_effect=AssertionError):
+            self.assertEqual(rise_set_utils.get_site_rise_set_intervals(
+                start=start + timedelta(days=1), end=end - timedelta(days=3), site_code='tst',
+                semester_bounds=semester_bounds
+            ), IntervalSet.from_tuples(intervals).clip(start + timedelta(days=1), end - timedelta(days=3)).to_tuples())
+        self.assertEqual(rise_set_utils.get_night_table.cache_info().currsize, 2)
+        rise_set_utils.get_night_table.cache_clear()
+
+
+class TestRiseSetPool(ConfigDBTestMixin, TestCase):
+    def tearDown(self):
+        rise_set_utils.rise_set_pool.terminate()
+        super().tearDown()
+
+    def _get_dark_intervals(self):
+        start = timezone.datetime(year=2017, month=5, day=5, tzinfo=timezone.utc)
+        end = timezone.datetime(year=2017, month=5, day=6, tzinfo=timezone.utc)
+        return rise_set_utils.get_site_rise_set_intervals(start=start, end=end, site_code='tst')
+
+    def test_pool_gives_the_same_intervals_as_in_process(self):
+        in_process_intervals = self._get_dark_intervals()
+        with self.settings(RISE_SET_POOL_SIZE=1):
+            self.assertEqual(self._get_dark_intervals(), in_process_intervals)
+
+    def test_timed_out_computations_are_cancelled(self):
+        with self.settings(RISE_SET_POOL_SIZE=1, RISE_SET_TIMEOUT=0):
+            with patch('valhalla.common.rise_set_utils.get_dark_intervals', side_effect=AssertionError):
+                with self.assertRaises(rise_set_utils.RiseSetTimeout):
+                    self._get_dark_intervals()
+        self.assertIsNone(rise_set_utils.rise_set_pool._pool)
+
+    def test_gevent_workers_compute_in_threads(self):
+        in_process_intervals = self._get_dark_intervals()
+        with self.settings(RISE_SET_POOL_SIZE=1):
+            with patch('valhalla.common.rise_set_utils.running_under_gevent', return_value=True):
+                with patch.object(rise_set_utils.rise_set_pool, '_get_pool', side_effect=AssertionError):
+                    with self.assertLogs('valhalla.common.rise_set_utils', 'INFO') as logs:
+                        self.assertEqual(self._get_dark_intervals(), in_process_intervals)
+        self.assertEqual(logs.records[-1].tags['executor'], 'threads')
+        self.assertEqual(logs.records[-1].tags['queue_depth'], 0)
+        self.assertEqual(rise_set_utils.rise_set_pool.queue_depth, 0)
+
+    def test_timed_out_threads_are_abandoned(self):
+        with self.settings(RISE_SET_POOL_SIZE=1, RISE_SET_TIMEOUT=0.1):
+            with patch('valhalla.common.rise_set_utils.running_under_gevent', return_value=True):
+                with patch('valhalla.common.rise_set_utils.get_dark_intervals', side_effect=lambda *args: sleep(1)):
+                    with self.assertRaises(rise_set_utils.RiseSetTimeout):
+                        self._get_dark_intervals()
+        self.assertEqual(rise_set_utils.rise_set_pool.queue_depth, 0)
+
+
+class TestSiderealVisibility(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.site_detail = {
+            'latitude': -30.1673, 'longitude': -70.8047, 'horizon': 15.0, 'ha_limit_neg': -4.6, 'ha_limit_pos': 4.6
+        }
+        self.start = datetime(2016, 9, 4, tzinfo=timezone.utc)
+        self.end = datetime(2016, 9, 7, tzinfo=timezone.utc)
+        self.targets = [
+            {'type': 'SIDEREAL', 'ra': ra, 'dec': dec, 'proper_motion_ra': 0.0, 'proper_motion_dec': 0.0,
+             'parallax': 0.0, 'epoch': 2000.0}
+            for ra, dec in ((34.4, -2.1), (83.8, -5.4), (201.4, -43.0), (280.0, -60.0), (10.0, 40.0))
+        ]
+
+    def assertIntervalsAlmostEqual(self, intervals, expected_intervals):
+        self.assertEqual(len(intervals), len(expected_intervals))
+        for (start, end), (expected_start, expected_end) in zip(intervals, expected_intervals):
+            self.assertLess(abs((start - expected_start).total_seconds()), 150)
+            self.assertLess(abs((end - expected_end).total_seconds()), 150)
+
+    def test_intervals_match_rise_set(self):
+        visibility = rise_set_utils.SiderealVisibility(self.site_detail, self.start, self.end)
+        for target in self.targets:
+            expected_intervals = rise_set_utils.get_observable_intervals(
+                target, 2.0, 30.0, self.start, self.end, self.site_detail
+            )
+            self.assertIntervalsAlmostEqual(visibility.get_observable_intervals(target, 2.0, 30.0), expected_intervals)
+
+    def test_target_that_never_rises_has_no_intervals(self):
+        visibility = rise_set_utils.SiderealVisibility(self.site_detail, self.start, self.end)
+        self.assertEqual(visibility.get_observable_intervals(self.targets[-1], 1.1, 0.0), [])
+
+    def test_intervals_and_gaps_shorter_than_the_grid_step_are_found(self):
+        visibility = rise_set_utils.SiderealVisibility(self.site_detail, self.start, self.end)
+        intervals = visibility._get_intervals(lambda seconds: 30.0 - np.abs(seconds - 1000.0))
+        self.assertEqual(len(intervals), 1)
+        self.assertAlmostEqual(intervals[0][0], 970.0, delta=rise_set_utils.SIDEREAL_PRECISION)
+        self.assertAlmostEqual(intervals[0][1], 1030.0, delta=rise_set_utils.SIDEREAL_PRECISION)
+        intervals = visibility._get_intervals(lambda seconds: np.abs(seconds - 1000.0) - 30.0)
+        self.assertEqual(len(intervals), 2)
+        self.assertAlmostEqual(intervals[0][1], 970.0, delta=rise_set_utils.SIDEREAL_PRECISION)
+        self.assertAlmostEqual(intervals[1][0], 1030.0, delta=rise_set_utils.SIDEREAL_PRECISION)
+
+    def test_vectorized_setting_uses_sidereal_visibility(self):
+        with self.settings(RISE_SET_VECTORIZED=True):
+            with patch('valhalla.common.rise_set_utils.get_rise_set_visibility', side_effect=AssertionError):
+                intervals = rise_set_utils.get_observable_intervals(
+                    self.targets[0], 2.0, 30.0, self.start, self.end, self.site_detail
+                )
+        self.assertIntervalsAlmostEqual(intervals, rise_set_utils.get_observable_intervals(
+            self.targets[0], 2.0, 30.0, self.start, self.end, self.site_detail
+        ))
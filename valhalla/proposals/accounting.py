@@ -2,6 +2,8 @@ import logging
 import requests
 from django.conf import settings
 
+from valhalla.common.pond import get_pond_session
+
 logger = logging.getLogger(__name__)
 
 
@@ -26,7 +28,7 @@ def get_time_totals_from_pond(timeallocation, start, end, too, recur=0):
         total += query_pond(
             timeallocation.proposal.id, start, end, timeallocation.telescope_class, timeallocation.instrument_name, too
         )
-    except requests.HTTPError:
+    except (requests.HTTPError, requests.Timeout):
         logger.warning('We got a pond inception. Splitting further.')
         for start, end in split_time(start, end, 4):
             total += get_time_totals_from_pond(timeallocation, start, end, too, recur=recur + 1)
@@ -42,7 +44,7 @@ def query_pond(proposal_id, start, end, telescope_class, instrument_class, too):
     url = '{0}/accounting/{1}/?proposal_id={2}&start={3}&end={4}&telescope_class={5}&instrument_class={6}'.format(
         settings.POND_URL, time_type, proposal_id, start, end, telescope_class, instrument_class
     )
-    response = requests.get(url)
+    response = get_pond_session().get(url, timeout=settings.POND_TIMEOUT)
     response.raise_for_status()
     if too:
         return response.json()['block_bounded_attempted_hours']
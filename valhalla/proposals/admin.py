@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from django.contrib import admin
+from django.utils import timezone
 
 from .models import Semester, TimeAllocationGroup, Proposal, TimeAllocation, Membership, ProposalInvite, ProposalNotification
 
@@ -50,7 +51,7 @@ class ProposalAdmin(admin.ModelAdmin):
     semesters.ordering = ''
 
     def activate_selected(self, request, queryset):
-        activated = queryset.filter(active=False).update(active=True)
+        activated = queryset.filter(active=False).update(active=True, modified=timezone.now())
         self.message_user(request, 'Successfully activated {} proposal(s)'.format(activated))
     activate_selected.short_description = 'Activate selected inactive proposals'
 
@@ -6,12 +6,17 @@ from django.utils.translation import ugettext as _
 from django.template.loader import render_to_string
 from django.urls import reverse
 from collections import namedtuple
+from contextlib import contextmanager
+import threading
 import logging
 
 from valhalla.celery import send_mail
 
 logger = logging.getLogger(__name__)
 
+# ids of the proposals to mark as modified when the outermost touch_proposals_once block exits
+_pending_touches = threading.local()
+
 
 class Semester(models.Model):
     id = models.CharField(primary_key=True, max_length=20)
@@ -58,6 +63,24 @@ class TimeAllocationGroup(models.Model):
         return allocs
 
 
+@contextmanager
+def touch_proposals_once():
+    ''' Defers the marking of proposals as modified when their time allocations are saved inside the block, then marks
+        each of those proposals once, so accounting for many requests takes one update rather than one for each
+    '''
+    if getattr(_pending_touches, 'ids', None) is not None:
+        yield
+        return
+    _pending_touches.ids = set()
+    try:
+        yield
+        proposal_ids = _pending_touches.ids
+    finally:
+        _pending_touches.ids = None
+    if proposal_ids:
+        Proposal.objects.filter(pk__in=proposal_ids).update(modified=timezone.now())
+
+
 class Proposal(models.Model):
     id = models.CharField(max_length=255, primary_key=True)
     active = models.BooleanField(default=True)
@@ -80,6 +103,17 @@ class Proposal(models.Model):
     class Meta:
         ordering = ('title',)
 
+    @classmethod
+    def touch(cls, proposal_id):
+        ''' Marks the proposal as modified so its pending user requests are in the schedulable requests delta, at the
+            end of the enclosing touch_proposals_once block if there is one
+        '''
+        pending_ids = getattr(_pending_touches, 'ids', None)
+        if pending_ids is not None:
+            pending_ids.add(proposal_id)
+        else:
+            cls.objects.filter(pk=proposal_id).update(modified=timezone.now())
+
     @cached_property
     def pi(self):
         return self.users.filter(membership__role=Membership.PI).first()
@@ -174,6 +208,34 @@ class TimeAllocation(models.Model):
         return 'Timeallocation for {0}-{1}'.format(self.proposal, self.semester)
 
 
+class TimeAllocationResolver(object):
+    ''' The time allocations of a set of proposals and semesters, loaded in a single query and looked up by
+        (TimeAllocationKey, proposal id). Build one per API request or scheduler call, it does not see later changes.
+    '''
+    def __init__(self, proposal_ids, semester_ids):
+        self.time_allocations = {}
+        time_allocations = TimeAllocation.objects.filter(proposal__in=set(proposal_ids), semester__in=set(semester_ids))
+        for time_allocation in time_allocations:
+            tak = TimeAllocationKey(time_allocation.semester_id, time_allocation.telescope_class,
+                                    time_allocation.instrument_name)
+            self.time_allocations[(tak, time_allocation.proposal_id)] = time_allocation
+
+    @classmethod
+    def for_keys(cls, keys):
+        ''' Builds a resolver that covers the given (TimeAllocationKey, proposal id) pairs
+        '''
+        keys = list(keys)
+        return cls([proposal_id for _, proposal_id in keys], [tak.semester for tak, _ in keys])
+
+    def get(self, tak, proposal_id):
+        try:
+            return self.time_allocations[(tak, proposal_id)]
+        except KeyError:
+            raise TimeAllocation.DoesNotExist(
+                'Proposal {} has no time allocation for {}'.format(proposal_id, tak)
+            )
+
+
 class Membership(models.Model):
     PI = 'PI'
     CI = 'CI'
@@ -0,0 +1,74 @@
+from django.core.cache import cache
+from bisect import bisect_right
+import time
+import uuid
+
+from valhalla.proposals.models import Semester
+
+SEMESTER_INDEX_CHECK_INTERVAL = 10  # seconds between checks of the shared semester index version
+SEMESTER_INDEX_VERSION_KEY = 'semester_index_version'
+semester_index = None
+
+
+class SemesterIndex(object):
+    ''' The semesters sorted by start, to find the semester a window is in by bisection. Semesters do not overlap, so
+        the only one that can contain a window is the last one to start before it.
+    '''
+    def __init__(self, semesters, version=None):
+        self.semesters = sorted(semesters, key=lambda semester: semester.start)
+        self.starts = [semester.start for semester in self.semesters]
+        self.version = version
+        self.checked = time.monotonic()
+
+    def get_semester_in(self, start_date, end_date):
+        index = bisect_right(self.starts, start_date) - 1
+        if index >= 0 and end_date <= self.semesters[index].end:
+            return self.semesters[index]
+
+        return None
+
+
+def get_semester_index():
+    ''' Returns this process's SemesterIndex, rebuilding it when the shared version has changed since it was built.
+        The version is kept in the default cache, which must be shared between processes for them to see each
+        other's changes. Without a version, as with a dummy cache, the index is rebuilt every
+        SEMESTER_INDEX_CHECK_INTERVAL seconds instead.
+    '''
+    global semester_index
+    if semester_index and time.monotonic() - semester_index.checked < SEMESTER_INDEX_CHECK_INTERVAL:
+        return semester_index
+    version = cache.get(SEMESTER_INDEX_VERSION_KEY)
+    if version is None:
+        cache.add(SEMESTER_INDEX_VERSION_KEY, uuid.uuid4().hex, None)
+        version = cache.get(SEMESTER_INDEX_VERSION_KEY)
+    if semester_index is None or version is None or semester_index.version != version:
+        semester_index = SemesterIndex(Semester.objects.all(), version)
+    semester_index.checked = time.monotonic()
+    return semester_index
+
+
+def invalidate_semester_index():
+    ''' Drops this process's SemesterIndex and changes the shared version, so every other process rebuilds theirs
+    '''
+    global semester_index
+    semester_index = None
+    cache.set(SEMESTER_INDEX_VERSION_KEY, uuid.uuid4().hex, None)
+
+
+def get_semesters():
+    ''' All of the semesters, the latest first
+    '''
+    return get_semester_index().semesters[::-1]
+
+
+def get_semester_in(start_date, end_date):
+    return get_semester_index().get_semester_in(start_date, end_date)
+
+
+def get_semester_bounds(start, end):
+    ''' The (start, end) of each semester that overlaps start to end, in time order
+    '''
+    return [
+        (semester.start, semester.end) for semester in get_semester_index().semesters
+        if semester.start < end and semester.end > start
+    ]
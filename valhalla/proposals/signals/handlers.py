@@ -1,6 +1,7 @@
 from django.dispatch import receiver
-from django.db.models.signals import pre_save
-from valhalla.proposals.models import TimeAllocation
+from django.db.models.signals import pre_save, post_save, post_delete
+from valhalla.proposals.models import Proposal, TimeAllocation, Semester
+from valhalla.proposals.semester_index import invalidate_semester_index
 
 
 @receiver(pre_save, sender=TimeAllocation)
@@ -14,3 +15,16 @@ def set_default_ipp_time(sender, instance, *args, **kwargs):
             instance.ipp_limit = instance.std_allocation * STARTING_IPP_LIMIT
         if not instance.ipp_time_available:
             instance.ipp_time_available = instance.std_allocation * STARTING_IPP_AVAILABLE
+
+
+@receiver(post_save, sender=TimeAllocation)
+@receiver(post_delete, sender=TimeAllocation)
+def touch_proposal(sender, instance, *args, **kwargs):
+    ''' Marks the proposal as modified, so its pending user requests are in the schedulable requests delta'''
+    Proposal.touch(instance.proposal_id)
+
+
+@receiver(post_save, sender=Semester)
+@receiver(post_delete, sender=Semester)
+def cb_semester_changed(sender, instance, *args, **kwargs):
+    invalidate_semester_index()
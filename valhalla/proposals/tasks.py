@@ -13,9 +13,11 @@ def update_time_allocation(time_allocation_id):
     logger.info('Updating timeallocation for %s', talloc.proposal, extra={'tags': {'proposal': talloc.proposal.id}})
     std_total = get_time_totals_from_pond(talloc, talloc.semester.start, talloc.semester.end, too=False)
     too_total = get_time_totals_from_pond(talloc, talloc.semester.start, talloc.semester.end, too=True)
-    talloc.std_time_used = std_total
-    talloc.too_time_used = too_total
-    talloc.save()
+    if (talloc.std_time_used, talloc.too_time_used) != (std_total, too_total):
+        # saving marks the pending user requests of the proposal as changed, so only save real changes
+        talloc.std_time_used = std_total
+        talloc.too_time_used = too_total
+        talloc.save()
 
 
 @shared_task
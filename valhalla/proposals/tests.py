@@ -1,4 +1,5 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.core.cache import cache
 from django.core import mail
 from django.contrib.auth.models import User
 from django.db.utils import IntegrityError
@@ -12,10 +13,12 @@ import responses
 import datetime
 
 from valhalla.proposals.models import ProposalInvite, Proposal, Membership, ProposalNotification, TimeAllocation, Semester
+from valhalla.proposals.models import TimeAllocationKey, TimeAllocationResolver
 from valhalla.userrequests.models import UserRequest, Molecule
 from valhalla.accounts.models import Profile
 from valhalla.proposals.accounting import split_time, get_time_totals_from_pond, query_pond
 from valhalla.proposals.tasks import run_accounting
+from valhalla.proposals import semester_index
 from valhalla.common.test_helpers import create_simple_userrequest, ConfigDBTestMixin
 
 
@@ -227,6 +230,31 @@ class TestDefaultIPP(TestCase):
         self.assertEqual(ta.ipp_time_available, 0)
 
 
+class TestTimeAllocationResolver(TestCase):
+    def setUp(self):
+        self.proposals = mixer.cycle(2).blend(Proposal)
+        self.semesters = mixer.cycle(2).blend(Semester)
+        self.time_allocations = [
+            mixer.blend(TimeAllocation, proposal=proposal, semester=semester, telescope_class='1m0',
+                        instrument_name='1M0-SCICAM-SBIG')
+            for proposal in self.proposals for semester in self.semesters
+        ]
+
+    def test_loads_all_time_allocations_in_one_query(self):
+        keys = [(TimeAllocationKey(ta.semester.id, '1m0', '1M0-SCICAM-SBIG'), ta.proposal.id)
+                for ta in self.time_allocations]
+        with self.assertNumQueries(1):
+            resolver = TimeAllocationResolver.for_keys(keys)
+            resolved = [resolver.get(tak, proposal_id) for tak, proposal_id in keys]
+        self.assertEqual(resolved, self.time_allocations)
+
+    def test_missing_time_allocation(self):
+        tak = TimeAllocationKey(self.semesters[0].id, '2m0', '2M0-FLOYDS-SCICAM')
+        resolver = TimeAllocationResolver.for_keys([(tak, self.proposals[0].id)])
+        with self.assertRaises(TimeAllocation.DoesNotExist):
+            resolver.get(tak, self.proposals[0].id)
+
+
 class TestProposalAdmin(TestCase):
     def setUp(self):
         self.admin_user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
@@ -241,3 +269,58 @@ class TestProposalAdmin(TestCase):
         )
         for proposal in self.proposals:
             self.assertEqual(Proposal.objects.get(pk=proposal.id).active, True)
+
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'semester-index-test'},
+    'locmem': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}
+})
+class TestSemesterIndex(TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.semester_a = mixer.blend(Semester, id='2016A', start=datetime.datetime(2016, 4, 1, tzinfo=timezone.utc),
+                                      end=datetime.datetime(2016, 9, 30, tzinfo=timezone.utc))
+        self.semester_b = mixer.blend(Semester, id='2016B', start=datetime.datetime(2016, 10, 1, tzinfo=timezone.utc),
+                                      end=datetime.datetime(2017, 3, 31, tzinfo=timezone.utc))
+
+    def tearDown(self):
+        semester_index.invalidate_semester_index()
+        cache.clear()
+        super().tearDown()
+
+    def test_semester_in(self):
+        get_semester_in = semester_index.get_semester_in
+        self.assertEqual(get_semester_in(datetime.datetime(2016, 4, 1, tzinfo=timezone.utc),
+                                         datetime.datetime(2016, 9, 30, tzinfo=timezone.utc)), self.semester_a)
+        self.assertEqual(get_semester_in(datetime.datetime(2016, 12, 1, tzinfo=timezone.utc),
+                                         datetime.datetime(2016, 12, 2, tzinfo=timezone.utc)), self.semester_b)
+        self.assertIsNone(get_semester_in(datetime.datetime(2016, 9, 1, tzinfo=timezone.utc),
+                                          datetime.datetime(2016, 10, 2, tzinfo=timezone.utc)))
+        self.assertIsNone(get_semester_in(datetime.datetime(2016, 3, 1, tzinfo=timezone.utc),
+                                          datetime.datetime(2016, 3, 2, tzinfo=timezone.utc)))
+
+    def test_index_is_rebuilt_when_semesters_change(self):
+        window = (datetime.datetime(2017, 5, 1, tzinfo=timezone.utc),
+                  datetime.datetime(2017, 5, 2, tzinfo=timezone.utc))
+        self.assertIsNone(semester_index.get_semester_in(*window))
+        semester = mixer.blend(Semester, id='2017A', start=datetime.datetime(2017, 4, 1, tzinfo=timezone.utc),
+                               end=datetime.datetime(2017, 9, 30, tzinfo=timezone.utc))
+        self.assertEqual(semester_index.get_semester_in(*window), semester)
+        semester.delete()
+        self.assertIsNone(semester_index.get_semester_in(*window))
+
+    def test_index_is_rebuilt_when_another_process_changes_semesters(self):
+        index = semester_index.get_semester_index()
+        self.assertIs(semester_index.get_semester_index(), index)
+        cache.set(semester_index.SEMESTER_INDEX_VERSION_KEY, 'changed elsewhere', None)
+        index.checked -= semester_index.SEMESTER_INDEX_CHECK_INTERVAL
+        self.assertIsNot(semester_index.get_semester_index(), index)
+        self.assertEqual(semester_index.get_semesters(), [self.semester_b, self.semester_a])
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
+    def test_index_is_rebuilt_periodically_without_a_shared_cache(self):
+        index = semester_index.get_semester_index()
+        self.assertIs(semester_index.get_semester_index(), index)
+        index.checked -= semester_index.SEMESTER_INDEX_CHECK_INTERVAL
+        self.assertIsNot(semester_index.get_semester_index(), index)
@@ -52,6 +52,7 @@ INSTALLED_APPS = [
     'storages',
     'corsheaders',
     'django_extensions',
+    'valhalla.common',
     'valhalla.accounts',
     'valhalla.userrequests',
     'valhalla.proposals',
@@ -227,9 +228,18 @@ SERVER_EMAIL = DEFAULT_FROM_EMAIL
 
 ELASTICSEARCH_URL = os.getenv('ELASTICSEARCH_URL', 'http://localhost')
 POND_URL = os.getenv('POND_URL', 'http://localhost')
+POND_TIMEOUT = float(os.getenv('POND_TIMEOUT', 60))
 CONFIGDB_URL = os.getenv('CONFIGDB_URL', 'http://localhost')
+CONFIGDB_TIMEOUT = float(os.getenv('CONFIGDB_TIMEOUT', 20))
+CONFIGDB_SNAPSHOT_DIR = os.getenv('CONFIGDB_SNAPSHOT_DIR', '')
 DOWNTIMEDB_URL = os.getenv('DOWNTIMEDB_URL', 'http://localhost')
 
+RISE_SET_POOL_SIZE = int(os.getenv('RISE_SET_POOL_SIZE', 0))
+RISE_SET_TIMEOUT = float(os.getenv('RISE_SET_TIMEOUT', 60))
+RISE_SET_VECTORIZED = os.getenv('RISE_SET_VECTORIZED', False)
+MAX_CADENCE_REQUESTS = int(os.getenv('MAX_CADENCE_REQUESTS', 1000))
+SQL_JSON_EXPORT = os.getenv('SQL_JSON_EXPORT', False)
+
 REST_FRAMEWORK = {
     'TEST_REQUEST_DEFAULT_FORMAT': 'json',
     'DEFAULT_PERMISSION_CLASSES': (
@@ -0,0 +1,220 @@
+from django.conf import settings
+from django.db import connection, models
+from django.db.models import Q
+from functools import lru_cache
+from itertools import chain
+import logging
+
+from valhalla.userrequests.models import UserRequest, Request, Target, Location, Constraints, Window, Molecule
+from valhalla.userrequests.target_helpers import TARGET_TYPE_HELPER_MAP
+
+logger = logging.getLogger(__name__)
+
+
+def get_dict_fields(model, exclude=()):
+    ''' The fields that model_to_dict puts in the dict of an instance of model, in the same order
+    '''
+    opts = model._meta
+    return [field.name for field in chain(opts.concrete_fields, opts.private_fields, opts.many_to_many)
+            if getattr(field, 'editable', False) and field.name not in exclude]
+
+
+def _rows_by_request(model, userrequest_ids):
+    ''' Returns the dicts of the instances of model under the user requests, as lists keyed by request id
+    '''
+    fields = get_dict_fields(model, model.SERIALIZER_EXCLUDE)
+    rows_by_request = {}
+    for row in model.objects.filter(request__user_request__in=userrequest_ids).values('request', *fields):
+        rows_by_request.setdefault(row['request'], []).append({field: row[field] for field in fields})
+    return rows_by_request
+
+
+def _target_dicts(target_rows):
+    ''' Trims each target dict to the fields of its target type, as Target.as_dict does, looking up the fields once
+        per type and scheme rather than once per target
+    '''
+    target_fields = {}
+    for target in target_rows:
+        key = (target['type'].upper(), target.get('scheme'))
+        if key not in target_fields:
+            target_fields[key] = TARGET_TYPE_HELPER_MAP[key[0]](target).fields
+        yield {field: target.get(field) for field in target_fields[key]}
+
+
+def userrequest_dicts(userrequest_ids):
+    ''' Builds the as_dict of many user requests from values() rows, with a fixed number of queries and no model
+        instances. The result is equal to [UserRequest.objects.get(pk=id).as_dict for id in userrequest_ids], except
+        that user requests with a request missing its target, location or constraints are logged and left out.
+    :param userrequest_ids: ids of the user requests, in the order to return them
+    :return: list of user request dicts
+    '''
+    userrequest_ids = list(userrequest_ids)
+    targets = _rows_by_request(Target, userrequest_ids)
+    for request_id, target_rows in targets.items():
+        targets[request_id] = list(_target_dicts(target_rows))
+    locations = _rows_by_request(Location, userrequest_ids)
+    constraints = _rows_by_request(Constraints, userrequest_ids)
+    windows = _rows_by_request(Window, userrequest_ids)
+    molecules = _rows_by_request(Molecule, userrequest_ids)
+
+    requests = Request.objects.filter(user_request__in=userrequest_ids)
+    missing_durations = Request.fill_missing_durations(requests)
+    request_fields = get_dict_fields(Request, Request.SERIALIZER_EXCLUDE)
+    requests_by_userrequest = {}
+    incomplete_userrequests = set()
+    for row in requests.values('user_request', 'duration', *request_fields):
+        request_id = row['id']
+        if request_id not in targets or request_id not in locations or request_id not in constraints:
+            logger.error('Request {} is missing its target, location or constraints, leaving out user request {}'
+                         .format(request_id, row['user_request']))
+            incomplete_userrequests.add(row['user_request'])
+            continue
+        request_dict = {field: row[field] for field in request_fields}
+        request_dict['duration'] = missing_durations.get(request_id, row['duration'])
+        request_dict['target'] = targets[request_id][0]
+        request_dict['molecules'] = molecules.get(request_id, [])
+        request_dict['location'] = {field: value for field, value in locations[request_id][0].items() if value}
+        request_dict['constraints'] = constraints[request_id][0]
+        request_dict['windows'] = windows.get(request_id, [])
+        requests_by_userrequest.setdefault(row['user_request'], []).append(request_dict)
+
+    userrequest_fields = get_dict_fields(UserRequest)
+    userrequests = {}
+    for row in UserRequest.objects.filter(id__in=userrequest_ids).values('submitter__username', *userrequest_fields):
+        userrequest_dict = {field: row[field] for field in userrequest_fields}
+        userrequest_dict['submitter'] = row['submitter__username']
+        userrequest_dict['requests'] = requests_by_userrequest.get(row['id'], [])
+        userrequests[row['id']] = userrequest_dict
+    return [userrequests[userrequest_id] for userrequest_id in userrequest_ids
+            if userrequest_id in userrequests and userrequest_id not in incomplete_userrequests]
+
+
+def complete_userrequest_ids(userrequest_ids):
+    ''' Leaves out the ids of the user requests that userrequest_dicts would leave out, those with a request missing its
+        target, location or constraints, so the number of dicts is known before building them
+    :return: list of the ids of the complete user requests, in the order of userrequest_ids
+    '''
+    userrequest_ids = list(userrequest_ids)
+    incomplete_userrequests = set(Request.objects.filter(user_request__in=userrequest_ids).filter(
+        Q(target__isnull=True) | Q(location__isnull=True) | Q(constraints__isnull=True)
+    ).values_list('user_request', flat=True))
+    return [userrequest_id for userrequest_id in userrequest_ids if userrequest_id not in incomplete_userrequests]
+
+
+def can_build_json_in_sql():
+    return bool(settings.SQL_JSON_EXPORT) and connection.vendor == 'postgresql'
+
+
+def _json_value(alias, field):
+    column = '{}.{}'.format(alias, connection.ops.quote_name(field.column))
+    if isinstance(field, models.DateTimeField):
+        # render UTC datetimes as the rest framework encoder does: a Z suffix, and fractional seconds cut to
+        # milliseconds
+        return ("CASE WHEN date_trunc('second', {0}) = {0} "
+                "THEN to_json(to_char({0} AT TIME ZONE 'UTC', 'YYYY-MM-DD\"T\"HH24:MI:SS\"Z\"')) "
+                "ELSE to_json(to_char({0} AT TIME ZONE 'UTC', 'YYYY-MM-DD\"T\"HH24:MI:SS.MS\"Z\"')) END").format(column)
+    return column
+
+
+def _json_object(pairs):
+    return 'json_build_object({})'.format(', '.join("'{}', {}".format(key, value) for key, value in pairs))
+
+
+def _json_children(model, alias, fields_sql):
+    return "(SELECT {} FROM {} {} WHERE {}.request_id = r.id)".format(
+        fields_sql, connection.ops.quote_name(model._meta.db_table), alias, alias
+    )
+
+
+def _json_list(model, alias):
+    fields = [model._meta.get_field(name) for name in get_dict_fields(model, model.SERIALIZER_EXCLUDE)]
+    json_object = _json_object((field.name, _json_value(alias, field)) for field in fields)
+    json_agg = 'json_agg({} ORDER BY {}.id)'.format(json_object, alias)
+    return "COALESCE({}, '[]'::json)".format(_json_children(model, alias, json_agg))
+
+
+def _target_json(alias):
+    ''' A CASE over the target types, and the schemes that change the fields of a type, that builds each target
+        with the fields of its target helper, as Target.as_dict does
+    '''
+    fields = {name: Target._meta.get_field(name) for name in get_dict_fields(Target, Target.SERIALIZER_EXCLUDE)}
+    cases = []
+    for target_type, helper in TARGET_TYPE_HELPER_MAP.items():
+        condition = "upper({}.type) = '{}'".format(alias, target_type)
+        type_fields = helper({'type': target_type}).fields
+        for scheme, _ in Target.ORBITAL_ELEMENT_SCHEMES:
+            scheme_fields = helper({'type': target_type, 'scheme': scheme}).fields
+            if scheme_fields != type_fields:
+                cases.append(("{} AND {}.scheme = '{}'".format(condition, alias, scheme), scheme_fields))
+        cases.append((condition, type_fields))
+    return 'CASE {} END'.format(' '.join(
+        'WHEN {} THEN {}'.format(condition, _json_object(
+            (name, _json_value(alias, fields[name]) if name in fields else 'NULL') for name in case_fields
+        ))
+        for condition, case_fields in cases
+    ))
+
+
+@lru_cache()
+def get_userrequest_json_sql():
+    ''' The PostgreSQL query that builds the as_dict of user requests, given an array of their ids, as json text
+    '''
+    # Location.as_dict leaves out blank values
+    location = 'json_strip_nulls({})'.format(_json_object(
+        (name, "NULLIF({}, '')".format(_json_value('l', Location._meta.get_field(name))))
+        for name in get_dict_fields(Location, Location.SERIALIZER_EXCLUDE)
+    ))
+    constraints_fields = [
+        Constraints._meta.get_field(name) for name in get_dict_fields(Constraints, Constraints.SERIALIZER_EXCLUDE)
+    ]
+    request_pairs = [
+        (name, _json_value('r', Request._meta.get_field(name)))
+        for name in get_dict_fields(Request, Request.SERIALIZER_EXCLUDE)
+    ]
+    request_pairs += [
+        ('duration', 'COALESCE(r.duration, 0)'),
+        ('target', _json_children(Target, 't', _target_json('t'))),
+        ('molecules', _json_list(Molecule, 'm')),
+        ('location', _json_children(Location, 'l', location)),
+        ('constraints', _json_children(
+            Constraints, 'c', _json_object((f.name, _json_value('c', f)) for f in constraints_fields)
+        )),
+        ('windows', _json_list(Window, 'w')),
+    ]
+    requests = "COALESCE((SELECT json_agg({} ORDER BY r.id) FROM {} r WHERE r.user_request_id = u.id), '[]'::json)"
+    requests = requests.format(_json_object(request_pairs), connection.ops.quote_name(Request._meta.db_table))
+    userrequest_pairs = [
+        (name, 'au.username' if name == 'submitter' else _json_value('u', UserRequest._meta.get_field(name)))
+        for name in get_dict_fields(UserRequest)
+    ]
+    # like userrequest_dicts, leave out user requests with a request that is missing one of its single children
+    incomplete = ' OR '.join(
+        'NOT EXISTS (SELECT 1 FROM {} x WHERE x.request_id = r.id)'.format(
+            connection.ops.quote_name(model._meta.db_table)
+        ) for model in (Target, Location, Constraints)
+    )
+    complete = 'NOT EXISTS (SELECT 1 FROM {} r WHERE r.user_request_id = u.id AND ({}))'.format(
+        connection.ops.quote_name(Request._meta.db_table), incomplete
+    )
+    return 'SELECT u.id, {}::text FROM {} u JOIN {} au ON au.id = u.submitter_id WHERE u.id = ANY(%s) AND {}'.format(
+        _json_object(userrequest_pairs + [('requests', requests)]),
+        connection.ops.quote_name(UserRequest._meta.db_table),
+        connection.ops.quote_name(UserRequest._meta.get_field('submitter').related_model._meta.db_table),
+        complete
+    )
+
+
+def userrequest_json(userrequest_ids):
+    ''' Builds the as_dict of many user requests as json text in PostgreSQL, without loading the rows into Python.
+        The json is equivalent to userrequest_dicts, though its spacing and the format of whole floats differ.
+    :param userrequest_ids: ids of the user requests, in the order to return them
+    :return: list of json strings, one for each user request
+    '''
+    userrequest_ids = list(userrequest_ids)
+    if not userrequest_ids:
+        return []
+    Request.fill_missing_durations(Request.objects.filter(user_request__in=userrequest_ids))
+    with connection.cursor() as cursor:
+        cursor.execute(get_userrequest_json_sql(), [userrequest_ids])
+        userrequests = dict(cursor.fetchall())
+    return [userrequests[userrequest_id] for userrequest_id in userrequest_ids if userrequest_id in userrequests]
@@ -1,38 +1,60 @@
 from valhalla.userrequests.duration_utils import get_request_duration
 from valhalla.common.rise_set_utils import get_rise_set_intervals, get_largest_interval
+from valhalla.common.intervals import IntervalSet
 
 from django.utils import timezone
 from datetime import timedelta
+from itertools import chain, islice
 
 
-def expand_cadence_request(request_dict):
+def get_cadence_windows(cadence):
     '''
-    Takes in a valid cadence request (valid request with cadence block), and expands the request into a list of requests
-    with their windows determined by the cadence parameters. Only valid requests that pass rise-set are returned, with
-    failing requests silently left out of the returned list.
+    Generates the (start, end) of each window of the cadence: one every period, jitter wide and within the cadence.
+    '''
+    half_jitter = timedelta(hours=cadence['jitter'] / 2.0)
+    request_window_start = cadence['start']
+    while request_window_start < cadence['end']:
+        yield max(request_window_start - half_jitter, cadence['start']), min(request_window_start + half_jitter,
+                                                                             cadence['end'])
+        request_window_start += timedelta(hours=cadence['period'])
+
+
+def iter_cadence_requests(request_dict):
+    '''
+    Generates the requests of a valid cadence request, one for each window of the cadence that is in the future and
+    passes rise-set. Rise-set is computed once over the whole span of the cadence and each window is intersected with
+    it, so requests are produced as fast as the caller consumes them.
     :param request_dict: a valid request dictionary with cadence information.
-    :return: Expanded list of requests with valid windows within the cadence.
+    :return: generator of requests with a single window within the cadence.
     '''
     cadence = request_dict['cadence']
-    # now expand the request into a list of requests with the proper windows from the cadence block
-    cadence_requests = []
-    half_jitter = timedelta(hours=cadence['jitter'] / 2.0)
     request_duration = get_request_duration(request_dict)
-    request_window_start = cadence['start']
+    now = timezone.now()
+    windows = (window for window in get_cadence_windows(cadence) if window[1] > now)
+    first_window = next(windows, None)
+    if first_window is None:
+        return
 
-    while request_window_start < cadence['end']:
-        window_start = max(request_window_start - half_jitter, cadence['start'])
-        window_end = min(request_window_start + half_jitter, cadence['end'])
-
-        # test the rise_set of this window
-        request_dict['windows'] = [{'start': window_start, 'end': window_end}]
-        intervals = get_rise_set_intervals(request_dict)
-        largest_interval = get_largest_interval(intervals)
-        if largest_interval.total_seconds() >= request_duration and window_end > timezone.now():
+    span_request = request_dict.copy()
+    span_request['windows'] = [{'start': first_window[0], 'end': cadence['end']}]
+    visible_intervals = IntervalSet.from_tuples(get_rise_set_intervals(span_request))
+    for window_start, window_end in chain([first_window], windows):
+        intervals = visible_intervals.clip(window_start, window_end).to_tuples()
+        if get_largest_interval(intervals).total_seconds() >= request_duration:
             # this cadence window passes rise_set and is in the future so add it to the list
             request_copy = request_dict.copy()
             del request_copy['cadence']
-            cadence_requests.append(request_copy)
+            request_copy['windows'] = [{'start': window_start, 'end': window_end}]
+            yield request_copy
 
-        request_window_start += timedelta(hours=cadence['period'])
-    return cadence_requests
+
+def expand_cadence_request(request_dict, max_requests=None):
+    '''
+    Takes in a valid cadence request (valid request with cadence block), and expands the request into a list of requests
+    with their windows determined by the cadence parameters. Only valid requests that pass rise-set are returned, with
+    failing requests silently left out of the returned list.
+    :param request_dict: a valid request dictionary with cadence information.
+    :param max_requests: stop expanding after this many requests.
+    :return: Expanded list of requests with valid windows within the cadence.
+    '''
+    return list(islice(iter_cadence_requests(request_dict), max_requests))
@@ -3,8 +3,9 @@ from datetime import timedelta
 import math
 
 from valhalla.userrequests.models import Request
-from valhalla.common.rise_set_utils import get_rise_set_intervals, get_site_rise_set_intervals
+from valhalla.common.rise_set_utils import get_filtered_rise_set_intervals_by_site, get_site_rise_set_intervals
 from valhalla.common.configdb import configdb
+from valhalla.proposals.semester_index import get_semester_bounds
 
 
 class Contention(object):
@@ -31,9 +32,9 @@ class Contention(object):
             ra = math.floor(request.target.ra / 15)
             proposal_id = request.user_request.proposal.id
             if not ra_bins[ra].get(proposal_id):
-                ra_bins[ra][proposal_id] = request.duration
+                ra_bins[ra][proposal_id] = request.get_duration()
             else:
-                ra_bins[ra][proposal_id] += request.duration
+                ra_bins[ra][proposal_id] += request.get_duration()
         return ra_bins
 
     def _anonymize(self, data):
@@ -92,9 +93,10 @@ class Pressure(object):
 
     def _site_nights(self):
         site_nights = {}
+        semester_bounds = get_semester_bounds(self.now, self.now + timedelta(hours=24))
         for site in self.sites:
             site_nights[site['code']] = get_site_rise_set_intervals(
-                self.now, self.now + timedelta(hours=24), site['code']
+                self.now, self.now + timedelta(hours=24), site['code'], semester_bounds
             )
         flattened = []
         for site in site_nights:
@@ -119,12 +121,13 @@ class Pressure(object):
 
     def _visible_intervals(self, request):
         visible_intervals = {}
+        intervals_by_site = get_filtered_rise_set_intervals_by_site(request.as_dict, self.site)
         for site in self.sites:
             if not request.location.site or request.location.site == site['code']:
-                intervals = get_rise_set_intervals(request.as_dict, site['code'])
+                intervals = intervals_by_site.get(site['code'], [])
                 for r, s in intervals:
                     effective_rise = max(r, self.now)
-                    if s > self.now and (s-effective_rise).seconds >= request.duration:
+                    if s > self.now and (s-effective_rise).seconds >= request.get_duration():
                         if site['code'] in visible_intervals:
                             visible_intervals[site['code']].append((effective_rise, s))
                         else:
@@ -149,7 +152,7 @@ class Pressure(object):
             if total_time_visible < 1:
                 continue
 
-            base_pressure = request.duration / total_time_visible
+            base_pressure = request.get_duration() / total_time_visible
             for i, bin_start in enumerate(bin_start_times):
                 n_telescopes = self._n_possible_telescopes(bin_start, site_intervals, instrument_name)
 
@@ -3,7 +3,8 @@ from django.utils.translation import ugettext as _
 from math import ceil, floor
 import logging
 
-from valhalla.proposals.models import TimeAllocationKey, Proposal, Semester
+from valhalla.proposals.models import TimeAllocationKey, TimeAllocationResolver, Proposal
+from valhalla.proposals.semester_index import get_semester_in
 from valhalla.common.configdb import configdb
 from valhalla.common.rise_set_utils import get_rise_set_intervals, get_largest_interval
 
@@ -15,23 +16,6 @@ PER_MOLECULE_STARTUP_TIME = 11.0   # per-molecule startup time, which encompasse
 OVERHEAD_ALLOWANCE = 1.1           # amount of leeway in a proposals timeallocation before rejecting that request
 MAX_IPP_LIMIT = 2.0                # the maximum allowed value of ipp
 MIN_IPP_LIMIT = 0.5                # the minimum allowed value of ipp
-semesters = None
-
-
-def get_semesters():
-    global semesters
-    if not semesters:
-        semesters = list(Semester.objects.all().order_by('-start'))
-    return semesters
-
-
-def get_semester_in(start_date, end_date):
-    semesters = get_semesters()
-    for semester in semesters:
-        if start_date >= semester.start and end_date <= semester.end:
-            return semester
-
-    return None
 
 
 def get_num_mol_changes(molecules):
@@ -42,14 +26,15 @@ def get_num_filter_changes(molecules):
     return len(list(itertools.groupby([mol.get('filter', '') for mol in molecules])))
 
 
-def get_molecule_duration_per_exposure(molecule_dict):
-    total_overhead_per_exp = configdb.get_exposure_overhead(molecule_dict['instrument_name'], molecule_dict['bin_x'])
+def get_molecule_duration_per_exposure(molecule_dict, overheads=None):
+    overheads = overheads or configdb.get_overhead_tables()
+    total_overhead_per_exp = overheads.get_exposure_overhead(molecule_dict['instrument_name'], molecule_dict['bin_x'])
     mol_duration_per_exp = molecule_dict['exposure_time'] + total_overhead_per_exp
     return mol_duration_per_exp
 
 
-def get_molecule_duration(molecule_dict):
-    mol_duration_per_exp = get_molecule_duration_per_exposure(molecule_dict)
+def get_molecule_duration(molecule_dict, overheads=None):
+    mol_duration_per_exp = get_molecule_duration_per_exposure(molecule_dict, overheads)
     mol_duration = molecule_dict['exposure_count'] * mol_duration_per_exp
     duration = mol_duration + PER_MOLECULE_GAP + PER_MOLECULE_STARTUP_TIME
 
@@ -57,10 +42,11 @@ def get_molecule_duration(molecule_dict):
 
 
 def get_request_duration_dict(request_dict):
+    overheads = configdb.get_overhead_tables()
     req_durations = {'requests': []}
     for req in request_dict:
-        req_info = {'duration': get_request_duration(req)}
-        mol_durations = [{'duration': get_molecule_duration_per_exposure(mol)} for mol in req['molecules']]
+        req_info = {'duration': get_request_duration(req, overheads)}
+        mol_durations = [{'duration': get_molecule_duration_per_exposure(mol, overheads)} for mol in req['molecules']]
         req_info['molecules'] = mol_durations
         req_info['largest_interval'] = get_largest_interval(get_rise_set_intervals(req)).total_seconds()
         req_info['largest_interval'] -= (PER_MOLECULE_STARTUP_TIME + PER_MOLECULE_GAP)
@@ -71,13 +57,12 @@ def get_request_duration_dict(request_dict):
 
 
 def get_max_ipp_for_userrequest(userrequest_dict):
-    proposal = Proposal.objects.get(pk=userrequest_dict['proposal'])
+    proposal_id = userrequest_dict['proposal'].id
     request_durations = get_request_duration_sum(userrequest_dict)
+    time_allocations = TimeAllocationResolver.for_keys((tak, proposal_id) for tak in request_durations)
     ipp_dict = {}
     for tak, duration in request_durations.items():
-        time_allocation = proposal.timeallocation_set.get(
-            semester=tak.semester, telescope_class=tak.telescope_class, instrument_name=tak.instrument_name
-        )
+        time_allocation = time_allocations.get(tak, proposal_id)
         duration_hours = duration / 3600.0
         ipp_available = time_allocation.ipp_time_available
         max_ipp_allowable = min((ipp_available / duration_hours) + 1.0, MAX_IPP_LIMIT)
@@ -98,8 +83,8 @@ def get_max_ipp_for_userrequest(userrequest_dict):
 
 def get_request_duration_sum(userrequest_dict):
     duration_sum = {}
-    for req in userrequest_dict['requests']:
-        duration = get_request_duration(req)
+    durations = get_request_durations(userrequest_dict['requests'])
+    for req, duration in zip(userrequest_dict['requests'], durations):
         tak = get_time_allocation_key(
             telescope_class=req['location']['telescope_class'],
             instrument_name=req['molecules'][0]['instrument_name'],
@@ -120,10 +105,11 @@ def get_num_exposures(molecule_dict, time_available):
     return max(1, num_exposures)
 
 
-def get_request_duration(request_dict):
+def get_request_duration(request_dict, overheads=None):
     # calculate the total time needed by the request, based on its instrument and exposures
-    request_overheads = configdb.get_request_overheads(request_dict['molecules'][0]['instrument_name'])
-    duration = sum([get_molecule_duration(m) for m in request_dict['molecules']])
+    overheads = overheads or configdb.get_overhead_tables()
+    request_overheads = overheads.get_request_overheads(request_dict['molecules'][0]['instrument_name'])
+    duration = sum([get_molecule_duration(m, overheads) for m in request_dict['molecules']])
     if configdb.is_spectrograph(request_dict['molecules'][0]['instrument_name']):
         duration += get_num_mol_changes(request_dict['molecules']) * request_overheads['config_change_time']
 
@@ -143,6 +129,14 @@ def get_request_duration(request_dict):
     return duration
 
 
+def get_request_durations(request_dicts):
+    ''' Computes the duration of many request dicts at once, looking up the configdb overheads only once
+    :return: list of durations in the same order as request_dicts
+    '''
+    overheads = configdb.get_overhead_tables()
+    return [get_request_duration(request_dict, overheads) for request_dict in request_dicts]
+
+
 def get_time_allocation(telescope_class, instrument_name, proposal_id, min_window_time, max_window_time):
     timeall = None
     try:
@@ -165,7 +159,11 @@ def get_time_allocation_key(telescope_class, instrument_name, min_window_time, m
 
 def get_total_duration_dict(userrequest_dict):
     durations = []
-    for request in userrequest_dict['requests']:
+    # requests loaded from the db carry their stored duration
+    request_durations = [request.get('duration') for request in userrequest_dict['requests']]
+    if None in request_durations:
+        request_durations = get_request_durations(userrequest_dict['requests'])
+    for request, duration in zip(userrequest_dict['requests'], request_durations):
         min_window_time = min([window['start'] for window in request['windows']])
         max_window_time = max([window['end'] for window in request['windows']])
         tak = get_time_allocation_key(request['location']['telescope_class'],
@@ -173,7 +171,6 @@ def get_total_duration_dict(userrequest_dict):
                                       min_window_time,
                                       max_window_time
                                       )
-        duration = get_request_duration(request)
         durations.append((tak, duration))
     # check the proposal has a time allocation with enough time for all requests depending on operator
     total_duration = {}
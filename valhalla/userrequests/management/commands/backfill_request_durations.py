@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from valhalla.common.configdb import ConfigDBException
+from valhalla.userrequests.models import Request
+from valhalla.userrequests.tasks import update_request_durations
+
+
+class Command(BaseCommand):
+    help = 'Stores the duration of requests that do not have one yet, computed from their molecules'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='Recompute the duration of every request, not only those without one')
+
+    def handle(self, *args, **options):
+        requests = Request.objects.all() if options['all'] else Request.objects.filter(duration__isnull=True)
+        try:
+            num_changed = update_request_durations(requests)
+        except ConfigDBException as e:
+            raise CommandError(str(e))
+        self.stdout.write('Updated the duration of {} requests'.format(num_changed))
@@ -0,0 +1,18 @@
+# Generated by Django 2.1.15 on 2026-10-18 18:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('userrequests', '0021_molecule_acquire_exp_time'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='request',
+            name='duration',
+            field=models.IntegerField(blank=True, editable=False, null=True),
+        ),
+    ]
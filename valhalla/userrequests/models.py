@@ -6,19 +6,26 @@ from django.core.cache import cache
 from django.urls import reverse
 from django.conf import settings
 from django.forms.models import model_to_dict
+from django.utils import timezone
+from contextlib import contextmanager
+import threading
 import requests
 import logging
 
-from valhalla.proposals.models import Proposal, TimeAllocationKey
+from valhalla.proposals.models import (Proposal, TimeAllocation, TimeAllocationKey, TimeAllocationResolver,
+                                       touch_proposals_once)
 from valhalla.userrequests.external_serializers import BlockSerializer
 from valhalla.userrequests.target_helpers import TARGET_TYPE_HELPER_MAP
 from valhalla.common.rise_set_utils import get_rise_set_target
-from valhalla.userrequests.request_utils import return_paginated_results
-from valhalla.userrequests.duration_utils import (get_request_duration, get_molecule_duration, get_total_duration_dict,
-                                                  get_semester_in)
+from valhalla.userrequests.request_utils import iter_paginated_results
+from valhalla.userrequests.duration_utils import get_request_duration, get_molecule_duration, get_total_duration_dict
+from valhalla.proposals.semester_index import get_semester_in
 
 logger = logging.getLogger(__name__)
 
+# ids of the requests to mark as modified when the outermost touch_requests_once block exits
+_pending_touches = threading.local()
+
 
 class UserRequest(models.Model):
     NORMAL = 'NORMAL'
@@ -99,6 +106,26 @@ class UserRequest(models.Model):
             return cached_duration
 
 
+@contextmanager
+def touch_requests_once():
+    ''' Defers the marking of requests as modified when their parts are saved or deleted inside the block, then marks
+        each of those requests once, so saving a whole user request takes one update rather than one for each part.
+        Proposals touched by time allocation saves in the block are marked once too.
+    '''
+    if getattr(_pending_touches, 'ids', None) is not None:
+        yield
+        return
+    _pending_touches.ids = set()
+    try:
+        with touch_proposals_once():
+            yield
+        request_ids = _pending_touches.ids
+    finally:
+        _pending_touches.ids = None
+    if request_ids:
+        Request.objects.filter(pk__in=request_ids).update(modified=timezone.now())
+
+
 class Request(models.Model):
     STATE_CHOICES = (
         ('PENDING', 'PENDING'),
@@ -127,6 +154,9 @@ class Request(models.Model):
     # Minimum completable block threshold (percentage, 0-100)
     acceptability_threshold = models.FloatField(default=90.0, validators=[MinValueValidator(0.0), MaxValueValidator(100.0)])
 
+    # Seconds needed to execute the molecules, kept up to date as the molecules and the configdb overheads change
+    duration = models.IntegerField(null=True, blank=True, editable=False)
+
     class Meta:
         ordering = ('id',)
 
@@ -139,7 +169,7 @@ class Request(models.Model):
     @property
     def as_dict(self):
         ret_dict = model_to_dict(self, exclude=self.SERIALIZER_EXCLUDE)
-        ret_dict['duration'] = self.duration
+        ret_dict['duration'] = self.get_duration()
         ret_dict['target'] = self.target.as_dict
         ret_dict['molecules'] = [m.as_dict for m in self.molecules.all()]
         ret_dict['location'] = self.location.as_dict
@@ -147,15 +177,46 @@ class Request(models.Model):
         ret_dict['windows'] = [w.as_dict for w in self.windows.all()]
         return ret_dict
 
-    @cached_property
-    def duration(self):
-        cached_duration = cache.get('request_duration_{}'.format(self.id))
-        if not cached_duration:
-            duration = get_request_duration({'molecules': [m.as_dict for m in self.molecules.all()]})
-            cache.set('request_duration_{}'.format(self.id), duration, 86400 * 30 * 6)
-            return duration
+    def update_duration(self, overheads=None):
+        ''' Recomputes the duration from the molecules and stores it on the row, without touching the other fields
+        :return: True if the stored duration changed
+        '''
+        molecules = [m.as_dict for m in self.molecules.all()]
+        if not molecules:
+            return False
+        duration = get_request_duration({'molecules': molecules}, overheads)
+        if duration == self.duration:
+            return False
+        self.duration = duration
+        Request.objects.filter(pk=self.pk).update(duration=duration)
+        cache.delete('userrequest_duration_{}'.format(self.user_request_id))
+        return True
+
+    def get_duration(self):
+        ''' Returns the stored duration, computing and storing it first if the row does not have one yet
+        '''
+        if self.duration is None:
+            self.update_duration()
+        return self.duration if self.duration is not None else 0
+
+    @classmethod
+    def touch(cls, request_id):
+        ''' Marks the request as modified so the change is in the schedulable requests delta, at the end of the
+            enclosing touch_requests_once block if there is one
+        '''
+        pending_ids = getattr(_pending_touches, 'ids', None)
+        if pending_ids is not None:
+            pending_ids.add(request_id)
         else:
-            return cached_duration
+            cls.objects.filter(pk=request_id).update(modified=timezone.now())
+
+    @classmethod
+    def fill_missing_durations(cls, requests):
+        ''' Computes and stores the duration of each of the requests that does not have one yet
+        :return: dict of request id to duration of those requests
+        '''
+        missing = requests.filter(duration__isnull=True).prefetch_related('molecules')
+        return {request.id: request.get_duration() for request in missing}
 
     @property
     def min_window_time(self):
@@ -171,25 +232,24 @@ class Request(models.Model):
 
     @property
     def time_allocation_key(self):
-        return TimeAllocationKey(self.semester.id, self.location.telescope_class, self.molecules.first().instrument_name)
+        semester = self.semester
+        if semester is None:
+            raise TimeAllocation.DoesNotExist('No semester contains the windows of request {}'.format(self.id))
+        return TimeAllocationKey(semester.id, self.location.telescope_class, self.molecules.first().instrument_name)
 
     @property
     def timeallocation(self):
-        return self.user_request.proposal.timeallocation_set.get(
-            semester__start__lte=self.min_window_time,
-            semester__end__gte=self.max_window_time,
-            telescope_class=self.location.telescope_class,
-            instrument_name=self.molecules.first().instrument_name
-        )
+        tak = self.time_allocation_key
+        proposal_id = self.user_request.proposal_id
+        return TimeAllocationResolver.for_keys([(tak, proposal_id)]).get(tak, proposal_id)
 
     @cached_property
     def blocks(self):
-        blocks = []
         url = '{0}/blocks/?request_num={1}&ordering=id&limit=1000'.format(settings.POND_URL, self.get_id_display().zfill(10))
         try:
-            blocks = return_paginated_results(blocks, url)
+            blocks = list(iter_paginated_results(url))
             return BlockSerializer(blocks, many=True).data
-        except (requests.exceptions.ConnectionError, requests.exceptions.HTTPError):
+        except requests.RequestException:
             logger.error('Could not connect to the pond.')
             return BlockSerializer([], many=True).data
 
@@ -1,11 +1,13 @@
+from django.conf import settings
 from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
 from rise_set.angle import Angle
 from rise_set.astrometry import calculate_airmass_at_times
-import requests
 
 from valhalla.common.configdb import configdb
+from valhalla.common.pond import get_pond_session
 from valhalla.common.telescope_states import TelescopeStates, filter_telescope_states_by_intervals
-from valhalla.common.rise_set_utils import get_rise_set_target, get_rise_set_intervals
+from valhalla.common.rise_set_utils import get_rise_set_target, get_filtered_rise_set_intervals_by_site
 
 MOLECULE_TYPE_DISPLAY = {
   'EXPOSE': 'Imaging',
@@ -26,17 +28,8 @@ MOLECULE_TYPE_DISPLAY = {
 
 def get_telescope_states_for_request(request):
     instrument_type = request.molecules.first().instrument_name
-    site_intervals = {}
-    # Build up the list of telescopes and their rise set intervals for the target on this request
-    site_data = configdb.get_sites_with_instrument_type_and_location(
-      instrument_type=instrument_type,
-      site_code=request.location.site,
-      observatory_code=request.location.observatory,
-      telescope_code=request.location.telescope
-    )
-    for site, details in site_data.items():
-        if site not in site_intervals:
-            site_intervals[site] = get_rise_set_intervals(request.as_dict, site)
+    # Build up the list of sites and their rise set intervals for the target on this request
+    site_intervals = get_filtered_rise_set_intervals_by_site(request.as_dict)
     # If you have no sites, return the empty dict here
     if not site_intervals:
         return {}
@@ -81,12 +74,13 @@ def get_airmasses_for_request_at_sites(request_dict):
 
     data = {'airmass_data': {}}
     if request_dict['target']['type'].upper() != 'SATELLITE':
+        intervals_by_site = get_filtered_rise_set_intervals_by_site(request_dict)
         for site_id, site_details in site_data.items():
             night_times = []
             site_lat = Angle(degrees=site_details['latitude'])
             site_lon = Angle(degrees=site_details['longitude'])
             site_alt = site_details['altitude']
-            intervals = get_rise_set_intervals(request_dict, site_id)
+            intervals = intervals_by_site.get(site_id, [])
             for interval in intervals:
                 night_times.extend(
                     [time for time in date_range_from_interval(interval[0], interval[1], dt=timedelta(minutes=10))])
@@ -125,11 +119,20 @@ def exposure_completion_percentage_from_pond_block(pond_block):
     return (completed_exposure_time / total_exposure_time) * 100.0
 
 
-def return_paginated_results(collection, url):
-    response = requests.get(url)
+def get_pond_page(url):
+    response = get_pond_session().get(url, timeout=settings.POND_TIMEOUT)
     response.raise_for_status()
-    collection += response.json()['results']
-    if not response.json()['next']:
-        return collection
-    else:
-        return return_paginated_results(collection, response.json()['next'])
+    page = response.json()
+    return page['results'], page['next']
+
+
+def iter_paginated_results(url):
+    ''' Generates the results of each page of a paginated pond endpoint, fetching the next page in the background
+        while the results of the current one are being consumed
+    '''
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        page = executor.submit(get_pond_page, url)
+        while page:
+            results, next_url = page.result()
+            page = executor.submit(get_pond_page, next_url) if next_url else None
+            yield from results
@@ -0,0 +1,249 @@
+from django.db.models import Min, Max, Count, Sum, OuterRef, Subquery, Q
+from django.core.cache import cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from rest_framework.renderers import JSONRenderer
+from datetime import timedelta
+from itertools import chain
+import hashlib
+import logging
+import json
+import msgpack
+
+from valhalla.common.renderers import pack
+from valhalla.proposals.models import Proposal, TimeAllocationResolver
+from valhalla.userrequests.models import UserRequest, Request, Window, Molecule
+from valhalla.userrequests.bulk_serializers import (
+    userrequest_dicts, userrequest_json, can_build_json_in_sql, complete_userrequest_ids
+)
+from valhalla.userrequests.state_changes import TERMINAL_STATES
+from valhalla.userrequests.duration_utils import get_total_duration_dict, OVERHEAD_ALLOWANCE
+
+logger = logging.getLogger(__name__)
+
+# The cursor of a delta is set back by this much, so that rows written by transactions that were still open while the
+# delta was built are in the next delta
+DELTA_CURSOR_OVERLAP = timedelta(minutes=1)
+SCHEDULABLE_CHUNK_SIZE = 500
+SCHEDULABLE_SNAPSHOT_KEY = 'schedulable_requests_snapshot'
+SCHEDULABLE_SNAPSHOT_TIMEOUT = 86400  # seconds, the snapshot is rebuilt after every isDirty that finds a change
+SCHEDULABLE_STREAM_ERROR = 'Failed to list all of the schedulable user requests, the list is incomplete'
+
+
+def get_schedulable_userrequests(start, end):
+    ''' Schedulable user requests are not in a terminal state, are part of an active proposal and have a window
+        starting between start and end. They are ordered newest first like every list of user requests, with the id
+        breaking ties between user requests created at the same time.
+    '''
+    return UserRequest.objects.exclude(state__in=TERMINAL_STATES).filter(
+        requests__windows__start__lte=end, requests__windows__start__gte=start, proposal__active=True
+    ).distinct().order_by('-created', 'id')
+
+
+def get_userrequest_summaries(userrequest_ids):
+    ''' Builds, for each user request, only the parts of its dict that get_total_duration_dict reads: the stored
+        duration, telescope class, first instrument and window extent of each request. That takes three small
+        queries instead of the whole user request tree.
+    :return: list of user request summary dicts, in the order of userrequest_ids
+    '''
+    userrequest_ids = list(userrequest_ids)
+    windows = {
+        row['request']: [{'start': row['start'], 'end': row['end']}]
+        for row in Window.objects.filter(request__user_request__in=userrequest_ids).order_by().values(
+            'request').annotate(start=Min('start'), end=Max('end'))
+    }
+    first_instrument = Molecule.objects.filter(request=OuterRef('pk')).order_by('id').values('instrument_name')[:1]
+    requests_by_userrequest = {}
+    requests = Request.objects.filter(user_request__in=userrequest_ids)
+    missing_durations = Request.fill_missing_durations(requests)
+    rows = requests.values(
+        'id', 'user_request', 'duration', 'location__telescope_class'
+    ).annotate(instrument_name=Subquery(first_instrument))
+    for row in rows:
+        requests_by_userrequest.setdefault(row['user_request'], []).append({
+            'duration': missing_durations.get(row['id'], row['duration']),
+            'location': {'telescope_class': row['location__telescope_class']},
+            'molecules': [{'instrument_name': row['instrument_name']}],
+            'windows': windows[row['id']],
+        })
+    userrequests = {
+        row['id']: dict(row, requests=requests_by_userrequest.get(row['id'], []))
+        for row in UserRequest.objects.filter(id__in=userrequest_ids).values(
+            'id', 'proposal', 'operator', 'observation_type'
+        )
+    }
+    return [userrequests[userrequest_id] for userrequest_id in userrequest_ids]
+
+
+def filter_by_time_allocation(userrequest_ids):
+    ''' Keeps the user requests whose proposal still has the time allocated for them, with some overhead allowance
+    :return: list of the ids of the user requests that have time left, in the order of userrequest_ids
+    '''
+    total_durations = [(ur, get_total_duration_dict(ur)) for ur in get_userrequest_summaries(userrequest_ids)]
+    time_allocations = TimeAllocationResolver.for_keys(
+        (tak, ur['proposal']) for ur, total_duration_dict in total_durations for tak in total_duration_dict
+    )
+    schedulable_ids = []
+    for ur, total_duration_dict in total_durations:
+        for tak, duration in total_duration_dict.items():
+            time_allocation = time_allocations.get(tak, ur['proposal'])
+            if ur['observation_type'] == UserRequest.NORMAL:
+                time_left = time_allocation.std_allocation - time_allocation.std_time_used
+            else:
+                time_left = time_allocation.too_allocation - time_allocation.too_time_used
+            if time_left * OVERHEAD_ALLOWANCE >= (duration / 3600.0):
+                schedulable_ids.append(ur['id'])
+                break
+            else:
+                logger.warning(
+                    'not enough time left {0} in proposal {1} for ur {2} of duration {3}, skipping'.format(
+                        time_left, ur['proposal'], ur['id'], (duration / 3600.0)
+                    )
+                )
+    return schedulable_ids
+
+
+def get_changed_userrequests(since):
+    ''' User requests that changed at or after since: the user request or one of its requests was saved, a window,
+        molecule, target, location or constraints of one of its requests was saved or deleted, or its proposal or
+        one of the proposal's time allocations was saved while the user request was not in a terminal state
+    '''
+    return UserRequest.objects.filter(
+        Q(modified__gte=since) | Q(requests__modified__gte=since) |
+        (Q(proposal__modified__gte=since) & ~Q(state__in=TERMINAL_STATES))
+    ).distinct()
+
+
+def get_schedulable_delta(start, end, since):
+    ''' Splits the user requests that changed since the cursor into the ones that are schedulable between start and
+        end, and tombstones for the ones that are not, which may have left the schedulable set. User requests that were
+        deleted outright leave no row to find, so they have no tombstone; the api never deletes them, they are
+        canceled, but after deleting one otherwise the scheduler has to fetch the whole range again.
+    :return: (ids of the changed schedulable user requests, ids of the changed user requests that are not schedulable)
+    '''
+    changed = get_changed_userrequests(since)
+    changed_ids = set(changed.values_list('id', flat=True))
+    schedulable_ids = filter_by_time_allocation(get_schedulable_userrequests(start, end).filter(
+        id__in=changed.values('id')
+    ).values_list('id', flat=True))
+    removed_ids = sorted(changed_ids.difference(schedulable_ids))
+    return schedulable_ids, removed_ids
+
+
+def iter_schedulable_chunks(userrequest_ids):
+    ''' Generates the ids of the user requests that still have time in their proposals, checking SCHEDULABLE_CHUNK_SIZE
+        of them at a time so only one chunk of user requests is serialized and in memory at once
+    '''
+    for i in range(0, len(userrequest_ids), SCHEDULABLE_CHUNK_SIZE):
+        yield filter_by_time_allocation(userrequest_ids[i:i + SCHEDULABLE_CHUNK_SIZE])
+
+
+def schedulable_requests_json(userrequest_ids, catch_errors=False):
+    ''' Generates the json list of the schedulable user requests, a chunk at a time
+    :param catch_errors: log a failure part way through the list and end the list with an error item, instead of
+        raising and leaving the list unfinished. Use it where the status of the response has already been sent.
+    '''
+    build_json_in_sql = can_build_json_in_sql()
+    renderer = JSONRenderer()
+    yield '['
+    separator = ''
+    try:
+        for chunk_ids in iter_schedulable_chunks(userrequest_ids):
+            if build_json_in_sql:
+                chunk_json = userrequest_json(chunk_ids)
+            else:
+                chunk_json = (renderer.render(ur_dict).decode() for ur_dict in userrequest_dicts(chunk_ids))
+            for ur_json in chunk_json:
+                yield separator + ur_json
+                separator = ','
+    except Exception:
+        if not catch_errors:
+            raise
+        logger.exception('Failed to stream the schedulable user requests')
+        yield separator + json.dumps({'error': SCHEDULABLE_STREAM_ERROR})
+    yield ']'
+
+
+def schedulable_requests_msgpack(userrequest_ids):
+    ''' Generates the schedulable user requests as one msgpack array, as MsgPackRenderer renders the list, serializing
+        a chunk at a time. The array header needs the count, so the time left in the proposals is checked for all of the
+        user requests before any is serialized. A failure part way through is logged and the rest of the array is
+        filled with error maps, so that it still unpacks.
+    '''
+    try:
+        schedulable_ids = complete_userrequest_ids(chain.from_iterable(iter_schedulable_chunks(userrequest_ids)))
+    except Exception:
+        logger.exception('Failed to stream the schedulable user requests')
+        yield pack([{'error': SCHEDULABLE_STREAM_ERROR}])
+        return
+    yield msgpack.Packer().pack_array_header(len(schedulable_ids))
+    packed = 0
+    try:
+        for i in range(0, len(schedulable_ids), SCHEDULABLE_CHUNK_SIZE):
+            for ur_dict in userrequest_dicts(schedulable_ids[i:i + SCHEDULABLE_CHUNK_SIZE]):
+                yield pack(ur_dict)
+                packed += 1
+    except Exception:
+        logger.exception('Failed to stream the schedulable user requests')
+    if packed < len(schedulable_ids):
+        # a user request deleted or left incomplete since the count was taken also leaves the array short
+        yield pack({'error': SCHEDULABLE_STREAM_ERROR}) * (len(schedulable_ids) - packed)
+
+
+def get_schedulable_watermark():
+    ''' A mark of the state of the data that can affect the schedulable user requests: the time of the latest change
+        and the number and summed ids of the user requests, requests and proposals. Changes to the parts of a request
+        and to time allocations are tracked through Request.modified and Proposal.modified, and the counts change when
+        rows are deleted, which leaves no modified time behind. Bulk updates must set modified to change it.
+    '''
+    aggregates = [
+        model.objects.aggregate(modified=Max('modified'), count=Count('id'), ids=Sum('id'))
+        for model in (UserRequest, Request, Proposal)
+    ]
+    return (
+        max(filter(None, (aggregate['modified'] for aggregate in aggregates)), default=None),
+        tuple((aggregate['count'], aggregate['ids']) for aggregate in aggregates)
+    )
+
+
+def build_schedulable_snapshot(start, end):
+    ''' Serializes the schedulable user requests between start and end and stores them in the shared cache, with the
+        watermark of the data they were built from and an etag of their json
+    '''
+    watermark = get_schedulable_watermark()
+    ur_ids = list(get_schedulable_userrequests(start, end).values_list('id', flat=True))
+    content = ''.join(schedulable_requests_json(ur_ids))
+    snapshot = {
+        'start': start,
+        'end': end,
+        'watermark': watermark,
+        'etag': hashlib.sha1(content.encode()).hexdigest(),
+        'content': content,
+    }
+    cache.set(SCHEDULABLE_SNAPSHOT_KEY, snapshot, SCHEDULABLE_SNAPSHOT_TIMEOUT)
+    stored = cache.get(SCHEDULABLE_SNAPSHOT_KEY)
+    if not stored or stored['etag'] != snapshot['etag']:
+        # memcached refuses values over its item size limit, and would go on serving an older snapshot
+        logger.warning('Failed to store the schedulable requests snapshot of {} bytes in the cache'.format(
+            len(content)
+        ))
+        cache.delete(SCHEDULABLE_SNAPSHOT_KEY)
+    return snapshot
+
+
+def can_store_schedulable_snapshot():
+    ''' The snapshot is only worth building when the shared cache keeps it
+    '''
+    return not isinstance(caches['default'], DummyCache)
+
+
+def get_schedulable_snapshot(start, end):
+    ''' Returns the stored snapshot of the schedulable user requests between start and end, or None if there is no
+        snapshot of that range or something has changed since it was built. Only the one snapshot is kept, of the
+        current semester, so any other range is never served from it.
+    '''
+    snapshot = cache.get(SCHEDULABLE_SNAPSHOT_KEY)
+    if not snapshot or (snapshot['start'], snapshot['end']) != (start, end):
+        return None
+    if snapshot['watermark'] != get_schedulable_watermark():
+        return None
+    return snapshot
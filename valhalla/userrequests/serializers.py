@@ -8,15 +8,16 @@ from json import JSONDecodeError
 import logging
 import json
 
-from valhalla.proposals.models import TimeAllocation, Membership
+from valhalla.proposals.models import TimeAllocationResolver, Membership
 from valhalla.userrequests.models import Request, Target, Window, UserRequest, Location, Molecule, Constraints
-from valhalla.userrequests.models import DraftUserRequest
+from valhalla.userrequests.models import DraftUserRequest, touch_requests_once
 from valhalla.userrequests.state_changes import debit_ipp_time, TimeAllocationError, validate_ipp
 from valhalla.userrequests.target_helpers import TARGET_TYPE_HELPER_MAP
 from valhalla.common.configdb import configdb
 from valhalla.userrequests.request_utils import MOLECULE_TYPE_DISPLAY
 from valhalla.userrequests.duration_utils import (get_request_duration, get_request_duration_sum, get_total_duration_dict,
-                                                  OVERHEAD_ALLOWANCE, get_molecule_duration, get_num_exposures, get_semester_in)
+                                                  OVERHEAD_ALLOWANCE, get_molecule_duration, get_num_exposures)
+from valhalla.proposals.semester_index import get_semester_in
 from datetime import timedelta, datetime
 from valhalla.common.rise_set_utils import get_rise_set_intervals
 
@@ -249,7 +250,7 @@ class RequestSerializer(serializers.ModelSerializer):
     molecules = MoleculeSerializer(many=True)
     windows = WindowSerializer(many=True)
     cadence = CadenceSerializer(required=False)
-    duration = serializers.ReadOnlyField()
+    duration = serializers.ReadOnlyField(source='get_duration')
 
     class Meta:
         model = Request
@@ -395,24 +396,26 @@ class UserRequestSerializer(serializers.ModelSerializer):
 
         user_request = UserRequest.objects.create(**validated_data)
 
-        for r in request_data:
-            target_data = r.pop('target')
-            constraints_data = r.pop('constraints')
-            window_data = r.pop('windows')
-            molecule_data = r.pop('molecules')
-            location_data = r.pop('location')
+        with touch_requests_once():
+            for r in request_data:
+                target_data = r.pop('target')
+                constraints_data = r.pop('constraints')
+                window_data = r.pop('windows')
+                molecule_data = r.pop('molecules')
+                location_data = r.pop('location')
 
-            request = Request.objects.create(user_request=user_request, **r)
-            Location.objects.create(request=request, **location_data)
-            Target.objects.create(request=request, **target_data)
-            Constraints.objects.create(request=request, **constraints_data)
+                duration = get_request_duration({'molecules': molecule_data})
+                request = Request.objects.create(user_request=user_request, duration=duration, **r)
+                Location.objects.create(request=request, **location_data)
+                Target.objects.create(request=request, **target_data)
+                Constraints.objects.create(request=request, **constraints_data)
 
-            for data in window_data:
-                Window.objects.create(request=request, **data)
-            for data in molecule_data:
-                Molecule.objects.create(request=request, **data)
+                for data in window_data:
+                    Window.objects.create(request=request, **data)
+                # the duration is already stored, so skip the molecule signals that would recompute it
+                Molecule.objects.bulk_create([Molecule(request=request, **data) for data in molecule_data])
 
-        debit_ipp_time(user_request)
+            debit_ipp_time(user_request)
 
         logger.info('UserRequest created', extra={'tags': {'user': user_request.submitter.username,
                                                            'tracking_num': user_request.id,
@@ -451,13 +454,10 @@ class UserRequestSerializer(serializers.ModelSerializer):
 
         try:
             total_duration_dict = get_total_duration_dict(data)
+            proposal_id = data['proposal'].id
+            time_allocations = TimeAllocationResolver.for_keys((tak, proposal_id) for tak in total_duration_dict)
             for tak, duration in total_duration_dict.items():
-                time_allocation = TimeAllocation.objects.get(
-                    semester=tak.semester,
-                    telescope_class=tak.telescope_class,
-                    instrument_name=tak.instrument_name,
-                    proposal=data['proposal'],
-                )
+                time_allocation = time_allocations.get(tak, proposal_id)
                 time_available = 0
                 if data['observation_type'] == UserRequest.NORMAL:
                     time_available = time_allocation.std_allocation - time_allocation.std_time_used
@@ -491,7 +491,7 @@ class UserRequestSerializer(serializers.ModelSerializer):
                             data['proposal'], tak.semester, tak.telescope_class)
                     )
             # validate the ipp debitting that will take place later
-            validate_ipp(data, total_duration_dict)
+            validate_ipp(data, total_duration_dict, time_allocations)
         except ObjectDoesNotExist:
             raise serializers.ValidationError(
                 _("You do not have sufficient time allocated on the instrument you're requesting for this proposal.")
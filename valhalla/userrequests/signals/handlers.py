@@ -1,10 +1,15 @@
 from django.dispatch import receiver
-from django.db.models.signals import pre_save, post_save
+from django.db.models.signals import pre_save, post_save, post_delete
+import logging
 
-from valhalla.userrequests.models import UserRequest, Request
+from valhalla.userrequests.models import UserRequest, Request, Molecule, Window, Target, Location, Constraints
+from valhalla.common.configdb import configdb_changed, ConfigDBException
+from valhalla.userrequests.tasks import update_pending_request_durations
 from valhalla.userrequests.state_changes import on_request_state_change, on_userrequest_state_change
 from valhalla.proposals.notifications import userrequest_notifications
 
+logger = logging.getLogger(__name__)
+
 
 @receiver(pre_save, sender=UserRequest)
 def cb_userrequest_pre_save(sender, instance, *args, **kwargs):
@@ -29,3 +34,37 @@ def cb_request_pre_save(sender, instance, *args, **kwargs):
 @receiver(post_save, sender=UserRequest)
 def cb_userrequest_send_notifications(sender, instance, *args, **kwargs):
     userrequest_notifications(instance)
+
+
+@receiver(post_save, sender=Molecule)
+@receiver(post_delete, sender=Molecule)
+def cb_molecule_changed(sender, instance, *args, **kwargs):
+    try:
+        instance.request.update_duration()
+    except ConfigDBException as e:
+        # the molecule change itself should not fail, so clear the stale duration for get_duration to compute later
+        logger.warning('Failed to update the duration of request {}, clearing it: {}'.format(
+            instance.request_id, repr(e)
+        ))
+        instance.request.duration = None
+        Request.objects.filter(pk=instance.request_id).update(duration=None)
+
+
+@receiver(post_save, sender=Window)
+@receiver(post_delete, sender=Window)
+@receiver(post_save, sender=Molecule)
+@receiver(post_delete, sender=Molecule)
+@receiver(post_save, sender=Target)
+@receiver(post_delete, sender=Target)
+@receiver(post_save, sender=Location)
+@receiver(post_delete, sender=Location)
+@receiver(post_save, sender=Constraints)
+@receiver(post_delete, sender=Constraints)
+def cb_request_part_changed(sender, instance, *args, **kwargs):
+    Request.touch(instance.request_id)
+
+
+@receiver(configdb_changed)
+def cb_configdb_changed(sender, resource, *args, **kwargs):
+    if resource == 'sites':
+        update_pending_request_durations.delay()
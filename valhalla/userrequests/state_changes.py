@@ -1,10 +1,12 @@
 from django.utils import timezone
 from django.db import transaction
+from django.db.models import F, Max
 from django.utils.translation import ugettext as _
 
-from valhalla.proposals.models import TimeAllocation, TimeAllocationKey
+from valhalla.proposals.models import TimeAllocationKey, TimeAllocationResolver, touch_proposals_once
 from valhalla.userrequests.request_utils import exposure_completion_percentage_from_pond_block
-from valhalla.userrequests.models import UserRequest, Request
+from valhalla.userrequests.models import UserRequest, Request, Window
+from valhalla.proposals.notifications import userrequest_notifications
 
 import itertools
 import logging
@@ -36,6 +38,18 @@ def valid_state_change(old_state, new_state, obj):
         ))
 
 
+def get_ipp_modification(old_state, new_state, ipp_value):
+    '''The ipp time accounting for a request moving from old_state to new_state: 'credit', 'debit' or None'''
+    if new_state == 'COMPLETED':
+        if ipp_value < 1.0:
+            return 'credit'
+        elif old_state == 'WINDOW_EXPIRED':
+            return 'debit'
+    elif new_state in ['CANCELED', 'WINDOW_EXPIRED'] and ipp_value >= 1.0:
+        return 'credit'
+    return None
+
+
 @transaction.atomic
 def on_request_state_change(old_request, new_request):
     if old_request.state == new_request.state:
@@ -44,21 +58,16 @@ def on_request_state_change(old_request, new_request):
     # it must be a valid transition, so do time accounting here
     if new_request.state == 'COMPLETED':
         new_request.completed = timezone.now()
-        ipp_value = new_request.user_request.ipp_value
-        if ipp_value < 1.0:
-            modify_ipp_time_from_requests(ipp_value, [new_request], 'credit')
-        else:
-            if old_request.state == 'WINDOW_EXPIRED':
-                try:
-                    modify_ipp_time_from_requests(ipp_value, [new_request], 'debit')
-                except TimeAllocationError as tae:
-                    logger.warning(_('Request {} switched from WINDOW_EXPIRED to COMPLETED but did not have enough '
-                                     'ipp_time to debit: {}').format(new_request, repr(tae)))
-
-    if new_request.state == 'CANCELED' or new_request.state == 'WINDOW_EXPIRED':
-        ipp_value = new_request.user_request.ipp_value
-        if ipp_value >= 1.0:
-            modify_ipp_time_from_requests(ipp_value, [new_request], 'credit')
+    ipp_value = new_request.user_request.ipp_value
+    modification = get_ipp_modification(old_request.state, new_request.state, ipp_value)
+    if modification == 'debit':
+        try:
+            modify_ipp_time_from_requests(ipp_value, [new_request], 'debit')
+        except TimeAllocationError as tae:
+            logger.warning(_('Request {} switched from WINDOW_EXPIRED to COMPLETED but did not have enough '
+                             'ipp_time to debit: {}').format(new_request, repr(tae)))
+    elif modification == 'credit':
+        modify_ipp_time_from_requests(ipp_value, [new_request], 'credit')
 
 
 @transaction.atomic
@@ -71,20 +80,21 @@ def on_userrequest_state_change(old_userrequest, new_userrequest):
             requests_to_credit = new_userrequest.requests_set.filter(state__in=['PENDING', 'SCHEDULED'])
             modify_ipp_time_from_requests(new_userrequest.ipp_value, requests_to_credit, 'credit')
     elif new_userrequest.state in TERMINAL_STATES:
-        for r in new_userrequest.requests.filter(state__in=['PENDING', 'SCHEDULED']):
-            r.state = new_userrequest.state
-            r.save()
+        with touch_proposals_once():
+            for r in new_userrequest.requests.filter(state__in=['PENDING', 'SCHEDULED']):
+                r.state = new_userrequest.state
+                r.save()
 
 
-def validate_ipp(ur_dict, total_duration_dict):
+def validate_ipp(ur_dict, total_duration_dict, time_allocations=None):
     ipp_value = ur_dict['ipp_value'] - 1
     if ipp_value <= 0:
         return
 
-    time_allocations_dict = {tak: TimeAllocation.objects.get(semester__id=tak.semester,
-                                                             telescope_class=tak.telescope_class,
-                                                             instrument_name=tak.instrument_name,
-                                                             proposal__id=ur_dict['proposal']).ipp_time_available
+    proposal_id = ur_dict['proposal'].id
+    if time_allocations is None:
+        time_allocations = TimeAllocationResolver.for_keys((tak, proposal_id) for tak in total_duration_dict.keys())
+    time_allocations_dict = {tak: time_allocations.get(tak, proposal_id).ipp_time_available
                              for tak in total_duration_dict.keys()}
 
     for tak, duration in total_duration_dict.items():
@@ -126,27 +136,38 @@ def modify_ipp_time_from_requests(ipp_val, requests_list, modification='debit'):
     ipp_value = ipp_val - 1
     if ipp_value == 0:
         return
-    try:
+    # a problem with the accounting of one request should not stop the accounting of the others
+    keys = {}
+    for request in requests_list:
+        try:
+            keys[request.id] = (request.time_allocation_key, request.user_request.proposal_id)
+        except Exception as e:
+            logger.warning(_("Problem {}ing ipp time for request {}: {}").format(modification, request.id, repr(e)))
+    time_allocations = TimeAllocationResolver.for_keys(keys.values())
+    with touch_proposals_once():
         for request in requests_list:
-            time_allocation = request.timeallocation
-            duration_hours = request.duration / 3600.0
-            modified_time = time_allocation.ipp_time_available
-            if modification == 'debit':
-                modified_time -= (duration_hours * ipp_value)
-            elif modification == 'credit':
-                modified_time += abs(ipp_value) * duration_hours
-            if modified_time < 0:
-                logger.warning(_("ipp debiting for request {} would set ipp_time_available < 0. "
-                                 "Time available after debiting will be capped at 0").format(request.id))
-                modified_time = 0
-            elif modified_time > time_allocation.ipp_limit:
-                logger.warning(_("ipp crediting for request {} would set ipp_time_available > ipp_limit. "
-                                 "Time available after crediting will be capped at ipp_limit"))
-                modified_time = time_allocation.ipp_limit
-            time_allocation.ipp_time_available = modified_time
-            time_allocation.save()
-    except Exception as e:
-        logger.warning(_("Problem {}ing ipp time for request {}: {}").format(modification, request.id, repr(e)))
+            if request.id not in keys:
+                continue
+            try:
+                time_allocation = time_allocations.get(*keys[request.id])
+                duration_hours = request.get_duration() / 3600.0
+                modified_time = time_allocation.ipp_time_available
+                if modification == 'debit':
+                    modified_time -= (duration_hours * ipp_value)
+                elif modification == 'credit':
+                    modified_time += abs(ipp_value) * duration_hours
+                if modified_time < 0:
+                    logger.warning(_("ipp debiting for request {} would set ipp_time_available < 0. "
+                                     "Time available after debiting will be capped at 0").format(request.id))
+                    modified_time = 0
+                elif modified_time > time_allocation.ipp_limit:
+                    logger.warning(_("ipp crediting for request {} would set ipp_time_available > ipp_limit. "
+                                     "Time available after crediting will be capped at ipp_limit"))
+                    modified_time = time_allocation.ipp_limit
+                time_allocation.ipp_time_available = modified_time
+                time_allocation.save()
+            except Exception as e:
+                logger.warning(_("Problem {}ing ipp time for request {}: {}").format(modification, request.id, repr(e)))
 
 
 def get_request_state_from_pond_blocks(request_state, acceptability_threshold, request_blocks):
@@ -172,16 +193,15 @@ def get_request_state_from_pond_blocks(request_state, acceptability_threshold, r
     return request_state
 
 
-def update_request_state(request, request_blocks, ur_expired):
-    '''Update a request state given a set of pond blocks for that request'''
-    if request.state == 'COMPLETED':
-        return False
-
+def get_request_state_change(request_state, acceptability_threshold, request_blocks, ur_expired):
+    '''Works out the state a request should move to given a set of pond blocks for that request
+    :return: (the new state, the number of failures to add to its fail_count, whether the pond reported a change)
+    '''
     state_changed = False
     fail_count = 0
 
     # Get the state from the pond blocks
-    new_r_state = get_request_state_from_pond_blocks(request.state, request.acceptability_threshold, request_blocks)
+    new_r_state = get_request_state_from_pond_blocks(request_state, acceptability_threshold, request_blocks)
     # update the fail_count if the pond state was failed, before overwriting pond state
     if new_r_state == 'FAILED':
         fail_count = 1
@@ -189,9 +209,20 @@ def update_request_state(request, request_blocks, ur_expired):
     if new_r_state not in TERMINAL_STATES and ur_expired:
         new_r_state = 'WINDOW_EXPIRED'
     # If the state was the 'FAILED' fake state, switch it to pending but record that the state has changed
-    elif new_r_state == 'FAILED' and request.state not in TERMINAL_STATES:
+    elif new_r_state == 'FAILED' and request_state not in TERMINAL_STATES:
         new_r_state = 'PENDING'
         state_changed = True
+    return new_r_state, fail_count, state_changed
+
+
+def update_request_state(request, request_blocks, ur_expired):
+    '''Update a request state given a set of pond blocks for that request'''
+    if request.state == 'COMPLETED':
+        return False
+
+    new_r_state, fail_count, state_changed = get_request_state_change(
+        request.state, request.acceptability_threshold, request_blocks, ur_expired
+    )
     with transaction.atomic():
         # Re-get the request and lock. If the new state is a valid state transition, set it on the request atomically.
         req = Request.objects.select_for_update().get(pk=request.id)
@@ -204,14 +235,13 @@ def update_request_state(request, request_blocks, ur_expired):
     return state_changed
 
 
-def aggregate_request_states(user_request):
-    '''Aggregate the state of the user request from all of its child request states'''
-    request_states = [request.state for request in Request.objects.filter(user_request=user_request)]
+def aggregate_states(request_states, operator):
+    '''Aggregate the state of a user request with the given operator from its child request states'''
     # Set the priority ordering - assume AND by default
     state_priority = ['WINDOW_EXPIRED', 'PENDING', 'COMPLETED', 'CANCELED']
-    if user_request.operator == 'ONEOF':
+    if operator == 'ONEOF':
         state_priority = ['COMPLETED', 'PENDING', 'WINDOW_EXPIRED', 'CANCELED']
-    elif user_request.operator == 'MANY':
+    elif operator == 'MANY':
         state_priority = ['PENDING', 'COMPLETED', 'WINDOW_EXPIRED', 'CANCELED']
 
     for state in state_priority:
@@ -221,6 +251,12 @@ def aggregate_request_states(user_request):
     raise AggregateStateException('Unable to Aggregate States: {}'.format(request_states))
 
 
+def aggregate_request_states(user_request):
+    '''Aggregate the state of the user request from all of its child request states'''
+    request_states = [request.state for request in Request.objects.filter(user_request=user_request)]
+    return aggregate_states(request_states, user_request.operator)
+
+
 def update_request_states_for_window_expiration():
     '''Update the state of all requests and user_requests to WINDOW_EXPIRED if their last window has passed'''
     now = timezone.now()
@@ -244,25 +280,112 @@ def update_request_states_for_window_expiration():
 
 
 def update_request_states_from_pond_blocks(pond_blocks):
-    '''Update the states of requests and user_requests given a set of recently changed pond blocks.'''
-    blocks_with_tracking_nums = [pb for pb in pond_blocks if pb['molecules'][0]['tracking_num']]
-    sorted_blocks_with_tracking_nums = sorted(blocks_with_tracking_nums, key=lambda x: x['molecules'][0]['tracking_num'])
-    blocks_by_tracking_num = itertools.groupby(sorted_blocks_with_tracking_nums, lambda x: x['molecules'][0]['tracking_num'])
+    '''Update the states of requests and user_requests given a set of recently changed pond blocks.
+
+    All the affected user requests and their requests are locked at once, their new states are worked out in memory
+    with the same transitions as saving each one would make, and the changes are written with one update per distinct
+    change instead of one save per row.
+    '''
+    blocks_by_tracking_num = {}
+    for pb in pond_blocks:
+        molecule = pb['molecules'][0]
+        if molecule['tracking_num']:
+            blocks_by_request_num = blocks_by_tracking_num.setdefault(int(molecule['tracking_num']), {})
+            blocks_by_request_num.setdefault(int(molecule['request_num']), []).append(pb)
+    if not blocks_by_tracking_num:
+        return False
+
     now = timezone.now()
     states_changed = False
+    with transaction.atomic():
+        user_requests = {ur.id: ur for ur in UserRequest.objects.select_for_update().filter(
+            id__in=list(blocks_by_tracking_num)
+        ).order_by('id')}
+        requests_by_userrequest = {}
+        for request in Request.objects.select_for_update().filter(user_request__in=list(user_requests)).order_by('id'):
+            request.user_request = user_requests[request.user_request_id]
+            requests_by_userrequest.setdefault(request.user_request_id, []).append(request)
+        max_window_times = dict(Window.objects.filter(request__user_request__in=list(user_requests)).order_by(
+        ).values_list('request__user_request').annotate(Max('end')))
+
+        old_states = {}
+        fail_counts = {}
+        touched_requests = {}
+        changed_userrequests = []
+        for tracking_num, blocks_by_request_num in sorted(blocks_by_tracking_num.items()):
+            if tracking_num not in user_requests:
+                logger.warning('Pond blocks for user request {} which does not exist'.format(tracking_num))
+                continue
+            max_window_time = max_window_times.get(tracking_num)
+            if max_window_time is None:
+                logger.warning('Pond blocks for user request {} which has no windows'.format(tracking_num))
+                continue
+            user_request = user_requests[tracking_num]
+            ur_expired = max_window_time < now
+            requests = requests_by_userrequest.get(tracking_num, [])
+            for request in requests:
+                if request.id not in blocks_by_request_num or request.state == 'COMPLETED':
+                    continue
+                new_r_state, fail_count, state_changed = get_request_state_change(
+                    request.state, request.acceptability_threshold, blocks_by_request_num[request.id], ur_expired
+                )
+                fail_counts[request.id] = fail_count
+                touched_requests[request.id] = request
+                if new_r_state in REQUEST_STATE_MAP[request.state]:
+                    state_changed = True
+                    old_states.setdefault(request.id, request.state)
+                    request.state = new_r_state
+                states_changed |= state_changed
+
+            new_ur_state = aggregate_states([request.state for request in requests], user_request.operator)
+            if new_ur_state in REQUEST_STATE_MAP[user_request.state]:
+                states_changed = True
+                user_request.state = new_ur_state
+                changed_userrequests.append(user_request)
+                if new_ur_state in TERMINAL_STATES and new_ur_state != 'COMPLETED':
+                    # a canceled or expired user request takes its unfinished requests with it
+                    for request in requests:
+                        if request.state in ['PENDING', 'SCHEDULED']:
+                            touched_requests[request.id] = request
+                            old_states.setdefault(request.id, request.state)
+                            request.state = new_ur_state
+
+        _save_request_state_changes(touched_requests.values(), old_states, fail_counts, now)
+        for state, userrequests in itertools.groupby(sorted(changed_userrequests, key=lambda ur: ur.state),
+                                                     key=lambda ur: ur.state):
+            UserRequest.objects.filter(id__in=[ur.id for ur in userrequests]).update(state=state, modified=now)
+
+    for user_request in changed_userrequests:
+        userrequest_notifications(user_request)
+    return states_changed
 
-    for tracking_num, blocks in blocks_by_tracking_num:
-        sorted_blocks_by_request = sorted(blocks, key=lambda x: x['molecules'][0]['request_num'])
-        blocks_by_request_num = {int(k): list(v) for k, v in itertools.groupby(sorted_blocks_by_request, key=lambda x: x['molecules'][0]['request_num'])}
-        user_request = UserRequest.objects.prefetch_related('requests').get(pk=tracking_num)
-        ur_expired = user_request.max_window_time < now
-        requests = user_request.requests.all()
-        for request in requests:
-            if request.id in blocks_by_request_num:
-                states_changed |= update_request_state(request, blocks_by_request_num[request.id], ur_expired)
-        states_changed |= update_user_request_state(user_request)
 
-    return states_changed
+def _save_request_state_changes(requests, old_states, fail_counts, now):
+    '''Writes the new states and fail counts of the requests, and does the ipp time accounting and completion time
+    that saving each state change would do, with one query per distinct change'''
+    modifications = {}
+    updates = {}
+    for request in requests:
+        old_state = old_states.get(request.id, request.state)
+        completed = old_state != request.state and request.state == 'COMPLETED'
+        if completed:
+            request.completed = now
+        if old_state != request.state:
+            ipp_value = request.user_request.ipp_value
+            modification = get_ipp_modification(old_state, request.state, ipp_value)
+            if modification:
+                modifications.setdefault((ipp_value, modification), []).append(request)
+        request.fail_count += fail_counts.get(request.id, 0)
+        updates.setdefault((request.state, fail_counts.get(request.id, 0), completed), []).append(request.id)
+
+    with touch_proposals_once():
+        for (ipp_value, modification), requests_to_modify in modifications.items():
+            modify_ipp_time_from_requests(ipp_value, requests_to_modify, modification)
+    for (state, fail_count, completed), request_ids in updates.items():
+        fields = {'state': state, 'fail_count': F('fail_count') + fail_count, 'modified': now}
+        if completed:
+            fields['completed'] = now
+        Request.objects.filter(id__in=request_ids).update(**fields)
 
 
 def update_user_request_state(user_request):
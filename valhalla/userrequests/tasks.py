@@ -1,12 +1,64 @@
 from celery import shared_task
+from django.core.cache import cache
+import hashlib
 import logging
 
+from valhalla.common.configdb import configdb
+from valhalla.proposals.models import Semester
+from valhalla.userrequests.models import Request
+from valhalla.userrequests.schedulable import build_schedulable_snapshot, can_store_schedulable_snapshot
 from valhalla.userrequests.state_changes import update_request_states_for_window_expiration
 
 logger = logging.getLogger(__name__)
 
+REQUEST_DURATION_CHUNK_SIZE = 1000
+REQUEST_DURATION_OVERHEADS_KEY = 'request_duration_overheads'
+
 
 @shared_task
 def expire_requests():
     logger.info('Expiring requests')
     update_request_states_for_window_expiration()
+
+
+def update_request_durations(requests):
+    ''' Recomputes the stored duration of each of the requests, a chunk of rows at a time
+    :return: the number of requests whose duration changed
+    '''
+    overheads = configdb.get_overhead_tables()
+    request_ids = list(requests.values_list('id', flat=True))
+    num_changed = 0
+    for i in range(0, len(request_ids), REQUEST_DURATION_CHUNK_SIZE):
+        chunk = Request.objects.filter(id__in=request_ids[i:i + REQUEST_DURATION_CHUNK_SIZE])
+        num_changed += sum(request.update_duration(overheads) for request in chunk.prefetch_related('molecules'))
+    return num_changed
+
+
+def get_overheads_hash(overheads):
+    return hashlib.sha1(repr([sorted(table.items()) for table in overheads]).encode()).hexdigest()
+
+
+@shared_task
+def update_pending_request_durations():
+    ''' Recomputes the durations of the pending requests if the configdb overheads have changed since the last run
+    '''
+    overheads_hash = get_overheads_hash(configdb.get_overhead_tables())
+    if cache.get(REQUEST_DURATION_OVERHEADS_KEY) == overheads_hash:
+        return
+    logger.info('Updating the durations of pending requests')
+    num_changed = update_request_durations(Request.objects.filter(state='PENDING'))
+    logger.info('Updated the durations of {} pending requests'.format(num_changed))
+    cache.set(REQUEST_DURATION_OVERHEADS_KEY, overheads_hash, None)
+
+
+@shared_task
+def update_schedulable_snapshot():
+    ''' Rebuilds the snapshot of the schedulable user requests of the current semester
+    '''
+    if not can_store_schedulable_snapshot():
+        logger.info('Not building the schedulable requests snapshot, the cache cannot store it')
+        return
+    semester = Semester.current_semesters().first()
+    if semester:
+        logger.info('Building the schedulable requests snapshot for semester {}'.format(semester))
+        build_schedulable_snapshot(semester.start, semester.end)
@@ -1,14 +1,16 @@
 from django.utils import timezone
 from django.test import TestCase
+from django.core.management import call_command
 from mixer.backend.django import mixer
 from datetime import datetime
+from io import StringIO
 import math
 
 from valhalla.userrequests.models import Request, Molecule, Target, UserRequest, Window, Location, Constraints
 from valhalla.proposals.models import Proposal, TimeAllocation, Semester
-from valhalla.common.configdb import ConfigDBException
+from valhalla.common.configdb import ConfigDB, ConfigDBException, configdb_changed
 from valhalla.common.test_helpers import ConfigDBTestMixin, SetTimeMixin
-from valhalla.userrequests.duration_utils import PER_MOLECULE_STARTUP_TIME, PER_MOLECULE_GAP
+from valhalla.userrequests.duration_utils import PER_MOLECULE_STARTUP_TIME, PER_MOLECULE_GAP, get_request_durations
 
 
 class TestUserRequestTotalDuration(ConfigDBTestMixin, SetTimeMixin, TestCase):
@@ -81,6 +83,12 @@ class TestUserRequestTotalDuration(ConfigDBTestMixin, SetTimeMixin, TestCase):
         tak = self.requests[0].time_allocation_key
         self.assertEqual(sum_duration, total_duration[tak])
 
+    def test_request_outside_of_any_semester_has_no_time_allocation(self):
+        Window.objects.filter(request=self.request).update(start=datetime(2017, 2, 1, tzinfo=timezone.utc),
+                                                           end=datetime(2017, 2, 2, tzinfo=timezone.utc))
+        with self.assertRaises(TimeAllocation.DoesNotExist):
+            self.request.timeallocation
+
 
 class TestRequestDuration(ConfigDBTestMixin, SetTimeMixin, TestCase):
     def setUp(self):
@@ -359,3 +367,75 @@ class TestRequestDuration(ConfigDBTestMixin, SetTimeMixin, TestCase):
         with self.assertRaises(ConfigDBException) as context:
             bad_molecule.duration
             self.assertTrue('not found in configdb' in context.exception)
+
+    def test_batch_request_durations_match_single_durations(self):
+        self.molecule_expose.request = self.request
+        self.molecule_expose.save()
+        spectrum_request = mixer.blend(Request)
+        self.molecule_spectrum.request = spectrum_request
+        self.molecule_spectrum.acquire_mode = 'WCS'
+        self.molecule_spectrum.save()
+        request_dicts = [
+            {'molecules': [m.as_dict for m in request.molecules.all()]} for request in [self.request, spectrum_request]
+        ]
+
+        durations = get_request_durations(request_dicts * 500)
+
+        self.assertEqual(len(durations), 1000)
+        self.assertEqual(durations[:2], [self.request.duration, spectrum_request.duration])
+        self.assertEqual(durations[-2:], durations[:2])
+
+    def test_stored_duration_follows_the_molecules(self):
+        self.molecule_expose_1.request = self.request
+        self.molecule_expose_1.save()
+        self.molecule_expose_2.request = self.request
+        self.molecule_expose_2.save()
+        duration = Request.objects.get(pk=self.request.id).duration
+
+        self.molecule_expose_2.delete()
+
+        self.assertLess(self.request.duration, duration)
+        self.assertEqual(Request.objects.get(pk=self.request.id).duration, self.request.duration)
+
+    def test_backfill_stores_missing_durations(self):
+        self.molecule_expose.request = self.request
+        self.molecule_expose.save()
+        duration = self.request.duration
+        Request.objects.filter(pk=self.request.id).update(duration=None)
+
+        call_command('backfill_request_durations', stdout=StringIO())
+
+        self.assertEqual(Request.objects.get(pk=self.request.id).duration, duration)
+
+    def test_duration_is_cleared_when_it_cannot_be_updated(self):
+        self.molecule_expose.request = self.request
+        self.molecule_expose.save()
+        self.assertIsNotNone(Request.objects.get(pk=self.request.id).duration)
+
+        mixer.blend(Molecule, request=self.request, instrument_name='FAKE_INSTRUMENT', bin_x=1, bin_y=1)
+
+        self.assertIsNone(Request.objects.get(pk=self.request.id).duration)
+
+    def test_missing_duration_is_computed_when_read(self):
+        self.molecule_expose.request = self.request
+        self.molecule_expose.save()
+        duration = self.request.duration
+        Request.objects.filter(pk=self.request.id).update(duration=None)
+
+        request = Request.objects.get(pk=self.request.id)
+        self.assertIsInstance(duration, int)
+        self.assertEqual(request.as_dict['duration'], duration)
+        self.assertEqual(Request.objects.get(pk=self.request.id).duration, duration)
+
+    def test_configdb_change_updates_pending_request_durations(self):
+        self.molecule_expose.request = self.request
+        self.molecule_expose.save()
+        duration = self.request.duration
+        completed_request = self.molecule_spectrum.request
+        Request.objects.filter(pk=self.request.id).update(state='PENDING', duration=1)
+        Request.objects.filter(pk=completed_request.id).update(state='COMPLETED', duration=1)
+
+        configdb_changed.send(sender=ConfigDB, resource='sites', version='new')
+
+        self.assertEqual(Request.objects.get(pk=self.request.id).duration, duration)
+        self.assertEqual(Request.objects.get(pk=completed_request.id).duration, 1)
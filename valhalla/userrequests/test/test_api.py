@@ -1,21 +1,34 @@
 from valhalla.userrequests.models import UserRequest, Request, DraftUserRequest
-from valhalla.userrequests.models import Window, Target, Molecule, Location, Constraints
+from valhalla.userrequests.models import Window, Target, Molecule, Location, Constraints, touch_requests_once
 from valhalla.proposals.models import Proposal, Membership, TimeAllocation, Semester
 from valhalla.common.test_helpers import ConfigDBTestMixin, SetTimeMixin
 import valhalla.userrequests.signals.handlers  # noqa
 from valhalla.userrequests.test.test_state_changes import PondMolecule, PondBlock
 from valhalla.userrequests.contention import Pressure
+from valhalla.userrequests.bulk_serializers import userrequest_dicts, userrequest_json
+from valhalla.userrequests.tasks import update_schedulable_snapshot
+from valhalla.userrequests.schedulable import SCHEDULABLE_STREAM_ERROR, SCHEDULABLE_SNAPSHOT_KEY
+from valhalla.userrequests.schedulable import SCHEDULABLE_SNAPSHOT_TIMEOUT
+from valhalla.common.renderers import MsgPackRenderer
+from valhalla.userrequests.state_changes import modify_ipp_time_from_requests
 from valhalla.accounts.models import Profile
 from valhalla.accounts.test_utils import blend_user
 
 from django.urls import reverse
 from django.contrib.auth.models import User
 from django.conf import settings
+from django.core.cache import cache
+from django.test import override_settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from rest_framework.test import APITestCase
+from rest_framework.renderers import JSONRenderer
 from mixer.backend.django import mixer
 from mixer.main import mixer as basic_mixer
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from datetime import datetime, timedelta
+import msgpack
 import responses
 import requests
 import os
@@ -23,7 +36,20 @@ import copy
 import json
 import random
 from urllib import parse
-from unittest.mock import patch
+from unittest.mock import patch, ANY
+from unittest import skipUnless
+
+
+def with_epoch_datetimes(value):
+    ''' Replaces the datetime strings in a json response with seconds since the epoch, as they are in msgpack'''
+    if isinstance(value, dict):
+        return {key: with_epoch_datetimes(item) for key, item in value.items()}
+    elif isinstance(value, list):
+        return [with_epoch_datetimes(item) for item in value]
+    elif isinstance(value, str) and parse_datetime(value):
+        return parse_datetime(value).timestamp()
+    return value
+
 
 generic_payload = {
     'proposal': 'temp',
@@ -147,6 +173,15 @@ class TestUserPostRequestApi(ConfigDBTestMixin, SetTimeMixin, APITestCase):
         self.assertEqual(response.status_code, 201)
         self.assertEqual(response.json()['group_id'], self.generic_payload['group_id'])
 
+    def test_post_userrequest_stores_request_duration(self):
+        response = self.client.post(reverse('api:user_requests-list'), data=self.generic_payload)
+        request = Request.objects.get(pk=response.json()['requests'][0]['id'])
+        self.assertGreater(request.duration, 0)
+        self.assertEqual(response.json()['requests'][0]['duration'], request.duration)
+        del request.duration
+        request.update_duration()
+        self.assertEqual(response.json()['requests'][0]['duration'], request.duration)
+
     def test_post_userrequest_wrong_proposal(self):
         bad_data = self.generic_payload.copy()
         bad_data['proposal'] = 'DoesNotExist'
@@ -509,6 +544,29 @@ class TestUserRequestIPP(ConfigDBTestMixin, SetTimeMixin, APITestCase):
         time_allocation_2m0 = TimeAllocation.objects.get(pk=self.time_allocation_2m0_floyds.id)
         self.assertEqual(time_allocation_2m0.ipp_time_available, 5.0)
 
+    def test_ipp_credit_touches_the_proposal_once(self):
+        ur = self.generic_multi_payload
+        ur['operator'] = 'MANY'
+        user_request = self._build_user_request(ur)
+
+        with CaptureQueriesContext(connection) as queries:
+            modify_ipp_time_from_requests(user_request.ipp_value, list(user_request.requests.all()), 'credit')
+
+        touches = [q for q in queries.captured_queries if q['sql'].startswith('UPDATE "proposals_proposal"')]
+        self.assertEqual(len(touches), 1)
+        self.assertEqual(TimeAllocation.objects.get(pk=self.time_allocation_2m0_floyds.id).ipp_time_available, 5.0)
+
+    def test_ipp_credit_continues_past_a_request_that_fails(self):
+        ur = self.generic_multi_payload
+        ur['operator'] = 'MANY'
+        user_request = self._build_user_request(ur)
+        self.time_allocation_1m0_sbig.delete()
+
+        modify_ipp_time_from_requests(user_request.ipp_value, list(user_request.requests.order_by('id')), 'credit')
+
+        time_allocation_2m0 = TimeAllocation.objects.get(pk=self.time_allocation_2m0_floyds.id)
+        self.assertEqual(time_allocation_2m0.ipp_time_available, 5.0)
+
 
 class TestRequestIPP(ConfigDBTestMixin, SetTimeMixin, APITestCase):
     def setUp(self):
@@ -669,18 +727,13 @@ class TestWindowApi(ConfigDBTestMixin, SetTimeMixin, APITestCase):
         self.assertEqual(response.status_code, 400)
         self.assertIn('The observation window does not fit within any defined semester', str(response.content))
 
-    @patch('valhalla.userrequests.duration_utils.get_semesters')
-    def test_request_windows_are_in_different_semesters(self, mock_get_semesters):
-        # Patch get_semesters so that we can add on a window that is in a different valid semester, and still ensure
-        # that the semesters that are returned are predictable in this test - the semesters variable used in
-        # get_semesters in duration_utils is a global, so it can cause unpredictable results across tests
-        another_semester = mixer.blend(
+    def test_request_windows_are_in_different_semesters(self):
+        mixer.blend(
             Semester,
             id='2017A',
             start=datetime(2017, 1, 1, tzinfo=timezone.utc),
             end=datetime(2017, 6, 30, tzinfo=timezone.utc),
         )
-        mock_get_semesters.return_value = [self.semester, another_semester]
         bad_data = self.generic_payload.copy()
         bad_data['requests'][0]['windows'].append({'start': '2017-02-01 00:00:00', 'end': '2017-02-02 00:00:00'})
         response = self.client.post(reverse('api:user_requests-list'), data=bad_data)
@@ -789,6 +842,62 @@ class TestCadenceApi(ConfigDBTestMixin, SetTimeMixin, APITestCase):
         self.assertEqual(response.status_code, 400)
         self.assertIn('Invalid data. Expected a dictionary, but got str.', str(response.content))
 
+    def test_post_cadence_with_too_many_requests(self):
+        with self.settings(MAX_CADENCE_REQUESTS=1):
+            response = self.client.post(reverse('api:user_requests-cadence'), data=self.generic_payload)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Cadence expands to more than 1 requests', str(response.content))
+
+    def test_cadence_preview_streams_the_expanded_windows(self):
+        response = self.client.post(reverse('api:user_requests-cadence') + '?preview=true', data=self.generic_payload)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        expanded = self.client.post(reverse('api:user_requests-cadence'), data=self.generic_payload).json()
+        self.assertEqual(lines, [{'request': 0, 'start': r['windows'][0]['start'], 'end': r['windows'][0]['end']}
+                                 for r in expanded['requests']])
+
+    def test_cadence_preview_stops_at_max_cadence_requests(self):
+        with self.settings(MAX_CADENCE_REQUESTS=1):
+            response = self.client.post(reverse('api:user_requests-cadence') + '?preview=true',
+                                        data=self.generic_payload)
+            lines = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(len(lines), 2)
+        self.assertIn('Cadence expands to more than 1 requests', lines[1]['errors'])
+
+    def test_cadence_preview_passes_through_requests_without_a_cadence(self):
+        data = self.generic_payload.copy()
+        window = {'start': '2016-09-29T21:12:18Z', 'end': '2016-10-29T21:12:19Z'}
+        data['requests'] = [dict(data['requests'][0], windows=[window])] + data['requests']
+        del data['requests'][0]['cadence']
+        response = self.client.post(reverse('api:user_requests-cadence') + '?preview=true', data=data)
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        expanded = self.client.post(reverse('api:user_requests-cadence'), data=data).json()
+        self.assertEqual(lines, [{'request': 0 if i == 0 else 1, 'start': r['windows'][0]['start'],
+                                  'end': r['windows'][0]['end']} for i, r in enumerate(expanded['requests'])])
+
+    def test_cadence_preview_with_a_request_that_is_not_a_dictionary(self):
+        bad_data = self.generic_payload.copy()
+        bad_data['requests'].append('invalid_request')
+        response = self.client.post(reverse('api:user_requests-cadence') + '?preview=true', data=bad_data)
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(lines[-1], {'request': 1, 'errors': 'Invalid data. Expected a dictionary.'})
+
+    def test_cadence_preview_with_no_visible_requests(self):
+        bad_data = self.generic_payload.copy()
+        bad_data['requests'][0]['cadence']['end'] = '2016-09-01T21:13:18Z'
+        bad_data['requests'][0]['cadence']['jitter'] = 0.02
+        bad_data['requests'][0]['cadence']['period'] = 0.02
+        response = self.client.post(reverse('api:user_requests-cadence') + '?preview=true', data=bad_data)
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(lines, [{'errors': 'No visible requests within cadence window parameters'}])
+
+    def test_cadence_preview_with_invalid_request(self):
+        bad_data = self.generic_payload.copy()
+        bad_data['requests'][0]['cadence']['jitter'] = 'bug'
+        response = self.client.post(reverse('api:user_requests-cadence') + '?preview=true', data=bad_data)
+        self.assertEqual(response.status_code, 400)
+
     def test_post_cadence_with_no_visible_requests(self):
         bad_data = self.generic_payload.copy()
         bad_data['requests'][0]['cadence']['end'] = '2016-09-01T21:13:18Z'
@@ -1478,6 +1587,7 @@ class TestMoleculeApi(ConfigDBTestMixin, SetTimeMixin, APITestCase):
         self.assertEqual(ur['requests'][0]['molecules'][0]['acquire_exp_time'], 20)
         self.assertEqual(response.status_code, 201)
 
+
 class TestGetRequestApi(ConfigDBTestMixin, APITestCase):
     def setUp(self):
         super().setUp()
@@ -1582,16 +1692,21 @@ class TestBlocksApi(APITestCase):
             result = self.client.get(reverse('api:requests-blocks', args=(self.request.id,)) + '?canceled=false')
             self.assertEqual(len(result.json()), 2)
 
-    @patch('requests.get', side_effect=requests.exceptions.ConnectionError())
+    @patch('requests.Session.get', side_effect=requests.exceptions.ConnectionError())
     def test_no_connection(self, request_patch):
         result = self.client.get(reverse('api:requests-blocks', args=(self.request.id,)))
         self.assertFalse(result.json())
 
-    @patch('requests.get', side_effect=requests.exceptions.HTTPError())
+    @patch('requests.Session.get', side_effect=requests.exceptions.HTTPError())
     def test_http_error(self, request_patch):
         result = self.client.get(reverse('api:requests-blocks', args=(self.request.id,)))
         self.assertFalse(result.json())
 
+    @patch('requests.Session.get', side_effect=requests.exceptions.ReadTimeout())
+    def test_timeout(self, request_patch):
+        result = self.client.get(reverse('api:requests-blocks', args=(self.request.id,)))
+        self.assertFalse(result.json())
+
 
 class TestDraftUserRequestApi(APITestCase):
     def setUp(self):
@@ -1813,6 +1928,18 @@ class TestUpdateRequestStatesAPI(APITestCase):
 
         self.assertFalse(response_json['isDirty'])
 
+    @responses.activate
+    def test_is_dirty_as_msgpack(self, modify_mock):
+        responses.add(responses.GET, settings.POND_URL + '/blocks/', json={'next': None, 'results': []}, status=200)
+        one_week_ahead = timezone.now() + timedelta(weeks=1)
+        response = self.client.get(
+            reverse('api:isDirty') + '?last_query_time=' + parse.quote(one_week_ahead.isoformat()),
+            HTTP_ACCEPT='application/msgpack'
+        )
+
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(response.content, raw=False), {'isDirty': False})
+
     @responses.activate
     def test_pond_blocks_no_state_changed(self, modify_mock):
         now = timezone.now()
@@ -1918,21 +2045,25 @@ class TestSchedulableRequestsApi(ConfigDBTestMixin, SetTimeMixin, APITestCase):
 
         self.client.force_login(self.user)
 
+    def streamed_json(self, response):
+        return json.loads(b''.join(response.streaming_content).decode())
+
     def test_setting_time_range_with_no_requests(self, modify_mock):
         start = datetime(2020, 1, 1, tzinfo=timezone.utc).isoformat()
         end = datetime(2020, 4, 1, tzinfo=timezone.utc).isoformat()
         response = self.client.get(reverse('api:user_requests-schedulable-requests') + '?start=' + start + '&end=' + end)
 
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.json()), 0)
+        self.assertEqual(len(self.streamed_json(response)), 0)
 
     def test_get_all_requests_in_semester(self, modify_mock):
         response = self.client.get(reverse('api:user_requests-schedulable-requests'))
 
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.json()), 10)
+        userrequests = self.streamed_json(response)
+        self.assertEqual(len(userrequests), 10)
         tracking_numbers = [ur.id for ur in self.urs]
-        for ur in response.json():
+        for ur in userrequests:
             self.assertIn(ur['id'], tracking_numbers)
 
     def test_dont_get_requests_in_terminal_states(self, modify_mock):
@@ -1952,8 +2083,9 @@ class TestSchedulableRequestsApi(ConfigDBTestMixin, SetTimeMixin, APITestCase):
         response = self.client.get(reverse('api:user_requests-schedulable-requests'))
 
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.json()), 5)
-        for ur in response.json():
+        userrequests = self.streamed_json(response)
+        self.assertEqual(len(userrequests), 5)
+        for ur in userrequests:
             self.assertIn(ur['id'], tracking_numbers)
 
     def test_dont_get_requests_in_inactive_proposals(self, modify_mock):
@@ -1964,7 +2096,7 @@ class TestSchedulableRequestsApi(ConfigDBTestMixin, SetTimeMixin, APITestCase):
         response = self.client.get(reverse('api:user_requests-schedulable-requests'))
 
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.json()), 0)
+        self.assertEqual(len(self.streamed_json(response)), 0)
 
     def test_get_ur_if_any_requests_in_time_range(self, modify_mock):
         start = datetime(2016, 10, 8, tzinfo=timezone.utc).isoformat()
@@ -1972,8 +2104,9 @@ class TestSchedulableRequestsApi(ConfigDBTestMixin, SetTimeMixin, APITestCase):
         response = self.client.get(reverse('api:user_requests-schedulable-requests') + '?start=' + start + '&end=' + end)
 
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.json()), 10)
-        for ur in response.json():
+        userrequests = self.streamed_json(response)
+        self.assertEqual(len(userrequests), 10)
+        for ur in userrequests:
             self.assertEqual(len(ur['requests']), 5)
 
     def test_not_admin(self, modify_mock):
@@ -1982,6 +2115,316 @@ class TestSchedulableRequestsApi(ConfigDBTestMixin, SetTimeMixin, APITestCase):
         response = self.client.get(reverse('api:user_requests-schedulable-requests'))
         self.assertEqual(response.status_code, 403)
 
+    def test_response_matches_userrequest_dicts(self, modify_mock):
+        response = self.client.get(reverse('api:user_requests-schedulable-requests'))
+
+        content = b''.join(response.streaming_content)
+        userrequests = [UserRequest.objects.get(pk=ur['id']).as_dict for ur in json.loads(content.decode())]
+        self.assertEqual(content, JSONRenderer().render(userrequests))
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_userrequests_are_listed_newest_first_on_every_path(self, modify_mock):
+        cache.clear()
+        created = datetime(2016, 8, 1, tzinfo=timezone.utc)
+        for ur, days in zip(self.urs, [3, 7, 1, 9, 5, 2, 8, 4, 10, 6]):
+            UserRequest.objects.filter(pk=ur.id).update(created=created + timedelta(days=days))
+        # the list as it was serialized before it was streamed: every user request's as_dict, in the default ordering
+        expected = JSONRenderer().render([ur.as_dict for ur in UserRequest.objects.all()])
+
+        response = self.client.get(reverse('api:user_requests-schedulable-requests'))
+        self.assertEqual(b''.join(response.streaming_content), expected)
+
+        update_schedulable_snapshot()
+        response = self.client.get(reverse('api:user_requests-schedulable-requests'))
+        self.assertFalse(response.streaming)
+        self.assertEqual(response.content, expected)
+
+        delta = self.get_delta(datetime(2016, 8, 15, tzinfo=timezone.utc))
+        self.assertEqual(delta['userrequests'], json.loads(expected.decode()))
+
+    @override_settings(SQL_JSON_EXPORT=True)
+    def test_sql_json_falls_back_to_python_serialization(self, modify_mock):
+        response = self.client.get(reverse('api:user_requests-schedulable-requests'))
+
+        content = b''.join(response.streaming_content)
+        userrequests = [UserRequest.objects.get(pk=ur['id']).as_dict for ur in json.loads(content.decode())]
+        self.assertEqual(len(userrequests), 10)
+        self.assertEqual(content, JSONRenderer().render(userrequests))
+
+    @patch('valhalla.userrequests.schedulable.SCHEDULABLE_CHUNK_SIZE', 3)
+    def test_streams_userrequests_in_chunks(self, modify_mock):
+        self.time_allocation_1m0.std_time_used = 99.0
+        self.time_allocation_1m0.save()
+        # user requests of 5 hours, so that only two of the first chunk fit in what is left of the allocation
+        Request.objects.filter(user_request__in=self.urs[2:]).update(duration=5 * 3600.0)
+
+        response = self.client.get(reverse('api:user_requests-schedulable-requests'))
+
+        self.assertTrue(response.streaming)
+        self.assertEqual([ur['id'] for ur in self.streamed_json(response)], [self.urs[0].id, self.urs[1].id])
+
+    @patch('valhalla.userrequests.schedulable.SCHEDULABLE_CHUNK_SIZE', 3)
+    def test_failure_part_way_through_ends_the_list_with_an_error(self, modify_mock):
+        ur_dicts = userrequest_dicts([ur.id for ur in self.urs[:3]])
+        with patch('valhalla.userrequests.schedulable.userrequest_dicts', side_effect=[ur_dicts, ConnectionError()]):
+            response = self.client.get(reverse('api:user_requests-schedulable-requests'))
+            streamed = self.streamed_json(response)
+
+        self.assertEqual([ur.get('id') for ur in streamed[:3]], [ur.id for ur in self.urs[:3]])
+        self.assertEqual(streamed[3:], [{'error': SCHEDULABLE_STREAM_ERROR}])
+
+    @patch('valhalla.userrequests.schedulable.SCHEDULABLE_CHUNK_SIZE', 3)
+    def test_msgpack_failure_part_way_through_ends_the_stream_with_an_error(self, modify_mock):
+        ur_dicts = userrequest_dicts([ur.id for ur in self.urs[:3]])
+        with patch('valhalla.userrequests.schedulable.userrequest_dicts', side_effect=[ur_dicts, ConnectionError()]):
+            response = self.client.get(reverse('api:user_requests-schedulable-requests'),
+                                       HTTP_ACCEPT='application/msgpack')
+            content = b''.join(response.streaming_content)
+
+        userrequests = msgpack.unpackb(content, raw=False)
+        self.assertEqual([ur['id'] for ur in userrequests[:3]], [ur.id for ur in self.urs[:3]])
+        self.assertEqual(userrequests[3:], [{'error': SCHEDULABLE_STREAM_ERROR}] * 7)
+
+    def test_msgpack_round_trips_to_json(self, modify_mock):
+        json_response = self.client.get(reverse('api:user_requests-schedulable-requests'))
+        response = self.client.get(reverse('api:user_requests-schedulable-requests'), HTTP_ACCEPT='application/msgpack')
+
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        content = b''.join(response.streaming_content)
+        userrequests = msgpack.unpackb(content, raw=False)
+        self.assertEqual(len(userrequests), 10)
+        # the stream is packed the same as the renderer packs the whole list
+        self.assertEqual(content, MsgPackRenderer().render(userrequest_dicts([ur['id'] for ur in userrequests])))
+        self.assertEqual(userrequests, with_epoch_datetimes(self.streamed_json(json_response)))
+        window = userrequests[0]['requests'][0]['windows'][0]
+        self.assertEqual(window['start'], datetime(2016, 10, 1, tzinfo=timezone.utc).timestamp())
+
+    def test_msgpack_leaves_out_incomplete_userrequests(self, modify_mock):
+        Constraints.objects.filter(request__user_request=self.urs[0]).delete()
+
+        response = self.client.get(reverse('api:user_requests-schedulable-requests'), HTTP_ACCEPT='application/msgpack')
+
+        userrequests = msgpack.unpackb(b''.join(response.streaming_content), raw=False)
+        self.assertEqual(sorted(ur['id'] for ur in userrequests), sorted(ur.id for ur in self.urs[1:]))
+
+    def test_delta_msgpack_round_trips_to_json(self, modify_mock):
+        since = datetime(2016, 8, 15, tzinfo=timezone.utc)
+        response = self.client.get(
+            reverse('api:user_requests-schedulable-requests') + '?format=msgpack&since=' + since.isoformat()
+        )
+
+        delta = msgpack.unpackb(response.content, raw=False)
+        json_delta = self.get_delta(since)
+        # the cursor is passed back as is, so it stays a string
+        self.assertEqual(delta.pop('cursor'), json_delta.pop('cursor'))
+        self.assertEqual(len(delta['userrequests']), 10)
+        self.assertEqual(delta, with_epoch_datetimes(json_delta))
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_serves_snapshot_with_etag(self, modify_mock):
+        cache.clear()
+        live_response = self.client.get(reverse('api:user_requests-schedulable-requests'))
+        update_schedulable_snapshot()
+
+        response = self.client.get(reverse('api:user_requests-schedulable-requests'))
+        self.assertFalse(response.streaming)
+        self.assertEqual(response.content, b''.join(live_response.streaming_content))
+
+        response = self.client.get(reverse('api:user_requests-schedulable-requests'),
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_stale_snapshot_falls_back_to_live(self, modify_mock):
+        cache.clear()
+        self.set_all_unmodified()
+        update_schedulable_snapshot()
+        self.urs[0].state = 'CANCELED'
+        self.urs[0].save()
+
+        response = self.client.get(reverse('api:user_requests-schedulable-requests'))
+
+        self.assertTrue(response.streaming)
+        self.assertEqual(len(self.streamed_json(response)), 9)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_snapshot_is_stale_after_a_delete(self, modify_mock):
+        cache.clear()
+        self.set_all_unmodified()
+        update_schedulable_snapshot()
+        self.urs[0].delete()
+
+        response = self.client.get(reverse('api:user_requests-schedulable-requests'))
+
+        self.assertTrue(response.streaming)
+        self.assertEqual(len(self.streamed_json(response)), 9)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_snapshot_the_cache_refuses_is_not_served(self, modify_mock):
+        cache.clear()
+        with patch('valhalla.userrequests.schedulable.cache.set') as set_mock:
+            with self.assertLogs('valhalla.userrequests.schedulable', 'WARNING'):
+                update_schedulable_snapshot()
+
+        set_mock.assert_called_once_with(SCHEDULABLE_SNAPSHOT_KEY, ANY, SCHEDULABLE_SNAPSHOT_TIMEOUT)
+        response = self.client.get(reverse('api:user_requests-schedulable-requests'))
+        self.assertTrue(response.streaming)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    @responses.activate
+    @override_settings(CELERY_TASK_ALWAYS_EAGER=False)
+    @patch('valhalla.userrequests.views.update_schedulable_snapshot.delay', side_effect=update_schedulable_snapshot)
+    def test_is_dirty_builds_snapshot(self, delay_mock, modify_mock):
+        cache.clear()
+        responses.add(responses.GET, settings.POND_URL + '/blocks/', json={'next': None, 'results': []}, status=200)
+        last_query_time = parse.quote(datetime(2016, 8, 1, tzinfo=timezone.utc).isoformat())
+        response = self.client.get(reverse('api:isDirty') + '?last_query_time=' + last_query_time)
+        self.assertTrue(response.json()['isDirty'])
+        delay_mock.assert_called_once_with()
+
+        response = self.client.get(reverse('api:user_requests-schedulable-requests'))
+
+        self.assertIn('ETag', response)
+        self.assertEqual(len(response.json()), 10)
+
+    @responses.activate
+    @patch('valhalla.userrequests.views.update_schedulable_snapshot.delay')
+    def test_is_dirty_does_not_build_snapshot_without_celery(self, delay_mock, modify_mock):
+        responses.add(responses.GET, settings.POND_URL + '/blocks/', json={'next': None, 'results': []}, status=200)
+        last_query_time = parse.quote(datetime(2016, 8, 1, tzinfo=timezone.utc).isoformat())
+        response = self.client.get(reverse('api:isDirty') + '?last_query_time=' + last_query_time)
+
+        self.assertTrue(response.json()['isDirty'])
+        delay_mock.assert_not_called()
+
+    @patch('valhalla.userrequests.tasks.build_schedulable_snapshot')
+    def test_snapshot_is_not_built_without_a_cache_to_keep_it(self, build_mock, modify_mock):
+        update_schedulable_snapshot()
+
+        build_mock.assert_not_called()
+
+    def test_missing_request_durations_are_stored(self, modify_mock):
+        Request.objects.filter(user_request=self.urs[0]).update(duration=None)
+
+        response = self.client.get(reverse('api:user_requests-schedulable-requests'))
+
+        self.assertEqual(len(self.streamed_json(response)), 10)
+        self.assertFalse(Request.objects.filter(user_request=self.urs[0], duration__isnull=True).exists())
+
+    def test_bulk_dicts_match_userrequest_dicts(self, modify_mock):
+        request = self.urs[0].requests.first()
+        Target.objects.filter(request=request).update(type='NON_SIDEREAL', scheme='MPC_COMET', eccentricity=0.5)
+        Location.objects.filter(request=request).update(site='', observatory='', telescope='')
+        ur_ids = [ur.id for ur in reversed(self.urs)]
+
+        with self.assertNumQueries(8):
+            ur_dicts = userrequest_dicts(ur_ids)
+
+        self.assertEqual(JSONRenderer().render(ur_dicts),
+                         JSONRenderer().render([UserRequest.objects.get(pk=ur_id).as_dict for ur_id in ur_ids]))
+
+    @skipUnless(connection.vendor == 'postgresql', 'the json is only built in the database on PostgreSQL')
+    def test_sql_json_matches_bulk_dicts_for_fractional_seconds(self, modify_mock):
+        request = self.urs[0].requests.first()
+        Window.objects.filter(request=request).update(
+            start=datetime(2016, 9, 29, 1, 2, 3, 123456, tzinfo=timezone.utc)
+        )
+        ur_ids = [ur.id for ur in self.urs]
+
+        self.assertEqual([json.loads(ur_json) for ur_json in userrequest_json(ur_ids)],
+                         json.loads(JSONRenderer().render(userrequest_dicts(ur_ids)).decode()))
+
+    def test_bulk_dicts_fill_in_missing_durations(self, modify_mock):
+        request = self.urs[0].requests.first()
+        duration = request.duration
+        Request.objects.filter(pk=request.id).update(duration=None)
+
+        ur_dict = userrequest_dicts([self.urs[0].id])[0]
+
+        self.assertEqual([r['duration'] for r in ur_dict['requests'] if r['id'] == request.id], [duration])
+        self.assertEqual(Request.objects.get(pk=request.id).duration, duration)
+
+    def test_bulk_dicts_leave_out_incomplete_userrequests(self, modify_mock):
+        Location.objects.filter(request__user_request=self.urs[0]).delete()
+        ur_ids = [ur.id for ur in self.urs]
+
+        ur_dicts = userrequest_dicts(ur_ids)
+
+        self.assertEqual([ur_dict['id'] for ur_dict in ur_dicts], ur_ids[1:])
+
+    def get_delta(self, since):
+        return self.client.get(
+            reverse('api:user_requests-schedulable-requests') + '?since=' + since.isoformat()
+        ).json()
+
+    def set_all_unmodified(self):
+        modified = datetime(2016, 8, 1, tzinfo=timezone.utc)
+        UserRequest.objects.update(modified=modified)
+        Request.objects.update(modified=modified)
+        Proposal.objects.update(modified=modified)
+
+    def test_delta_has_only_changed_userrequests(self, modify_mock):
+        self.set_all_unmodified()
+        window = Window.objects.filter(request__user_request=self.urs[0]).first()
+        window.end += timedelta(days=1)
+        window.save()
+        molecule = Molecule.objects.filter(request__user_request=self.urs[1]).first()
+        molecule.exposure_count = 5
+        molecule.save()
+        for request in self.urs[2].requests.all():
+            request.state = 'COMPLETED'
+            request.save()
+        self.urs[2].state = 'COMPLETED'
+        self.urs[2].save()
+
+        delta = self.get_delta(datetime(2016, 8, 15, tzinfo=timezone.utc))
+
+        self.assertEqual([ur['id'] for ur in delta['userrequests']], [self.urs[0].id, self.urs[1].id])
+        self.assertEqual(delta['userrequests'][1]['requests'][0]['molecules'][0]['exposure_count'], 5)
+        self.assertEqual(delta['removed'], [self.urs[2].id])
+        self.assertEqual(delta['cursor'], '2016-08-31T23:59:00Z')
+
+    def test_parts_saved_together_touch_their_request_once(self, modify_mock):
+        self.set_all_unmodified()
+        request = self.urs[0].requests.first()
+
+        with CaptureQueriesContext(connection) as queries:
+            with touch_requests_once():
+                for window in request.windows.all():
+                    window.save()
+                request.target.save()
+                request.constraints.save()
+
+        touches = [q for q in queries.captured_queries
+                   if q['sql'].startswith('UPDATE "userrequests_request" SET "modified"')]
+        self.assertEqual(len(touches), 1)
+        self.assertGreater(Request.objects.get(pk=request.id).modified, datetime(2016, 8, 15, tzinfo=timezone.utc))
+
+    def test_delta_rejects_a_malformed_cursor(self, modify_mock):
+        response = self.client.get(reverse('api:user_requests-schedulable-requests') + '?since=notadate')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Invalid since cursor', response.json()['errors'][0])
+
+    def test_delta_is_empty_when_nothing_changed(self, modify_mock):
+        self.set_all_unmodified()
+
+        delta = self.get_delta(datetime(2016, 8, 15, tzinfo=timezone.utc))
+
+        self.assertEqual(delta['userrequests'], [])
+        self.assertEqual(delta['removed'], [])
+
+    def test_delta_removes_userrequests_without_time_left(self, modify_mock):
+        self.set_all_unmodified()
+        self.time_allocation_1m0.std_time_used = 100.0
+        self.time_allocation_1m0.save()
+
+        delta = self.get_delta(datetime(2016, 8, 15, tzinfo=timezone.utc))
+
+        self.assertEqual(delta['userrequests'], [])
+        self.assertEqual(delta['removed'], sorted(ur.id for ur in self.urs))
+
 
 class TestContention(ConfigDBTestMixin, APITestCase):
     def setUp(self):
@@ -2137,22 +2580,23 @@ class TestPressure(ConfigDBTestMixin, APITestCase):
         # Check that the correct telescopes are returned.
         self.assertEqual(floyds_returned, p.telescopes['2M0-FLOYDS-SCICAM'])
 
-    @patch('valhalla.userrequests.contention.get_rise_set_intervals')
+    @patch('valhalla.userrequests.contention.get_filtered_rise_set_intervals_by_site')
     def test_visible_intervals(self, mock_intervals):
-        request = mixer.blend(Request, state='PENDING', duration=70*60)  # Request duration is 70 minutes.
+        request = mixer.blend(Request, state='PENDING')
         mixer.blend(Window, request=request)
         mixer.blend(Target, request=request)
         mixer.blend(Molecule, request=request)
         mixer.blend(Location, request=request, site='tst')
         mixer.blend(Constraints, request=request)
+        request.duration = 70*60  # Request duration is 70 minutes.
 
-        mock_intervals.return_value = [
+        mock_intervals.return_value = {'tst': [
             [self.now - timedelta(hours=6), self.now - timedelta(hours=2)],  # Sets before now.
             [self.now + timedelta(hours=2), self.now + timedelta(hours=6)],
             [self.now + timedelta(hours=8), self.now + timedelta(hours=12)],
             [self.now - timedelta(hours=1), self.now + timedelta(minutes=30)],  # Sets too soon after now.
             [self.now + timedelta(hours=14), self.now + timedelta(hours=15)]  # Duration longer than interval.
-        ]
+        ]}
         expected = {
             'tst': [
                 (self.now + timedelta(hours=2), self.now + timedelta(hours=6)),
@@ -2196,18 +2640,19 @@ class TestPressure(ConfigDBTestMixin, APITestCase):
         ]
         self.assertEqual(Pressure()._anonymize(data), expected)
 
-    @patch('valhalla.userrequests.contention.get_rise_set_intervals')
+    @patch('valhalla.userrequests.contention.get_filtered_rise_set_intervals_by_site')
     def test_binned_pressure_by_hours_from_now_should_be_gtzero_pressure(self, mock_intervals):
-        request = mixer.blend(Request, state='PENDING', duration=120*60)  # 2 hour duration.
+        request = mixer.blend(Request, state='PENDING')
         mixer.blend(Window, request=request)
         mixer.blend(Target, request=request)
-        mixer.blend(Molecule, request=request, instrument_name='1M0-SCICAM-SBIG')
+        # the duration is computed from the molecule, a little over 2 hours.
+        mixer.blend(Molecule, request=request, instrument_name='1M0-SCICAM-SBIG', exposure_time=3600, exposure_count=2)
         mixer.blend(Location, request=request, site='tst')
         mixer.blend(Constraints, request=request)
 
-        mock_intervals.return_value = [
+        mock_intervals.return_value = {'tst': [
             [self.now + timedelta(hours=2), self.now + timedelta(hours=6)],
-        ]
+        ]}
         p = Pressure()
         p.requests = [request]
         sum_of_pressure = sum(sum(time.values()) for i, time in enumerate(p._binned_pressure_by_hours_from_now()))
@@ -1,10 +1,12 @@
 from django.test import TestCase
 from mixer.backend.django import mixer
 from django.utils import timezone
+from unittest.mock import patch
 import datetime
 
 from valhalla.common.test_helpers import ConfigDBTestMixin, SetTimeMixin
-from valhalla.userrequests.cadence import expand_cadence_request
+from valhalla.userrequests.cadence import expand_cadence_request, iter_cadence_requests
+from valhalla.common import rise_set_utils
 from valhalla.userrequests.models import Request, Molecule, Target, Constraints, Location
 
 
@@ -68,3 +70,32 @@ class TestCadence(SetTimeMixin, ConfigDBTestMixin, TestCase):
 
         requests = expand_cadence_request(r_dict)
         self.assertEqual(len(requests), 5)
+
+    def test_visibility_is_computed_once_for_the_whole_cadence(self):
+        r_dict = self.req.as_dict
+        r_dict['cadence'] = {
+            'start': datetime.datetime(2016, 9, 1, tzinfo=timezone.utc),
+            'end': datetime.datetime(2016, 10, 1, tzinfo=timezone.utc),
+            'period': 1.0,
+            'jitter': 1.0
+        }
+        with patch('valhalla.userrequests.cadence.get_rise_set_intervals',
+                   wraps=rise_set_utils.get_rise_set_intervals) as mock_intervals:
+            requests = expand_cadence_request(r_dict)
+        self.assertEqual(mock_intervals.call_count, 1)
+        self.assertTrue(requests)
+        for request in requests:
+            self.assertEqual(len(request['windows']), 1)
+            self.assertNotIn('cadence', request)
+
+    def test_requests_are_generated_lazily(self):
+        r_dict = self.req.as_dict
+        r_dict['cadence'] = {
+            'start': datetime.datetime(2016, 9, 1, tzinfo=timezone.utc),
+            'end': datetime.datetime(2016, 10, 1, tzinfo=timezone.utc),
+            'period': 24.0,
+            'jitter': 12.0
+        }
+        first_request = next(iter_cadence_requests(r_dict))
+        self.assertEqual(first_request['windows'], expand_cadence_request(r_dict)[0]['windows'])
+        self.assertEqual(len(expand_cadence_request(r_dict, max_requests=3)), 3)
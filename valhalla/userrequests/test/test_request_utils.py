@@ -1,11 +1,15 @@
 from django.utils import timezone
 from django.test import TestCase
+from django.conf import settings
 from mixer.backend.django import mixer
 from datetime import datetime
 from unittest.mock import patch
+import requests
+import responses
 
-from valhalla.userrequests.request_utils import (get_airmasses_for_request_at_sites, get_telescope_states_for_request,
-                                                 get_rise_set_intervals)
+from valhalla.userrequests.request_utils import get_airmasses_for_request_at_sites, get_telescope_states_for_request
+from valhalla.userrequests.request_utils import iter_paginated_results
+from valhalla.common.rise_set_utils import get_rise_set_intervals
 from valhalla.userrequests.models import Request, Molecule, Target, UserRequest, Window, Location, Constraints
 from valhalla.proposals.models import Proposal, TimeAllocation, Semester
 from valhalla.common.test_telescope_states import TelescopeStatesFakeInput
@@ -385,3 +389,38 @@ class TestRequestTelescopeStates(TelescopeStatesFakeInput):
         telescope_states = get_telescope_states_for_request(self.request)
 
         self.assertEqual({}, telescope_states)
+
+
+class TestPaginatedResults(TestCase):
+    def setUp(self):
+        self.url = settings.POND_URL + '/blocks/'
+        for page in range(3):
+            responses.add(
+                responses.GET, self.url + '?page={}'.format(page),
+                json={'results': [{'id': page * 2}, {'id': page * 2 + 1}],
+                      'next': self.url + '?page={}'.format(page + 1) if page < 2 else None},
+                status=200, match_querystring=True
+            )
+
+    @responses.activate
+    def test_yields_the_results_of_every_page_in_order(self):
+        results = list(iter_paginated_results(self.url + '?page=0'))
+
+        self.assertEqual([result['id'] for result in results], list(range(6)))
+        self.assertEqual(len(responses.calls), 3)
+
+    @responses.activate
+    def test_fetches_one_page_ahead(self):
+        results = iter_paginated_results(self.url + '?page=0')
+
+        self.assertEqual(next(results), {'id': 0})
+        results.close()
+        self.assertLessEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_raises_for_error_pages(self):
+        responses.replace(responses.GET, self.url + '?page=1', body='Internal Server Error', status=500,
+                          match_querystring=True)
+
+        with self.assertRaises(requests.HTTPError):
+            list(iter_paginated_results(self.url + '?page=0'))
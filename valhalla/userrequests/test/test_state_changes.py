@@ -1,4 +1,6 @@
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
 from mixer.main import mixer
 from mixer.backend.django import mixer as dmixer
 from django.utils import timezone
@@ -688,6 +690,76 @@ class TestUpdateRequestStates(TestCase):
         self.ur.refresh_from_db()
         self.assertEqual(self.ur.state, 'COMPLETED')
 
+    def test_completion_time_fail_count_and_ipp_are_set(self, modify_mock):
+        now = timezone.now()
+        self.ur.ipp_value = 1.5
+        self.ur.save()
+        dmixer.cycle(3).blend(Window, request=(r for r in self.requests), start=now - timedelta(days=2),
+                              end=now + timedelta(days=1))
+        molecules1 = mixer.cycle(3).blend(PondMolecule, completed=True, failed=False, request_num=self.requests[0].id,
+                                          tracking_num=self.ur.id, events=[])
+        molecules2 = mixer.cycle(3).blend(PondMolecule, completed=False, failed=True, request_num=self.requests[1].id,
+                                          tracking_num=self.ur.id, events=[])
+        pond_blocks = mixer.cycle(2).blend(PondBlock, molecules=(m for m in [molecules1, molecules2]),
+                                           start=now - timedelta(minutes=30), end=now - timedelta(minutes=20))
+        pond_blocks = [pb._to_dict() for pb in pond_blocks]
+
+        self.assertTrue(update_request_states_from_pond_blocks(pond_blocks))
+
+        for req in self.requests:
+            req.refresh_from_db()
+        self.assertEqual(self.requests[0].state, 'COMPLETED')
+        self.assertIsNotNone(self.requests[0].completed)
+        self.assertEqual(self.requests[1].state, 'PENDING')
+        self.assertEqual(self.requests[1].fail_count, 1)
+        self.assertIsNone(self.requests[1].completed)
+        # completing with an ipp value of at least 1 from PENDING does not touch the ipp time
+        modify_mock.assert_not_called()
+
+    def test_userrequests_are_updated_with_a_fixed_number_of_queries(self, modify_mock):
+        now = timezone.now()
+
+        def expiring_pond_blocks(num_userrequests):
+            pond_blocks = []
+            for ur in dmixer.cycle(num_userrequests).blend(UserRequest, operator='AND', state='PENDING', ipp_value=1.0):
+                for request in dmixer.cycle(2).blend(Request, user_request=ur, state='PENDING'):
+                    dmixer.blend(Window, request=request, start=now - timedelta(days=2), end=now - timedelta(days=1))
+                    molecules = mixer.cycle(2).blend(PondMolecule, completed=False, failed=False,
+                                                     request_num=request.id, tracking_num=ur.id, events=[])
+                    pond_blocks.append(mixer.blend(PondBlock, molecules=molecules, start=now - timedelta(minutes=30),
+                                                   end=now - timedelta(minutes=20))._to_dict())
+            return pond_blocks
+
+        query_counts = []
+        for pond_blocks in [expiring_pond_blocks(1), expiring_pond_blocks(5)]:
+            with CaptureQueriesContext(connection) as queries:
+                update_request_states_from_pond_blocks(pond_blocks)
+            query_counts.append(len(queries))
+
+        self.assertEqual(query_counts[0], query_counts[1])
+        self.assertFalse(Request.objects.exclude(user_request=self.ur).exclude(state='WINDOW_EXPIRED').exists())
+        self.assertEqual(UserRequest.objects.filter(state='WINDOW_EXPIRED').count(), 6)
+        self.assertEqual(modify_mock.call_count, 2)
+
+    def test_userrequest_without_windows_is_skipped(self, modify_mock):
+        now = timezone.now()
+        other_ur = dmixer.blend(UserRequest, operator='SINGLE', state='PENDING')
+        other_request = dmixer.blend(Request, user_request=other_ur, state='PENDING')
+        dmixer.blend(Window, request=other_request, start=now - timedelta(days=2), end=now + timedelta(days=1))
+        pond_blocks = []
+        for request in [self.requests[0], other_request]:
+            molecules = mixer.cycle(2).blend(PondMolecule, completed=True, failed=False, request_num=request.id,
+                                             tracking_num=request.user_request_id, events=[])
+            pond_blocks.append(mixer.blend(PondBlock, molecules=molecules, start=now - timedelta(minutes=30),
+                                           end=now - timedelta(minutes=20))._to_dict())
+
+        update_request_states_from_pond_blocks(pond_blocks)
+
+        self.requests[0].refresh_from_db()
+        self.assertEqual(self.requests[0].state, 'PENDING')
+        other_request.refresh_from_db()
+        self.assertEqual(other_request.state, 'COMPLETED')
+
 
 @patch('valhalla.userrequests.state_changes.modify_ipp_time_from_requests')
 class TestExpireRequests(TestCase):
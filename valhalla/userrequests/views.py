@@ -13,17 +13,21 @@ from django.core.cache import cache
 from dateutil.parser import parse
 from datetime import timedelta
 from rest_framework.views import APIView
+from requests.exceptions import RequestException
 import logging
 
 from valhalla.common.configdb import configdb
+from valhalla.common.renderers import SCHEDULER_RENDERER_CLASSES
+from valhalla.proposals.semester_index import get_semester_bounds
 from valhalla.common.telescope_states import (TelescopeStates, get_telescope_availability_per_day,
                                               combine_telescope_availabilities_by_site_and_class,
                                               ElasticSearchException)
-from valhalla.userrequests.request_utils import get_airmasses_for_request_at_sites, return_paginated_results
+from valhalla.userrequests.request_utils import get_airmasses_for_request_at_sites, iter_paginated_results
 from valhalla.userrequests.models import UserRequest, Request
 from valhalla.userrequests.serializers import RequestSerializer
 from valhalla.userrequests.filters import UserRequestFilter
 from valhalla.userrequests.state_changes import update_request_states_from_pond_blocks
+from valhalla.userrequests.tasks import update_schedulable_snapshot
 from valhalla.userrequests.contention import Contention, Pressure
 
 logger = logging.getLogger(__name__)
@@ -123,6 +127,7 @@ class TelescopeStatesView(APIView):
     ''' Retrieves the telescope states for all telescopes between the start and end times
     '''
     permission_classes = (AllowAny,)
+    renderer_classes = SCHEDULER_RENDERER_CLASSES
 
     def get(self, request):
         try:
@@ -152,7 +157,8 @@ class TelescopeAvailabilityView(APIView):
         telescopes = request.query_params.getlist('telescope')
         try:
             telescope_availability = get_telescope_availability_per_day(
-                start, end, sites=sites, telescopes=telescopes
+                start, end, sites=sites, telescopes=telescopes,
+                semester_bounds=get_semester_bounds(start - timedelta(days=1), end + timedelta(days=1))
             )
         except ElasticSearchException:
             logger.warning('Error connecting to ElasticSearch. Is SBA reachable?')
@@ -197,9 +203,11 @@ class InstrumentsInformationView(APIView):
 class UserRequestStatusIsDirty(APIView):
     '''
         Gets the pond blocks changed since last call, and updates request and ur statuses with them. Returns if any
-        pond_blocks were received from the pond (isDirty)
+        pond_blocks were received from the pond (isDirty). When celery is enabled, a dirty result also queues a
+        rebuild of the schedulable requests snapshot of the current semester.
     '''
     permission_classes = (IsAdminUser,)
+    renderer_classes = SCHEDULER_RENDERER_CLASSES
 
     def get(self, request):
         try:
@@ -209,19 +217,20 @@ class UserRequestStatusIsDirty(APIView):
 
         url = settings.POND_URL + '/blocks/?modified_after={0}&canceled=False&limit=1000'.format(last_query_time.strftime('%Y-%m-%dT%H:%M:%S.%f'))
         now = timezone.now()
-        pond_blocks = []
         try:
-            pond_blocks = return_paginated_results(pond_blocks, url)
-        except Exception as e:
+            # the blocks of each page are grouped while the next page is fetched
+            is_dirty = update_request_states_from_pond_blocks(iter_paginated_results(url))
+        except (RequestException, ValueError) as e:
             return HttpResponseServerError({'error': repr(e)})
-
-        is_dirty = update_request_states_from_pond_blocks(pond_blocks)
         cache.set('isDirty_query_time', now, None)
 
         # also factor in if a change in requests (added, updated, cancelled) has occurred since we last checked
         last_update_time = max(Request.objects.latest('modified').modified,
                                UserRequest.objects.latest('modified').modified)
         is_dirty |= last_update_time >= last_query_time
+        # building the snapshot takes as long as serving the schedulable requests, so only do it in a celery worker
+        if is_dirty and not settings.CELERY_TASK_ALWAYS_EAGER:
+            update_schedulable_snapshot.delay()
 
         return Response({'isDirty': is_dirty})
 
@@ -1,26 +1,73 @@
-from rest_framework import viewsets, filters
+from rest_framework import viewsets, filters, serializers
 from rest_framework.decorators import list_route, detail_route
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticatedOrReadOnly, IsAdminUser
 from django.utils import timezone
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
 from django_filters.rest_framework import DjangoFilterBackend
 from dateutil.parser import parse
 import logging
+import json
 
-from valhalla.proposals.models import Proposal, Semester, TimeAllocation
+from valhalla.common.renderers import MsgPackRenderer, SCHEDULER_RENDERER_CLASSES
+from valhalla.proposals.models import Proposal, Semester
 from valhalla.userrequests.models import UserRequest, Request, DraftUserRequest
 from valhalla.userrequests.filters import UserRequestFilter, RequestFilter
-from valhalla.userrequests.cadence import expand_cadence_request
+from valhalla.userrequests.bulk_serializers import userrequest_dicts, userrequest_json, can_build_json_in_sql
+from valhalla.userrequests.schedulable import get_schedulable_userrequests, get_schedulable_snapshot
+from valhalla.userrequests.schedulable import schedulable_requests_json, schedulable_requests_msgpack
+from valhalla.userrequests.schedulable import get_schedulable_delta, DELTA_CURSOR_OVERLAP
+from valhalla.userrequests.cadence import expand_cadence_request, iter_cadence_requests
 from valhalla.userrequests.serializers import RequestSerializer, UserRequestSerializer
 from valhalla.userrequests.serializers import DraftUserRequestSerializer, CadenceRequestSerializer
-from valhalla.userrequests.duration_utils import (get_request_duration_dict, get_max_ipp_for_userrequest,
-                                                  OVERHEAD_ALLOWANCE)
-from valhalla.userrequests.state_changes import InvalidStateChange, TERMINAL_STATES
+from valhalla.userrequests.duration_utils import get_request_duration_dict, get_max_ipp_for_userrequest
+from valhalla.userrequests.state_changes import InvalidStateChange
 from valhalla.userrequests.request_utils import (get_airmasses_for_request_at_sites,
                                                  get_telescope_states_for_request)
 logger = logging.getLogger(__name__)
 
 
+TOO_MANY_CADENCE_REQUESTS_MSG = 'Cadence expands to more than {} requests, use a longer period or a shorter cadence'
+NO_VISIBLE_CADENCE_REQUESTS_MSG = 'No visible requests within cadence window parameters'
+
+
+def cadence_preview_lines(requests):
+    ''' Generates a line of json with the index and window of each request expanded from the (index, cadence request)
+        tuples, followed by an error line if they expand to more than MAX_CADENCE_REQUESTS requests. Requests without
+        a cadence are passed through as the (index, request data) and get a line for each of their own windows, or an
+        error line if they are not a dictionary, the same requests the non preview cadence endpoint sends back.
+    '''
+    datetime_field = serializers.DateTimeField()
+    count = 0
+    lines = 0
+    for index, req, cadence_request in requests:
+        if cadence_request is None:
+            if not isinstance(req, dict):
+                yield json.dumps({'request': index, 'errors': 'Invalid data. Expected a dictionary.'}) + '\n'
+                return
+            for window in req.get('windows', []):
+                lines += 1
+                yield json.dumps({'request': index, 'start': window.get('start'), 'end': window.get('end')}) + '\n'
+            continue
+        for request_dict in iter_cadence_requests(cadence_request):
+            if count == settings.MAX_CADENCE_REQUESTS:
+                yield json.dumps({'errors': TOO_MANY_CADENCE_REQUESTS_MSG.format(settings.MAX_CADENCE_REQUESTS)}) + '\n'
+                return
+            count += 1
+            lines += 1
+            window = request_dict['windows'][0]
+            yield json.dumps({
+                'request': index,
+                'start': datetime_field.to_representation(window['start']),
+                'end': datetime_field.to_representation(window['end'])
+            }) + '\n'
+    if not lines:
+        yield json.dumps({'errors': NO_VISIBLE_CADENCE_REQUESTS_MSG}) + '\n'
+
+
 class UserRequestViewSet(viewsets.ModelViewSet):
     permission_classes = (IsAuthenticatedOrReadOnly,)
     http_method_names = ['get', 'post', 'head', 'options']
@@ -55,57 +102,58 @@ class UserRequestViewSet(viewsets.ModelViewSet):
     def perform_create(self, serializer):
         serializer.save(submitter=self.request.user)
 
-    @list_route(methods=['get'], permission_classes=(IsAdminUser,))
+    @list_route(methods=['get'], permission_classes=(IsAdminUser,), renderer_classes=SCHEDULER_RENDERER_CLASSES)
     def schedulable_requests(self, request):
         '''
             Gets the set of schedulable User requests for the scheduler, should be called right after isDirty finishes
             Needs a start and end time specified as the range of time to get requests in. Usually this is the entire
             semester for a scheduling run.
+            With a since cursor, only returns the delta since the response that gave the cursor: the schedulable
+            User requests that changed, the ids of the User requests that changed and are no longer schedulable, and
+            the cursor to pass next time. The start and end should not change between calls using the same cursor.
+            User requests deleted outright are not in the removed ids, so a full fetch is needed after deleting any.
+            Responds with msgpack instead of json when asked for it with the Accept header or format=msgpack.
+            Json of the current semester, when start and end are left out or equal its bounds, is served from the
+            snapshot built after isDirty when nothing has changed since, with an ETag to send back in If-None-Match.
+            The live list is streamed after a 200 status, so a failure part way through ends it with an item holding
+            only an error message, repeated to fill the length of the array in msgpack. Treat such a list as failed.
         '''
         current_semester = Semester.current_semesters().first()
         start = parse(request.query_params.get('start', str(current_semester.start))).replace(tzinfo=timezone.utc)
         end = parse(request.query_params.get('end', str(current_semester.end))).replace(tzinfo=timezone.utc)
+        as_msgpack = request.accepted_renderer.format == MsgPackRenderer.format
 
-        # Schedulable requests are not in a terminal state, are part of an active proposal,
-        # and have a window within this semester
-        queryset = UserRequest.objects.exclude(state__in=TERMINAL_STATES).filter(
-            requests__windows__start__lte=end, requests__windows__start__gte=start,
-            proposal__active=True).prefetch_related('requests', 'requests__windows', 'requests__target', 'proposal',
-                                                    'proposal__timeallocation_set', 'requests__molecules', 'submitter',
-                                                    'requests__location', 'requests__constraints').distinct()
-
-        # queryset now contains all the schedulable URs and their associated requests and data
-        # Check that each request time available in its proposal still
-        ur_data = []
-        tas = {}
-        for ur in queryset.all():
-            total_duration_dict = ur.total_duration
-            for tak, duration in total_duration_dict.items():
-                if (tak, ur.proposal.id) in tas:
-                    time_allocation = tas[(tak, ur.proposal.id)]
-                else:
-                    time_allocation = TimeAllocation.objects.get(
-                        semester=tak.semester,
-                        instrument_name=tak.instrument_name,
-                        telescope_class=tak.telescope_class,
-                        proposal=ur.proposal.id,
-                    )
-                    tas[(tak, ur.proposal.id)] = time_allocation
-                if ur.observation_type == UserRequest.NORMAL:
-                    time_left = time_allocation.std_allocation - time_allocation.std_time_used
-                else:
-                    time_left = time_allocation.too_allocation - time_allocation.too_time_used
-                if time_left * OVERHEAD_ALLOWANCE >= (duration / 3600.0):
-                    ur_data.append(ur.as_dict)
-                    break
-                else:
-                    logger.warning(
-                        'not enough time left {0} in proposal {1} for ur {2} of duration {3}, skipping'.format(
-                            time_left, ur.proposal.id, ur.id, (duration / 3600.0)
-                        )
-                    )
+        if 'since' in request.query_params:
+            try:
+                since = parse(request.query_params['since']).replace(tzinfo=timezone.utc)
+            except (ValueError, OverflowError) as exc:
+                return Response({'errors': ['Invalid since cursor: {}'.format(exc)]}, status=400)
+            cursor = timezone.now() - DELTA_CURSOR_OVERLAP
+            ur_ids, removed_ids = get_schedulable_delta(start, end, since)
+            cursor = serializers.DateTimeField().to_representation(cursor)
+            if can_build_json_in_sql() and not as_msgpack:
+                return HttpResponse('{{"cursor": {}, "removed": {}, "userrequests": [{}]}}'.format(
+                    json.dumps(cursor), json.dumps(removed_ids), ','.join(userrequest_json(ur_ids))
+                ), content_type='application/json')
+            return Response({'cursor': cursor, 'removed': removed_ids, 'userrequests': userrequest_dicts(ur_ids)})
+
+        snapshot = None if as_msgpack else get_schedulable_snapshot(start, end)
+        if snapshot:
+            etag = quote_etag(snapshot['etag'])
+            response = get_conditional_response(request, etag=etag)
+            if response is None:
+                response = HttpResponse(snapshot['content'], content_type='application/json')
+            response['ETag'] = etag
+            return response
 
-        return Response(ur_data)
+        # Schedulable requests are not in a terminal state, are part of an active proposal,
+        # and have a window within this semester. Each is checked for time available in its proposal as it is streamed
+        ur_ids = list(get_schedulable_userrequests(start, end).values_list('id', flat=True))
+        if as_msgpack:
+            return StreamingHttpResponse(schedulable_requests_msgpack(ur_ids), content_type=MsgPackRenderer.media_type)
+        return StreamingHttpResponse(
+            schedulable_requests_json(ur_ids, catch_errors=True), content_type='application/json'
+        )
 
     @detail_route(methods=['post'])
     def cancel(self, request, pk=None):
@@ -143,12 +191,22 @@ class UserRequestViewSet(viewsets.ModelViewSet):
 
     @list_route(methods=['post'])
     def cadence(self, request):
+        if request.query_params.get('preview'):
+            return self._cadence_preview(request)
+
         expanded_requests = []
         for req in request.data.get('requests', []):
             if isinstance(req, dict) and req.get('cadence'):
                 cadence_request_serializer = CadenceRequestSerializer(data=req)
                 if cadence_request_serializer.is_valid():
-                    expanded_requests.extend(expand_cadence_request(cadence_request_serializer.validated_data))
+                    cadence_requests = expand_cadence_request(
+                        cadence_request_serializer.validated_data, settings.MAX_CADENCE_REQUESTS + 1
+                    )
+                    if len(cadence_requests) > settings.MAX_CADENCE_REQUESTS:
+                        return Response(
+                            {'errors': TOO_MANY_CADENCE_REQUESTS_MSG.format(settings.MAX_CADENCE_REQUESTS)}, status=400
+                        )
+                    expanded_requests.extend(cadence_requests)
                 else:
                     return Response(cadence_request_serializer.errors, status=400)
             else:
@@ -156,7 +214,7 @@ class UserRequestViewSet(viewsets.ModelViewSet):
 
         # if we couldn't find any valid cadence requests, return that as an error
         if not expanded_requests:
-            return Response({'errors': 'No visible requests within cadence window parameters'}, status=400)
+            return Response({'errors': NO_VISIBLE_CADENCE_REQUESTS_MSG}, status=400)
 
         # now replace the originally sent requests with the cadence requests and send it back
         ret_data = request.data.copy()
@@ -169,6 +227,22 @@ class UserRequestViewSet(viewsets.ModelViewSet):
             return Response(ur_serializer.errors, status=400)
         return Response(ret_data)
 
+    def _cadence_preview(self, request):
+        ''' Streams the window of each expanded cadence request as a line of json as soon as it passes rise-set,
+            without validating the whole user request again. The expansion stops when the client stops reading.
+        '''
+        requests = []
+        for index, req in enumerate(request.data.get('requests', [])):
+            if isinstance(req, dict) and req.get('cadence'):
+                cadence_request_serializer = CadenceRequestSerializer(data=req)
+                if not cadence_request_serializer.is_valid():
+                    return Response(cadence_request_serializer.errors, status=400)
+                requests.append((index, req, cadence_request_serializer.validated_data))
+            else:
+                requests.append((index, req, None))
+
+        return StreamingHttpResponse(cadence_preview_lines(requests), content_type='application/x-ndjson')
+
 
 class RequestViewSet(viewsets.ReadOnlyModelViewSet):
     permission_classes = (IsAuthenticatedOrReadOnly,)